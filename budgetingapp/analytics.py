@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+from database import DEFAULT_CURRENCY, MINOR_UNITS
+
+DEFAULT_PERCENTILES = (0.25, 0.5, 0.75, 0.9, 0.99)
+LEDGER_TYPES = ('income', 'expenses')
+
+
+def load_ledger(conn, user_id, currency=DEFAULT_CURRENCY):
+    """
+    Loads the user's income and expenses once into a DataFrame with typed columns:
+    date (datetime64), name, amount (int64 minor units of currency, converted at
+    the month's rate, see fx.py) and type ('income'/'expenses').
+    """
+    cursor = conn.cursor()
+    # The type comes back as its index in LEDGER_TYPES, the category code
+    cursor.execute("""
+        SELECT date, amount, name, type = 'expenses', currency FROM transactions WHERE user_id = ?
+    """, (user_id,))
+    # fromiter fills the columns straight from the cursor without a list of tuples
+    rows = np.fromiter(cursor, dtype=[('date', 'U10'), ('amount', 'i8'), ('name', 'O'), ('code', 'i1'),
+                                      ('currency', 'U3')])
+    dates = rows['date'].astype('datetime64[D]')
+    amounts = rows['amount']
+    if (rows['currency'] != currency).any():
+        from fx import rate_table
+
+        amounts = rate_table(conn).convert(amounts, rows['currency'], dates, currency)
+    return pd.DataFrame({
+        'date': pd.to_datetime(dates),
+        'name': rows['name'],
+        'amount': amounts,
+        'type': pd.Categorical.from_codes(rows['code'], categories=list(LEDGER_TYPES)),
+    })
+
+
+def monthly_totals(ledger):
+    """
+    Returns the exact income, expenses and net in minor units per calendar month,
+    including empty months.
+    """
+    months = ledger['date'].dt.to_period('M')
+    totals = ledger.pivot_table(index=months, columns='type', values='amount',
+                                aggfunc='sum', fill_value=0, observed=False)
+    totals = totals.reindex(columns=['income', 'expenses'], fill_value=0)
+    if len(totals):
+        totals = totals.reindex(pd.period_range(totals.index.min(), totals.index.max(), freq='M'),
+                                fill_value=0)
+    totals.index.name = 'month'
+    totals.columns.name = None
+    totals['net'] = totals['income'] - totals['expenses']
+    return totals
+
+
+def rolling_means(monthly, window=3):
+    """Rolling mean of every monthly column over `window` months."""
+    return monthly.rolling(window, min_periods=1).mean()
+
+
+def month_over_month(monthly):
+    """Relative change of each monthly column against the previous month (NaN where undefined)."""
+    previous = monthly.shift(1)
+    return (monthly - previous) / previous.abs().replace(0.0, np.nan)
+
+
+def savings_rate(monthly):
+    """Share of each month's income that was not spent (NaN for months without income)."""
+    return monthly['net'] / monthly['income'].replace(0.0, np.nan)
+
+
+def amount_percentiles(ledger, percentiles=DEFAULT_PERCENTILES):
+    """Percentiles of single transaction amounts, per type."""
+    return ledger.groupby('type', observed=False)['amount'].quantile(list(percentiles)).unstack()
+
+
+def top_payees(ledger, n=10, type='expenses'):
+    """The n names with the largest total amount of the given type."""
+    rows = ledger[ledger['type'] == type]
+    totals = rows.groupby('name', sort=False)['amount'].agg(['sum', 'count'])
+    return totals.nlargest(n, 'sum')
+
+
+def analyze(conn=None, user_id=None, ledger=None, window=3, top=10, currency=DEFAULT_CURRENCY):
+    """
+    Runs every analysis over the ledger, loading the user's ledger from conn in
+    currency if no DataFrame is given.
+
+    Returns:
+        A dict of DataFrames/Series keyed by analysis name.
+    """
+    if ledger is None:
+        ledger = load_ledger(conn, user_id, currency)
+    monthly = monthly_totals(ledger)
+    return {
+        'currency': currency,
+        'window': window,
+        'monthly': monthly,
+        'rolling': rolling_means(monthly, window),
+        'month_over_month': month_over_month(monthly),
+        'savings_rate': savings_rate(monthly),
+        'percentiles': amount_percentiles(ledger),
+        'top_payees': top_payees(ledger, top),
+        'top_income_sources': top_payees(ledger, top, 'income'),
+    }
+
+
+def format_report(results, months=12):
+    """Renders analyze() results as plain text for the UI or a terminal."""
+    monthly = results['monthly'].tail(months)
+    if monthly.empty:
+        return "No transactions yet."
+    # Amounts are kept in minor units and only shown in major units
+    report = pd.DataFrame({
+        'Income': monthly['income'] / MINOR_UNITS,
+        'Expenses': monthly['expenses'] / MINOR_UNITS,
+        'Net': monthly['net'] / MINOR_UNITS,
+        f"Net ({results['window']}m avg)": results['rolling']['net'].tail(months) / MINOR_UNITS,
+        'Expenses MoM': results['month_over_month']['expenses'].tail(months).map(_format_change),
+        'Savings rate': results['savings_rate'].tail(months).map(_format_percent),
+    })
+    sections = [
+        f"Monthly overview ({results['currency']})",
+        report.to_string(float_format=lambda value: f"{value:,.2f}"),
+        "",
+        "Transaction amount percentiles",
+        (results['percentiles'] / MINOR_UNITS).to_string(float_format=lambda value: f"{value:,.2f}"),
+        "",
+        "Top payees",
+        _major_sums(results['top_payees']).to_string(float_format=lambda value: f"{value:,.2f}"),
+        "",
+        "Top income sources",
+        _major_sums(results['top_income_sources']).to_string(float_format=lambda value: f"{value:,.2f}"),
+    ]
+    return "\n".join(sections)
+
+
+def _major_sums(payees):
+    return payees.assign(sum=payees['sum'] / MINOR_UNITS)
+
+
+def _format_percent(value):
+    return "" if pd.isna(value) else f"{value:.1%}"
+
+
+def _format_change(value):
+    return "" if pd.isna(value) else f"{value:+.1%}"
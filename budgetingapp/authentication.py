@@ -1,39 +1,15 @@
-import sqlite3
-from hashlib import sha256
-
 from PyQt5.QtWidgets import \
     QDialog, QLineEdit, QLabel, QVBoxLayout, QPushButton, QMessageBox
 
-
-def create_user(conn, username, password):
-    hashed_password = sha256(password.encode()).hexdigest()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        return False
-    return True
-
-
-def check_user(conn, username, password):
-    hashed_password = sha256(password.encode()).hexdigest()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, hashed_password))
-    return cursor.fetchone() is not None
-
-
-def add_default_user(conn):
-    username = "admin"
-    password = "admin"  # You should choose a more secure default password
-    if not check_user(conn, username, password):
-        create_user(conn, username, password)
+# The user functions are Qt-free so the CLI can use them; imported here for existing callers
+from users import create_user, authenticate, check_user, add_default_user
 
 
 class LoginDialog(QDialog):
     def __init__(self, db_conn):
         super().__init__()
         self.db_conn = db_conn
+        self.user_id = None  # set to the logged-in user's id once accepted
         self.init_ui()
 
     def init_ui(self):
@@ -54,7 +30,8 @@ class LoginDialog(QDialog):
     def check_login(self):
         username = self.username_line_edit.text()
         password = self.password_line_edit.text()
-        if check_user(self.db_conn, username, password):
+        self.user_id = authenticate(self.db_conn, username, password)
+        if self.user_id is not None:
             self.accept()  # Close the dialog and return success
         else:
             QMessageBox.warning(self, "Login Failed", "Incorrect username or password")
\ No newline at end of file
@@ -0,0 +1,201 @@
+"""
+Online snapshots of the database with the SQLite backup API, and restoring them.
+
+    python cli.py backup
+    python cli.py backups
+    python cli.py restore backups/budgeting-20240501-120000.db.gz
+
+A snapshot is copied BACKUP_STEP_PAGES pages at a time inside one read
+transaction, so it is consistent and never restarts while the app keeps writing
+(in WAL mode readers do not block writers). The copy is checked, gzip
+compressed and moved into place, and only the newest `keep` snapshots are kept.
+"""
+import datetime
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import zlib
+
+from database import BUSY_TIMEOUT_SECONDS
+
+BACKUP_SUFFIX = ".db.gz"
+BACKUP_STEP_PAGES = 1024
+DEFAULT_KEEP = 10
+# gzip level 1 is about three times faster than the default for ~15% larger ledger snapshots
+COMPRESS_LEVEL = 1
+TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+# Label of the snapshot restore_backup() takes of the database it replaces
+PRE_RESTORE_LABEL = "pre-restore"
+
+
+class BackupError(Exception):
+    """Raised when a snapshot cannot be made, or is not fit to be restored."""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def default_backup_dir(db_path):
+    """BUDGETING_BACKUP_DIR, or a backups directory next to the database."""
+    return os.environ.get("BUDGETING_BACKUP_DIR") or \
+        os.path.join(os.path.dirname(os.path.abspath(db_path)), "backups")
+
+
+def backup_prefix(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0] + "-"
+
+
+def list_backups(db_path, backup_dir=None):
+    """The snapshots of the database in backup_dir, newest first."""
+    backup_dir = backup_dir or default_backup_dir(db_path)
+    pattern = os.path.join(glob.escape(backup_dir), glob.escape(backup_prefix(db_path)) + "*" + BACKUP_SUFFIX)
+    # By modification time, as snapshots taken within a second only differ by a suffix
+    return sorted(glob.glob(pattern), key=lambda path: (os.stat(path).st_mtime_ns, path), reverse=True)
+
+
+def backup_database(db_path, backup_dir=None, keep=DEFAULT_KEEP, label=None, progress=None, is_cancelled=None):
+    """
+    Writes a compressed snapshot of the database at db_path into backup_dir
+    (default_backup_dir() if None) and deletes all but the newest `keep`
+    snapshots (none if keep is None).
+
+    Args:
+        label: Optional word added to the file name, e.g. PRE_RESTORE_LABEL.
+        progress: Optional callable receiving (pages copied, total pages).
+        is_cancelled: Optional callable; the snapshot is abandoned once it returns True.
+
+    Returns:
+        The path of the snapshot, or None if it was cancelled.
+
+    Raises:
+        BackupError: If the copy fails its quick_check.
+    """
+    backup_dir = backup_dir or default_backup_dir(db_path)
+    os.makedirs(backup_dir, exist_ok=True)
+    copy_fd, copy_path = tempfile.mkstemp(dir=backup_dir, suffix=".tmp")
+    os.close(copy_fd)
+    try:
+        if not _copy_database(db_path, copy_path, progress, is_cancelled):
+            return None
+        path = _new_backup_path(db_path, backup_dir, label)
+        with open(copy_path, "rb") as source, gzip.open(path + ".tmp", "wb", COMPRESS_LEVEL) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(path + ".tmp", path)
+    finally:
+        for leftover in (copy_path, copy_path + "-journal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    if keep is not None:
+        for old in list_backups(db_path, backup_dir)[max(keep, 1):]:
+            os.remove(old)
+    return path
+
+
+def _copy_database(db_path, copy_path, progress, is_cancelled):
+    """Copies the database into copy_path with the backup API; returns False if cancelled."""
+    source = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None)
+    target = sqlite3.connect(copy_path)
+    try:
+        # Holding a read transaction pins the snapshot; otherwise every commit of
+        # another connection would restart the copy from the first page
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        def step(status, remaining, total):
+            if is_cancelled is not None and is_cancelled():
+                raise _Cancelled()
+            if progress is not None:
+                progress(total - remaining, total)
+
+        try:
+            source.backup(target, pages=BACKUP_STEP_PAGES, progress=step)
+        except _Cancelled:
+            return False
+        source.execute("COMMIT")
+        # A standalone file, without the -wal and -shm files the source needs
+        target.execute("PRAGMA journal_mode = DELETE")
+        result = target.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise BackupError(f"The copy of {db_path} is damaged: {result}")
+        return True
+    finally:
+        target.close()
+        source.close()
+
+
+def _new_backup_path(db_path, backup_dir, label=None):
+    name = backup_prefix(db_path) + datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+    if label:
+        name += "-" + label
+    path = os.path.join(backup_dir, name + BACKUP_SUFFIX)
+    counter = 1
+    while os.path.exists(path):
+        counter += 1
+        path = os.path.join(backup_dir, f"{name}-{counter}{BACKUP_SUFFIX}")
+    return path
+
+
+def restore_backup(backup_path, db_path, backup_dir=None):
+    """
+    Replaces the database at db_path with a snapshot of backup_database().
+
+    The snapshot is decompressed next to the database and must pass PRAGMA
+    integrity_check before anything is touched. The current database is then
+    snapshotted with PRE_RESTORE_LABEL (outside the retention count) and
+    overwritten through the backup API, which is safe while other connections
+    have it open; they see the restored data from their next transaction.
+
+    Returns:
+        The path of the pre-restore snapshot, or None if there was no database.
+
+    Raises:
+        BackupError: If the snapshot cannot be read or fails the integrity check,
+            or the current database cannot be snapshotted.
+    """
+    restore_fd, restore_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(db_path)),
+                                                suffix=".restore")
+    os.close(restore_fd)
+    try:
+        try:
+            with gzip.open(backup_path, "rb") as source, open(restore_path, "wb") as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+        except (OSError, EOFError, zlib.error) as e:
+            raise BackupError(f"Cannot read {backup_path}: {e}") from None
+        snapshot = sqlite3.connect(restore_path)
+        try:
+            _check_snapshot(snapshot, backup_path)
+            previous = None
+            if os.path.exists(db_path):
+                try:
+                    previous = backup_database(db_path, backup_dir, keep=None, label=PRE_RESTORE_LABEL)
+                except (BackupError, sqlite3.DatabaseError) as e:
+                    raise BackupError(f"Cannot snapshot the current database ({e}); "
+                                      f"move {db_path} aside and restore again") from None
+            target = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS)
+            try:
+                snapshot.backup(target)
+            finally:
+                target.close()
+        finally:
+            snapshot.close()
+    finally:
+        for leftover in (restore_path, restore_path + "-journal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return previous
+
+
+def _check_snapshot(snapshot, backup_path):
+    try:
+        problems = [row[0] for row in snapshot.execute("PRAGMA integrity_check")]
+        tables = {row[0] for row in snapshot.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"{backup_path} is not a database: {e}") from None
+    if problems != ["ok"]:
+        raise BackupError(f"{backup_path} failed the integrity check: {'; '.join(problems[:5])}")
+    if "users" not in tables:
+        raise BackupError(f"{backup_path} is not a Budgeting App database")
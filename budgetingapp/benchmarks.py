@@ -0,0 +1,282 @@
+"""
+Benchmarks of the data-layer hot paths over synthetic ledgers.
+
+    python benchmarks.py --sizes 10k,100k,1M --output results.json
+    python benchmarks.py --sizes 10k,100k --baseline results.json
+
+With --baseline the run is compared against an earlier JSON result and the
+exit status is 1 if any operation got slower than --threshold allows.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from categories import apply_rules, fetch_budget
+from database import create_connection, initialize_database, sync_recurring_transactions_to_main
+from export import export_data
+from synthetic import generate_categories, generate_ledger, generate_portfolio, generate_rates, parse_size
+from ledger import add_entry, fetch_total, fetch_monthly_summary, fetch_data, delete_entries
+
+DEFAULT_SIZES = "10k,100k,1M,10M"
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 1.2  # 20% slower than the baseline counts as a regression
+DELETE_BATCH = 1000
+# The ledger is shared out between --users users; the benchmarks run as the first one
+BENCHMARK_USER = 1
+# The synthetic portfolio valued by the investment benchmarks, the same for every ledger size
+PORTFOLIO_TICKERS = 300
+PORTFOLIO_YEARS = 30
+# Budget categories of the benchmark user, each with BUDGET_RULES rules
+BUDGET_CATEGORIES = 300
+BUDGET_RULES = 2
+
+
+class Benchmark:
+    """A timed operation; setup runs untimed before every repetition."""
+
+    def __init__(self, name, run, setup=None, max_rows=None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.max_rows = max_rows  # skip on larger ledgers, e.g. for fetchall of everything
+
+
+def ledger_path(db_dir, rows, seed, users):
+    return os.path.join(db_dir, f"ledger_{rows}_{seed}_{users}.db")
+
+
+def prepare_ledger(db_dir, rows, seed, users=1):
+    """Creates the synthetic ledger for `rows`, or reuses one generated earlier."""
+    path = ledger_path(db_dir, rows, seed, users)
+    if not os.path.exists(path):
+        conn = create_connection(path + ".tmp")
+        initialize_database(conn)
+        generate_ledger(conn, rows, seed=seed, users=users)
+        conn.close()
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def reset_recurring(context):
+    """Undoes the previous sync so every repetition catches up the same occurrences."""
+    conn = context['conn']
+    with conn:
+        conn.execute("DELETE FROM transactions WHERE id > ?", (context['max_id'],))
+        conn.execute("UPDATE recurring_transactions SET next_due_date = start_date, last_processed_date = NULL")
+
+
+def pick_rows_to_delete(context):
+    conn = context['conn']
+    max_id = context['max_id']
+    ids = context['rng'].sample(range(1, max_id + 1), min(DELETE_BATCH, max_id))
+    placeholders = ",".join("?" * len(ids))
+    context['deleted'] = conn.execute(f"""
+        SELECT id, type, date, name, amount, user_id, category_id FROM transactions
+        WHERE id IN ({placeholders}) AND user_id = ? AND type = 'expenses'
+    """, ids + [BENCHMARK_USER]).fetchall()
+
+
+def restore_deleted_rows(context):
+    with context['conn']:
+        context['conn'].executemany(
+            """
+            INSERT INTO transactions (id, type, date, name, amount, user_id, category_id) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, context['deleted'])
+
+
+def value_holdings(context):
+    from investments import value_portfolio
+
+    valuation = value_portfolio(context['conn'], BENCHMARK_USER, store=context['price_store'])
+    return valuation.market_values(context['conn']), valuation.invested(context['conn'])
+
+
+def add_categorized_entry(context):
+    """Adds an expense the way the Add Data tab does: categorised by the rules, then its budget looked up."""
+    from categories import transaction_budget
+
+    id = add_entry(context['conn'], BENCHMARK_USER, "expenses", datetime.date.today(), "Tesco 7", 1250)
+    return transaction_budget(context['conn'], BENCHMARK_USER, id)
+
+
+def clear_price_cache(context):
+    """A new store reads every price file again, like the first valuation after a start."""
+    from investments import PriceStore
+
+    context['price_store'] = PriceStore(context['price_dir'])
+
+
+def populate_table_view(context):
+    """Builds the View Data model and view and waits for the first page, like TabTwo does."""
+    from PyQt5.QtWidgets import QTableView
+    from table_models import LedgerTableModel
+
+    model = LedgerTableModel(context['executor'], BENCHMARK_USER)
+    view = QTableView()
+    view.setModel(model)
+    model.refresh()
+    while model.pending is not None:
+        context['app'].processEvents()
+    view.deleteLater()
+
+
+def qt_benchmarks(context):
+    """Sets up an offscreen QApplication; returns no benchmarks if PyQt5 is missing."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PyQt5.QtWidgets import QApplication
+        from workers import DatabaseExecutor
+    except ImportError:
+        return []
+    context['app'] = QApplication.instance() or QApplication([])
+    context['executor'] = DatabaseExecutor(context['conn'])
+    return [Benchmark("qt_table_first_page", populate_table_view)]
+
+
+def benchmarks(context):
+    conn = context['conn']
+    export_path = os.path.join(context['tmp_dir'], "export.csv")
+    return [
+        Benchmark("fetch_total", lambda c: (fetch_total(conn, BENCHMARK_USER, "income"),
+                                            fetch_total(conn, BENCHMARK_USER, "expenses"))),
+        Benchmark("fetch_monthly_summary", lambda c: fetch_monthly_summary(conn, BENCHMARK_USER)),
+        # The same totals converted to another currency with the cached exchange rates
+        Benchmark("fetch_monthly_summary_converted",
+                  lambda c: fetch_monthly_summary(conn, BENCHMARK_USER, currency="USD")),
+        # Hundreds of tickers over decades of daily prices, first read from the Parquet files
+        Benchmark("value_portfolio", value_holdings, setup=clear_price_cache),
+        Benchmark("value_portfolio_cached", value_holdings),
+        # Hundreds of categories and rules; the rules are applied to the whole ledger first
+        Benchmark("apply_rules", lambda c: apply_rules(conn, BENCHMARK_USER, recategorize=True), max_rows=1000000),
+        Benchmark("fetch_budget",
+                  lambda c: fetch_budget(conn, BENCHMARK_USER, datetime.date.today().strftime("%Y-%m"))),
+        Benchmark("add_entry_categorized", add_categorized_entry),
+        Benchmark("fetch_data", lambda c: fetch_data(conn, BENCHMARK_USER, "expenses"), max_rows=1000000),
+        Benchmark("sync_recurring_transactions_to_main",
+                  lambda c: sync_recurring_transactions_to_main(conn, BENCHMARK_USER), setup=reset_recurring),
+        Benchmark("export_data_to_file", lambda c: export_data(conn, BENCHMARK_USER, export_path)),
+        Benchmark("delete_entries",
+                  lambda c: delete_entries(conn, BENCHMARK_USER, "expenses", [row[0] for row in c['deleted']]),
+                  setup=lambda c: (restore_deleted_rows(c) if c.get('deleted') else None, pick_rows_to_delete(c))),
+    ] + qt_benchmarks(context)
+
+
+def run_size(db_dir, tmp_dir, rows, seed, repeat, selected=None, users=1):
+    path = prepare_ledger(db_dir, rows, seed, users)
+    work_path = os.path.join(tmp_dir, "work.db")
+    # Benchmarks modify the ledger, so they run on a copy
+    source = sqlite3.connect(path)
+    target = sqlite3.connect(work_path)
+    source.backup(target)
+    source.close()
+    target.close()
+
+    conn = create_connection(work_path)
+    # Ledgers kept in --db-dir may predate the current schema
+    initialize_database(conn)
+    generate_rates(conn, seed=seed, years=PORTFOLIO_YEARS)
+    context = {'conn': conn, 'tmp_dir': tmp_dir, 'rng': random.Random(seed),
+               'max_id': conn.execute("SELECT MAX(id) FROM transactions").fetchone()[0] or 0,
+               'price_dir': os.path.join(tmp_dir, "prices")}
+    clear_price_cache(context)
+    generate_categories(conn, BUDGET_CATEGORIES, BUDGET_RULES, user_id=BENCHMARK_USER, seed=seed)
+    if not selected or selected & {"value_portfolio", "value_portfolio_cached"}:
+        generate_portfolio(conn, context['price_store'], PORTFOLIO_TICKERS, PORTFOLIO_YEARS,
+                           user_id=BENCHMARK_USER, seed=seed)
+    results = {}
+    for benchmark in benchmarks(context):
+        if selected and benchmark.name not in selected:
+            continue
+        if benchmark.max_rows is not None and rows > benchmark.max_rows:
+            continue
+        timings = []
+        for _ in range(repeat):
+            if benchmark.setup is not None:
+                benchmark.setup(context)
+            start = time.perf_counter()
+            benchmark.run(context)
+            timings.append(time.perf_counter() - start)
+        results[benchmark.name] = {'min': min(timings), 'median': statistics.median(timings),
+                                   'repeat': repeat}
+        print(f"  {benchmark.name:<40} min {min(timings) * 1000:10.2f} ms   "
+              f"median {statistics.median(timings) * 1000:10.2f} ms", file=sys.stderr)
+    if 'executor' in context:
+        context['executor'].shutdown()
+    conn.close()
+    os.remove(work_path)
+    shutil.rmtree(context['price_dir'], ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Prints current vs baseline minimum timings and returns the list of
+    (size, operation, ratio) entries slower than threshold.
+    """
+    regressions = []
+    print(f"{'size':>8} {'operation':<40} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for size, operations in results['results'].items():
+        for name, timing in operations.items():
+            previous = baseline.get('results', {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            ratio = timing['min'] / previous['min'] if previous['min'] else float('inf')
+            flag = "  REGRESSION" if ratio > threshold else ""
+            print(f"{size:>8} {name:<40} {previous['min'] * 1000:10.2f}ms {timing['min'] * 1000:10.2f}ms "
+                  f"{ratio:6.2f}x{flag}")
+            if ratio > threshold:
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the budgeting app's hot paths.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated ledger sizes, e.g. 10k,1M")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=1, help="users the ledger is shared out between")
+    parser.add_argument("--only", help="comma separated benchmark names to run")
+    parser.add_argument("--db-dir", help="where generated ledgers are kept and reused between runs")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="slowdown ratio that counts as a regression")
+    args = parser.parse_args(argv)
+
+    selected = set(args.only.split(",")) if args.only else None
+    results = {
+        'meta': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                 'platform': platform.platform(), 'seed': args.seed, 'repeat': args.repeat, 'users': args.users,
+                 'time': time.strftime("%Y-%m-%dT%H:%M:%S")},
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_dir = args.db_dir or tmp_dir
+        os.makedirs(db_dir, exist_ok=True)
+        for size in args.sizes.split(","):
+            print(f"{size} rows:", file=sys.stderr)
+            results['results'][size] = run_size(db_dir, tmp_dir, parse_size(size), args.seed,
+                                                args.repeat, selected, args.users)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""
+Budget categories: the categories of every user with their monthly limits, and
+the rules that put transactions into them by name.
+
+    python cli.py category Groceries --limit 400
+    python cli.py rule Groceries tesco
+    python cli.py budget --month 2024-05
+
+A rule is a phrase of one or more words, matched case-insensitively against
+whole words of a transaction's name; "council tax" matches "Council Tax May"
+but not "Councillor". When several rules match, the one with the most words
+wins, then the oldest. New transactions are categorised when they are added
+(see ledger.add_entry(), the importer and the recurring sync); apply_rules()
+categorises the rows that are already there.
+
+CategoryMatcher indexes the rules by their first word, so matching a name costs
+a dictionary lookup per word however many rules there are. It is compiled once
+per user and reused until the rules change.
+
+What was spent in every category is kept per month in the category_totals table
+by triggers on the transactions (see database.setup_categories_tables()), so
+fetch_budget() reads a handful of rows instead of adding up the ledger.
+"""
+import re
+import threading
+
+from changes import CATEGORIES, change_bus
+from database import DEFAULT_CURRENCY, MIGRATION_BATCH_SIZE, database_path, parse_currency
+
+# Letters and digits; punctuation and spaces separate words
+WORD = re.compile(r"[^\W_]+")
+
+
+class CategoryError(ValueError):
+    """Raised when a category or rule cannot be added or found."""
+
+
+def tokens(text):
+    """The lower-case words of text, e.g. ['sainsbury', 's', '1234'] for "SAINSBURY'S 1234"."""
+    return WORD.findall(text.casefold())
+
+
+class CategoryMatcher:
+    """
+    The compiled (rule id, category id, keywords) rules of a user: every rule
+    under its first word, longest and oldest first, so a name is matched with a
+    lookup per word rather than by trying every rule.
+    """
+
+    def __init__(self, rules, version=None):
+        self.version = version
+        self._rules = {}  # first word -> [(words, rule id, category id)], best first
+        for rule_id, category_id, keywords in rules:
+            words = tuple(tokens(keywords))
+            if words:
+                self._rules.setdefault(words[0], []).append((words, rule_id, category_id))
+        for candidates in self._rules.values():
+            candidates.sort(key=lambda candidate: (-len(candidate[0]), candidate[1]))
+
+    def __len__(self):
+        return sum(len(candidates) for candidates in self._rules.values())
+
+    def match(self, name):
+        """The category id of the best rule matching name, or None."""
+        if not self._rules or not name:
+            return None
+        words = tuple(tokens(name))
+        best = None
+        for position, word in enumerate(words):
+            for candidate in self._rules.get(word, ()):
+                phrase, rule_id, _ = candidate
+                if words[position:position + len(phrase)] == phrase:
+                    if best is None or (-len(phrase), rule_id) < (-len(best[0]), best[1]):
+                        best = candidate
+                    break  # the rest under this word are shorter or newer
+        return None if best is None else best[2]
+
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+def category_matcher(conn, user_id):
+    """
+    The CategoryMatcher of the user's rules, compiled only the first time and
+    again after a rule was added or deleted (by any connection). Shared by all threads.
+    """
+    # Rule ids are never reused, so the count and the highest id change with every change of the rules
+    version = conn.execute("SELECT COUNT(*), MAX(id) FROM category_rules WHERE user_id = ?", (user_id,)).fetchone()
+    key = (database_path(conn) or id(conn), user_id)
+    matcher = _matchers.get(key)
+    if matcher is None or matcher.version != version:
+        matcher = CategoryMatcher(fetch_rules(conn, user_id, with_names=False), version)
+        with _matchers_lock:
+            _matchers[key] = matcher
+    return matcher
+
+
+def categorize(conn, user_id, names):
+    """The category id (or None) of each of names under the user's rules."""
+    matcher = category_matcher(conn, user_id)
+    return [matcher.match(name) for name in names]
+
+
+def add_category(conn, user_id, name, monthly_limit=None, currency=DEFAULT_CURRENCY):
+    """
+    Adds a category with an optional monthly limit in minor units of currency
+    and returns its id.
+
+    Raises:
+        CategoryError: If the user already has a category of that name.
+    """
+    name = name.strip()
+    if not name:
+        raise CategoryError("A category needs a name")
+    if monthly_limit is not None and monthly_limit < 0:
+        raise CategoryError("The monthly limit cannot be negative")
+    if find_category(conn, user_id, name) is not None:
+        raise CategoryError(f"Category '{name}' already exists")
+    with conn:
+        cursor = conn.execute("INSERT INTO categories (user_id, name, monthly_limit, currency) VALUES (?, ?, ?, ?)",
+                              (user_id, name, monthly_limit, parse_currency(currency)))
+    change_bus.publish(CATEGORIES, user_id, inserted=[cursor.lastrowid])
+    return cursor.lastrowid
+
+
+def find_category(conn, user_id, name):
+    """The id of the user's category called name (ignoring case), or None."""
+    cursor = conn.execute("SELECT id FROM categories WHERE user_id = ? AND name = ? COLLATE NOCASE",
+                          (user_id, name.strip()))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def category_id(conn, user_id, name):
+    """
+    The id of the user's category called name.
+
+    Raises:
+        CategoryError: If there is no such category.
+    """
+    id = find_category(conn, user_id, name)
+    if id is None:
+        raise CategoryError(f"No category '{name}'")
+    return id
+
+
+def set_limit(conn, user_id, id, monthly_limit, currency=None):
+    """Sets the monthly limit of a category (None for no limit), and its currency if given."""
+    if monthly_limit is not None and monthly_limit < 0:
+        raise CategoryError("The monthly limit cannot be negative")
+    with conn:
+        if currency is None:
+            conn.execute("UPDATE categories SET monthly_limit = ? WHERE id = ? AND user_id = ?",
+                         (monthly_limit, id, user_id))
+        else:
+            conn.execute("UPDATE categories SET monthly_limit = ?, currency = ? WHERE id = ? AND user_id = ?",
+                         (monthly_limit, parse_currency(currency), id, user_id))
+    change_bus.publish(CATEGORIES, user_id, updated=[id])
+
+
+def delete_category(conn, user_id, id):
+    """Deletes a category and its rules; its transactions become uncategorised."""
+    with conn:
+        conn.execute("UPDATE transactions SET category_id = NULL WHERE category_id = ? AND user_id = ?", (id, user_id))
+        conn.execute("DELETE FROM category_rules WHERE category_id = ? AND user_id = ?", (id, user_id))
+        conn.execute("DELETE FROM categories WHERE id = ? AND user_id = ?", (id, user_id))
+    change_bus.publish(CATEGORIES, user_id, deleted=[id])
+
+
+def fetch_categories(conn, user_id):
+    """Returns the user's (id, name, monthly_limit, currency) categories by name."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, name, monthly_limit, currency FROM categories WHERE user_id = ? ORDER BY name COLLATE NOCASE, id
+    """, (user_id,))
+    return cursor.fetchall()
+
+
+def add_rule(conn, user_id, category_id, keywords):
+    """
+    Adds a rule putting transactions whose name contains the words of keywords
+    into the category, and returns its id. Existing transactions are left as
+    they are until apply_rules() runs.
+    """
+    if not tokens(keywords):
+        raise CategoryError(f"Rule '{keywords}' has no words to match")
+    if conn.execute("SELECT 1 FROM categories WHERE id = ? AND user_id = ?", (category_id, user_id)).fetchone() is None:
+        raise CategoryError(f"No category {category_id}")
+    with conn:
+        cursor = conn.execute("INSERT INTO category_rules (user_id, category_id, keywords) VALUES (?, ?, ?)",
+                              (user_id, category_id, " ".join(keywords.split())))
+    change_bus.publish(CATEGORIES, user_id, updated=[category_id])
+    return cursor.lastrowid
+
+
+def delete_rule(conn, user_id, id):
+    with conn:
+        conn.execute("DELETE FROM category_rules WHERE id = ? AND user_id = ?", (id, user_id))
+    change_bus.publish(CATEGORIES, user_id, reset=True)
+
+
+def fetch_rules(conn, user_id, with_names=True):
+    """
+    Returns the user's (id, category name, keywords) rules by category, or
+    (id, category id, keywords) rules by id without names.
+    """
+    cursor = conn.cursor()
+    if with_names:
+        cursor.execute("""
+            SELECT r.id, c.name, r.keywords FROM category_rules r JOIN categories c ON c.id = r.category_id
+            WHERE r.user_id = ? ORDER BY c.name COLLATE NOCASE, r.id
+        """, (user_id,))
+    else:
+        cursor.execute("SELECT id, category_id, keywords FROM category_rules WHERE user_id = ? ORDER BY id",
+                       (user_id,))
+    return cursor.fetchall()
+
+
+def apply_rules(conn, user_id, recategorize=False, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Categorises the user's uncategorised transactions by the rules, or all of
+    them with recategorize (rows no rule matches keep their category). Commits
+    every batch_size rows, so the app stays usable meanwhile.
+
+    Returns:
+        The number of transactions whose category changed.
+    """
+    matcher = category_matcher(conn, user_id)
+    if not len(matcher):
+        return 0
+    matches = {}  # name -> category id, as statements repeat the same names
+    changed = 0
+    last_id = 0
+    while True:
+        # In id order by the primary key; the unary + keeps SQLite off the user index, which would sort every batch
+        cursor = conn.execute(f"""
+            SELECT id, name, category_id FROM transactions
+            WHERE +user_id = ? AND id > ? {'' if recategorize else 'AND category_id IS NULL'}
+            ORDER BY id LIMIT ?
+        """, (user_id, last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        updates = []
+        for id, name, current in rows:
+            if name not in matches:
+                matches[name] = matcher.match(name)
+            category = matches[name]
+            if category is not None and category != current:
+                updates.append((category, id))
+        with conn:
+            conn.executemany("UPDATE transactions SET category_id = ? WHERE id = ?", updates)
+        changed += len(updates)
+        last_id = rows[-1][0]
+    if changed:
+        change_bus.publish(CATEGORIES, user_id, reset=True)
+    return changed
+
+
+def fetch_budget(conn, user_id, month, category_ids=None):
+    """
+    Returns a (category id, name, monthly limit, currency, spent, remaining) row
+    for each of the user's categories, or only category_ids, in month ('YYYY-MM').
+    spent is what the category's expenses came to in the month in minor units
+    of its currency, converted at the month's rate where they were in another
+    currency (see fx.py); remaining is None for categories without a limit.
+    """
+    conditions, params = ["c.user_id = ?"], [user_id]
+    if category_ids is not None:
+        conditions.append(f"c.id IN ({', '.join('?' * len(category_ids))})")
+        params += category_ids
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT c.id, c.name, c.monthly_limit, c.currency, t.currency, t.total
+        FROM categories c
+        LEFT JOIN category_totals t ON t.user_id = c.user_id AND t.month = ? AND t.category_id = c.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY c.name COLLATE NOCASE, c.id
+    """, [month] + params)
+    rows = cursor.fetchall()
+    spent = [total or 0 for *_, total in rows]
+    foreign = [index for index, row in enumerate(rows) if row[4] is not None and row[4] != row[3]]
+    if foreign:
+        # numpy is only loaded once something was spent in another currency than the category's
+        from fx import rate_table
+        table = rate_table(conn)
+        for index in foreign:
+            _, _, _, currency, spent_currency, total = rows[index]
+            spent[index] = int(table.convert([total], [spent_currency], [month], currency)[0])
+    budget = {}  # category id -> row, adding up what was spent in each currency
+    for (id, name, limit, currency, _, _), amount in zip(rows, spent):
+        previous = budget.get(id)
+        budget[id] = (id, name, limit, currency, amount + (previous[4] if previous else 0))
+    return [(id, name, limit, currency, amount, None if limit is None else limit - amount)
+            for id, name, limit, currency, amount in budget.values()]
+
+
+def transaction_budget(conn, user_id, transaction_id):
+    """
+    The fetch_budget() row of the category and month of one of the user's
+    transactions, e.g. to show what is left right after adding it, or None if
+    it is not a categorised expense.
+    """
+    cursor = conn.execute("""
+        SELECT category_id, substr(date, 1, 7) FROM transactions
+        WHERE id = ? AND user_id = ? AND type = 'expenses' AND category_id IS NOT NULL
+    """, (transaction_id, user_id))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    rows = fetch_budget(conn, user_id, row[1], [row[0]])
+    return rows[0] if rows else None
@@ -0,0 +1,79 @@
+"""
+Change notifications for the ledger, so open views can patch the rows that
+changed instead of reloading everything.
+
+The write helpers in ledger.py, database.py and importer.py publish a
+ChangeEvent on change_bus once their transaction has committed. This module
+does not depend on Qt; workers.ChangeNotifier re-emits the events as a signal
+on the GUI thread.
+"""
+import logging
+import threading
+
+# The table of the recurring rules; changes of transactions are published per type
+RECURRING = "recurring_transactions"
+# The budget categories and their rules; inserted, updated and deleted hold category ids
+CATEGORIES = "categories"
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeEvent:
+    """
+    Ids of the rows of one user that a committed write inserted, updated or deleted.
+
+    table is the transaction type ('income' or 'expenses'), RECURRING or CATEGORIES. reset
+    means the table changed wholesale (e.g. it was cleared) and has to be reloaded.
+    """
+
+    def __init__(self, table, user_id, inserted=(), updated=(), deleted=(), reset=False):
+        self.table = table
+        self.user_id = user_id
+        self.inserted = tuple(inserted)
+        self.updated = tuple(updated)
+        self.deleted = tuple(deleted)
+        self.reset = reset
+
+    def __repr__(self):
+        return (f"ChangeEvent({self.table!r}, user_id={self.user_id}, inserted={len(self.inserted)}, "
+                f"updated={len(self.updated)}, deleted={len(self.deleted)}, reset={self.reset})")
+
+
+class ChangeBus:
+    """
+    Delivers ChangeEvents to the subscribed callbacks, on the thread that
+    published them. Shared by all threads.
+    """
+
+    def __init__(self):
+        self.subscribers = ()
+        self._lock = threading.Lock()
+
+    @property
+    def listening(self):
+        """Whether anyone is subscribed, so writers can skip looking up what they changed."""
+        return bool(self.subscribers)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self.subscribers += (callback,)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self.subscribers = tuple(subscriber for subscriber in self.subscribers if subscriber != callback)
+
+    def publish(self, table, user_id, inserted=(), updated=(), deleted=(), reset=False):
+        """Sends a ChangeEvent to every subscriber, unless nothing changed or no one listens."""
+        subscribers = self.subscribers
+        if not subscribers or not (inserted or updated or deleted or reset):
+            return
+        event = ChangeEvent(table, user_id, inserted, updated, deleted, reset)
+        for callback in subscribers:
+            # The write has been committed, so a failing view must not fail it
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("Change subscriber failed for %r", event)
+
+
+change_bus = ChangeBus()
@@ -0,0 +1,283 @@
+import datetime
+
+import numpy as np
+
+from database import DEFAULT_CURRENCY, MINOR_UNITS
+from investments import value_portfolio
+
+RESOLUTIONS = ("day", "week", "month", "year")
+# numpy datetime64 unit each resolution is bucketed to
+RESOLUTION_UNITS = {"day": "D", "week": "W", "month": "M", "year": "Y"}
+
+
+def fetch_daily_totals(conn, user_id, table, currency=DEFAULT_CURRENCY):
+    """
+    Returns (dates, amounts) numpy arrays with one entry per day the user has
+    transactions, the amounts as int64 minor units of currency (converted at the
+    month's rate, see fx.py).
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT date, currency, SUM(amount) FROM transactions WHERE user_id = ? AND type = ?
+        GROUP BY date, currency ORDER BY date
+    """, (user_id, table))
+    rows = cursor.fetchall()
+    if not rows:
+        return np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64)
+    dates, currencies, amounts = zip(*rows)
+    dates = np.array(dates, dtype="datetime64[D]")
+    if any(code != currency for code in currencies):
+        from fx import rate_table
+
+        # Days with amounts in several currencies are summed once converted
+        amounts = rate_table(conn).convert(amounts, currencies, dates, currency)
+        return aggregate(dates, amounts, "day")
+    return dates, np.array(amounts, dtype=np.int64)
+
+
+def aggregate(dates, amounts, resolution):
+    """
+    Sums daily amounts (sorted by date) into buckets of the given resolution, keyed
+    by bucket start day. The sums stay exact int64.
+    """
+    buckets = dates.astype(f"datetime64[{RESOLUTION_UNITS[resolution]}]")
+    # Sorted dates keep every bucket contiguous, so each is summed from its first day on
+    keys, starts = np.unique(buckets, return_index=True)
+    return keys.astype("datetime64[D]"), np.add.reduceat(amounts, starts)
+
+
+def last_of_buckets(dates, amounts, resolution):
+    """
+    The last of daily balances (sorted by date) in every bucket of the given
+    resolution, keyed by bucket start day, as balances are not summed.
+    """
+    if not len(dates):
+        return dates, amounts
+    buckets = dates.astype(f"datetime64[{RESOLUTION_UNITS[resolution]}]")
+    keys, starts = np.unique(buckets, return_index=True)
+    return keys.astype("datetime64[D]"), amounts[np.append(starts[1:], len(amounts)) - 1]
+
+
+def fetch_net_worth(conn, user_id, income, expenses, currency=DEFAULT_CURRENCY):
+    """
+    Returns (dates, amounts) numpy arrays of the user's net worth at the end of
+    every day from the first transaction or trade on, through today or the last
+    transaction if that is later: the cash balance (income less expenses and the
+    cost of trades) plus the market value of the holdings, see investments.py.
+    income and expenses are the (dates, amounts) of fetch_daily_totals().
+    """
+    starts = [dates[0] for dates, _ in (income, expenses) if len(dates)]
+    end = max([dates[-1] for dates, _ in (income, expenses) if len(dates)]
+              + [np.datetime64(datetime.date.today(), "D")])
+    valuation = value_portfolio(conn, user_id, end.item())
+    if valuation is not None:
+        # Later than end if there are trades after it
+        starts.append(valuation.dates[0])
+        end = valuation.dates[-1]
+    if not starts:
+        return np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64)
+    dates = np.arange(min(starts), end + 1)
+    flows = np.zeros(len(dates), dtype=np.int64)
+    for (days, amounts), sign in ((income, 1), (expenses, -1)):
+        np.add.at(flows, (days - dates[0]).astype(np.int64), sign * amounts)
+    net_worth = np.cumsum(flows)
+    if valuation is not None:
+        first = int((valuation.dates[0] - dates[0]).astype(np.int64))
+        net_worth[first:] += valuation.market_values(conn, currency) - valuation.invested(conn, currency)
+    return dates, net_worth
+
+
+class ChartData:
+    """
+    Income and expenses pre-aggregated at every resolution, and the net worth at
+    the end of every bucket, as x (matplotlib date numbers, i.e. days since
+    1970-01-01) and y arrays sorted by x.
+    """
+
+    def __init__(self, income, expenses, currency=DEFAULT_CURRENCY, net_worth=None):
+        self.currency = currency
+        self.series = {}
+        for resolution in RESOLUTIONS:
+            self.series[resolution] = {
+                name: tuple(_to_xy(*aggregate(dates, amounts, resolution)))
+                for name, (dates, amounts) in (("income", income), ("expenses", expenses))
+            }
+            if net_worth is not None:
+                self.series[resolution]["net_worth"] = tuple(_to_xy(*last_of_buckets(*net_worth, resolution)))
+
+    def is_empty(self):
+        return all(len(x) == 0 for x, _ in self.series["day"].values())
+
+    def x_range(self):
+        starts = [x[0] for x, _ in self.series["day"].values() if len(x)]
+        ends = [x[-1] for x, _ in self.series["day"].values() if len(x)]
+        return min(starts), max(ends)
+
+
+def _to_xy(dates, amounts):
+    return dates.astype(np.int64).astype(float), amounts / MINOR_UNITS
+
+
+def load_chart_data(conn, user_id, currency=DEFAULT_CURRENCY):
+    """Loads and aggregates everything the graph tab needs; safe to run on a worker thread."""
+    income = fetch_daily_totals(conn, user_id, "income", currency)
+    expenses = fetch_daily_totals(conn, user_id, "expenses", currency)
+    return ChartData(income, expenses, currency, fetch_net_worth(conn, user_id, income, expenses, currency))
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling: keeps threshold points of (x, y)
+    that preserve the visual shape of the line.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    # The first and last points are kept, the rest are split into threshold - 2 buckets
+    every = (n - 2) / (threshold - 2)
+    bounds = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+    bounds[-1] = n - 1
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        # The third triangle corner is the average of the next bucket (or the last point)
+        next_start, next_end = (bounds[i + 1], bounds[i + 2]) if i + 2 < len(bounds) else (n - 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+class ChartEngine:
+    """
+    Draws income and expenses on one axes, and the net worth on another below it
+    sharing the date axis, and keeps the lines in place: on pan and
+    zoom it picks the resolution that fits the visible range, slices the visible
+    points and downsamples them to the canvas width before updating the artists.
+
+    The lines are animated artists, so a data update that keeps the axes as they
+    are only blits the lines over the cached background.
+    """
+    # Use a finer resolution as long as it has at most this many points per pixel
+    MAX_POINTS_PER_PIXEL = 1
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.figure = canvas.figure
+        self.data = None
+        self.resolution = None  # None picks one automatically
+        self.current_resolution = None
+        self.background = None
+        self.background_limits = None
+        self._updating = False
+
+        self.ax = self.figure.add_subplot(211)
+        self.ax.xaxis_date()
+        self.ax.set_ylabel('Amount')
+        self.ax.tick_params(labelbottom=False)
+        # Panning and zooming either axes moves both
+        self.net_worth_ax = self.figure.add_subplot(212, sharex=self.ax)
+        self.net_worth_ax.set_xlabel('Date')
+        self.net_worth_ax.set_ylabel('Amount')
+        self.net_worth_ax.set_title('Net Worth')
+        self.lines = {
+            "income": self.ax.plot([], [], label='Income', marker='o', markersize=3, animated=True)[0],
+            "expenses": self.ax.plot([], [], label='Expenses', marker='o', markersize=3, animated=True)[0],
+            "net_worth": self.net_worth_ax.plot([], [], label='Net Worth', color='tab:green', animated=True)[0],
+        }
+        self.ax.legend(loc='upper left')
+        self.ax.callbacks.connect('xlim_changed', lambda ax: self.update_lines())
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def set_data(self, data):
+        """Shows new ChartData; keeps the current view unless this is the first data."""
+        first = self.data is None or self.data.is_empty()
+        self.data = data
+        self.ax.set_ylabel(f'Amount ({data.currency})')
+        self.net_worth_ax.set_ylabel(f'Amount ({data.currency})')
+        if data.is_empty():
+            for line in self.lines.values():
+                line.set_data([], [])
+            self.canvas.draw_idle()
+            return
+        if first:
+            start, end = data.x_range()
+            self._updating = True
+            self.ax.set_xlim(start - 1, end + 1)
+            self._updating = False
+        self.update_lines()
+
+    def set_resolution(self, resolution):
+        self.resolution = resolution
+        self.update_lines()
+
+    def pick_resolution(self, start, end):
+        if self.resolution is not None:
+            return self.resolution
+        width = max(int(self.ax.bbox.width), 1)
+        for resolution in RESOLUTIONS:
+            # The net worth has a point every day, so only the income and expenses pick the resolution
+            visible = max(np.searchsorted(x, end) - np.searchsorted(x, start)
+                          for name, (x, _) in self.data.series[resolution].items() if name != "net_worth")
+            if visible <= width * self.MAX_POINTS_PER_PIXEL:
+                return resolution
+        return RESOLUTIONS[-1]
+
+    def update_lines(self):
+        if self.data is None or self.data.is_empty() or self._updating:
+            return
+        start, end = self.ax.get_xlim()
+        resolution = self.pick_resolution(start, end)
+        width = max(int(self.ax.bbox.width), 3)
+        y_max = 0
+        net_worth_range = None
+        for name, (x, y) in self.data.series[resolution].items():
+            # One point either side of the view, so the line runs to the edge
+            lo = max(np.searchsorted(x, start) - 1, 0)
+            hi = min(np.searchsorted(x, end) + 1, len(x))
+            visible_x, visible_y = lttb(x[lo:hi], y[lo:hi], width)
+            self.lines[name].set_data(visible_x, visible_y)
+            if not len(visible_y):
+                continue
+            if name == "net_worth":
+                net_worth_range = (min(visible_y.min(), 0), max(visible_y.max(), 0))
+            else:
+                y_max = max(y_max, visible_y.max())
+
+        y_limits = (0, y_max * 1.05 or 1)
+        # The net worth axes starts at zero unless the net worth is negative
+        low, high = net_worth_range or (0, 0)
+        net_worth_limits = (low * 1.05, high * 1.05) if low != high else (0, 1)
+        if resolution == self.current_resolution and self.background is not None \
+                and self.background_limits == ((start, end), y_limits, net_worth_limits):
+            self.blit()
+            return
+        # The axes, ticks or title change, so the whole figure has to be drawn
+        self.current_resolution = resolution
+        self.ax.set_title('Daily Income and Expenses' if resolution == "day"
+                          else f'{resolution.capitalize()}ly Income and Expenses')
+        self._updating = True
+        self.ax.set_ylim(*y_limits)
+        self.net_worth_ax.set_ylim(*net_worth_limits)
+        self._updating = False
+        self.canvas.draw_idle()
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.background_limits = (tuple(self.ax.get_xlim()), tuple(self.ax.get_ylim()),
+                                  tuple(self.net_worth_ax.get_ylim()))
+        self.draw_lines()
+
+    def draw_lines(self):
+        for line in self.lines.values():
+            line.axes.draw_artist(line)
+
+    def blit(self):
+        """Redraws only the lines over the cached background."""
+        self.canvas.restore_region(self.background)
+        self.draw_lines()
+        self.canvas.blit(self.figure.bbox)
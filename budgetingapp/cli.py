@@ -0,0 +1,529 @@
+"""
+Headless command line interface for batch jobs, without loading Qt.
+
+    python cli.py sync
+    python cli.py summary --month 2024-05 --format json
+    python cli.py export ledger.parquet
+    python cli.py import statement.ofx --dry-run
+    python cli.py serve --port 8080
+    python cli.py backup
+    python cli.py restore backups/budgeting-20240501-120000.db.gz
+    python cli.py load-rates eurofxref-hist.zip
+    python cli.py trade VWRL.L 10 95.40 --date 2024-05-01
+    python cli.py update-prices
+    python cli.py portfolio --currency USD
+    python cli.py category Groceries --limit 400
+    python cli.py rule Groceries tesco
+    python cli.py budget --month 2024-05
+
+--db (or BUDGETING_DB) selects the database and --user (or BUDGETING_USER) the
+user whose ledger is used. Errors are printed to stderr with exit status 1.
+"""
+import argparse
+import csv
+import datetime
+import getpass
+import ipaddress
+import json
+import os
+import sqlite3
+import sys
+
+from backup import DEFAULT_KEEP
+from database import (DEFAULT_CURRENCY, DEFAULT_DB_PATH, MINOR_UNITS, create_connection, format_amount,
+                      format_money, initialize_database, parse_currency, to_minor_units)
+from users import DEFAULT_USERNAME, add_default_user, find_user, has_default_password, set_password
+
+SUMMARY_HEADERS = ("month", "income", "expenses", "net", "currency")
+
+
+class CommandError(Exception):
+    """Raised by the commands for errors that are reported without a traceback."""
+
+
+def parse_month(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid month '{value}', expected YYYY-MM")
+
+
+def parse_limit(value):
+    """A monthly limit such as '400' in minor units, or None for 'none'."""
+    if value.strip().lower() == "none":
+        return None
+    try:
+        return to_minor_units(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid limit '{value}', expected an amount or 'none'")
+
+
+def parse_currency_code(value):
+    try:
+        return parse_currency(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid currency '{value}', expected a code such as GBP")
+
+
+def parse_day(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{value}', expected YYYY-MM-DD")
+
+
+def command_sync(conn, user_id, args):
+    from database import sync_recurring_transactions_to_main
+
+    added = sync_recurring_transactions_to_main(conn, user_id, args.date)
+    print(f"Added {added} recurring transactions.")
+
+
+def command_summary(conn, user_id, args):
+    from ledger import fetch_monthly_summary
+
+    rows = [(month, income, expenses, income - expenses)
+            for month, income, expenses in fetch_monthly_summary(conn, user_id, args.month, args.currency)]
+    # The totals are minor units of args.currency, shown in major units
+    if args.format == "json":
+        json.dump([dict(zip(SUMMARY_HEADERS, (row[0],) + tuple(amount / MINOR_UNITS for amount in row[1:])
+                            + (args.currency,)))
+                   for row in rows], sys.stdout, indent=2)
+        print()
+    elif args.format == "csv":
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        writer.writerow(SUMMARY_HEADERS)
+        writer.writerows((row[0],) + tuple(format_amount(amount) for amount in row[1:]) + (args.currency,)
+                         for row in rows)
+    else:
+        print(f"{'Month':<8} {'Income ' + args.currency:>14} {'Expenses ' + args.currency:>14} "
+              f"{'Net ' + args.currency:>14}")
+        for month, income, expenses, net in rows:
+            print(f"{month:<8} {format_amount(income):>14} {format_amount(expenses):>14} {format_amount(net):>14}")
+        if len(rows) != 1:
+            income, expenses = sum(row[1] for row in rows), sum(row[2] for row in rows)
+            print(f"{'Total':<8} {format_amount(income):>14} {format_amount(expenses):>14} "
+                  f"{format_amount(income - expenses):>14}")
+
+
+def command_export(conn, user_id, args):
+    from export import export_data
+
+    export_data(conn, user_id, args.file, args.format, currency=args.currency)
+    print(f"Exported to {args.file}.")
+
+
+def command_import(conn, user_id, args):
+    from importer import import_transactions
+
+    if not os.path.exists(args.file):
+        raise CommandError(f"No such file: {args.file}")
+    result = import_transactions(conn, user_id, args.file, args.format, args.dry_run, args.date_format,
+                                 currency=args.currency)
+    for line, message in result.errors:
+        print(f"Line {line}: {message}", file=sys.stderr)
+    verb = "Would import" if result.dry_run else "Imported"
+    print(f"{verb} {result.income} income and {result.expenses} expense transactions, "
+          f"skipped {result.skipped} invalid rows.")
+
+
+def command_load_rates(conn, user_id, args):
+    from fx import load_rates
+
+    if not os.path.exists(args.file):
+        raise CommandError(f"No such file: {args.file}")
+    print(f"Loaded {load_rates(conn, args.file)} exchange rates.")
+
+
+def command_refresh_rates(conn, user_id, args):
+    import urllib.error
+    from fx import ECB_HISTORY_URL, refresh_rates
+
+    url = args.url or ECB_HISTORY_URL
+    try:
+        count = refresh_rates(conn, url=url)
+    except urllib.error.URLError as e:
+        raise CommandError(f"Could not download the rates: {e.reason}")
+    print(f"Loaded {count} exchange rates from {url}.")
+
+
+def command_trade(conn, user_id, args):
+    from investments import add_trade
+
+    trade_id = add_trade(conn, user_id, args.date or datetime.date.today(), args.ticker, args.quantity,
+                         to_minor_units(args.price), args.currency)
+    print(f"Recorded trade {trade_id}.")
+
+
+def command_trades(conn, user_id, args):
+    from investments import delete_trades, fetch_trades
+
+    if args.delete:
+        delete_trades(conn, user_id, args.delete)
+        print(f"Deleted {len(args.delete)} trades.")
+        return
+    print(f"{'ID':>6} {'Date':<10} {'Ticker':<12} {'Quantity':>12} {'Price':>14}")
+    for id, date, ticker, quantity, price, currency in fetch_trades(conn, user_id):
+        print(f"{id:>6} {date:<10} {ticker:<12} {quantity:>12g} {format_money(price, currency):>14}")
+
+
+def command_update_prices(conn, user_id, args):
+    from investments import CsvPriceProvider, YahooPriceProvider, update_prices
+
+    if args.from_dir:
+        provider = CsvPriceProvider(args.from_dir, args.currency)
+    else:
+        try:
+            import yfinance  # noqa: F401
+        except ImportError:
+            raise CommandError("Downloading prices needs yfinance; use --from-dir to read saved price files")
+        provider = YahooPriceProvider()
+    result = update_prices(conn, user_id, provider)
+    for ticker, message in result.errors:
+        print(f"{ticker}: {message}", file=sys.stderr)
+    print(f"Added {result.prices} prices of {result.tickers} tickers.")
+
+
+def command_portfolio(conn, user_id, args):
+    from investments import value_portfolio
+
+    valuation = value_portfolio(conn, user_id, args.date)
+    if valuation is None:
+        print("No trades.")
+        return
+    day = valuation.day(args.date)
+    if day is None:
+        print(f"No trades before {valuation.dates[0]}.")
+        return
+    print(f"{'Ticker':<12} {'Quantity':>12} {'Price':>14} {'Value':>16}")
+    for ticker, quantity, price, currency, value in valuation.holdings(args.date):
+        print(f"{ticker:<12} {quantity:>12g} {price:>14.4f} {format_money(value, currency, ','):>16}")
+    market_value = valuation.market_values(conn, args.currency)[day]
+    invested = valuation.invested(conn, args.currency)[day]
+    print(f"Market value {format_money(market_value, args.currency, ',')}, "
+          f"invested {format_money(invested, args.currency, ',')}, "
+          f"gain {format_money(market_value - invested, args.currency, ',')}")
+
+
+def command_category(conn, user_id, args):
+    from categories import add_category, find_category, set_limit
+
+    id = find_category(conn, user_id, args.name)
+    limit = getattr(args, "limit", None)
+    if id is None:
+        add_category(conn, user_id, args.name, limit, args.currency or DEFAULT_CURRENCY)
+        print(f"Added category {args.name}.")
+        return
+    if not hasattr(args, "limit"):
+        # Only the currency changes
+        limit = conn.execute("SELECT monthly_limit FROM categories WHERE id = ?", (id,)).fetchone()[0]
+    set_limit(conn, user_id, id, limit, args.currency)
+    print(f"Changed the limit of {args.name}.")
+
+
+def command_categories(conn, user_id, args):
+    from categories import category_id, delete_category, fetch_categories
+
+    if args.delete:
+        for name in args.delete:
+            delete_category(conn, user_id, category_id(conn, user_id, name))
+        print(f"Deleted {len(args.delete)} categories.")
+        return
+    print(f"{'Category':<24} {'Limit':>14}")
+    for _, name, limit, currency in fetch_categories(conn, user_id):
+        print(f"{name:<24} {'' if limit is None else format_money(limit, currency, ','):>14}")
+
+
+def command_rule(conn, user_id, args):
+    from categories import add_rule, category_id
+
+    rule_id = add_rule(conn, user_id, category_id(conn, user_id, args.category), " ".join(args.keywords))
+    print(f"Added rule {rule_id}; run categorize to apply it to existing transactions.")
+
+
+def command_rules(conn, user_id, args):
+    from categories import delete_rule, fetch_rules
+
+    if args.delete:
+        for id in args.delete:
+            delete_rule(conn, user_id, id)
+        print(f"Deleted {len(args.delete)} rules.")
+        return
+    print(f"{'ID':>6} {'Category':<24} Keywords")
+    for id, name, keywords in fetch_rules(conn, user_id):
+        print(f"{id:>6} {name:<24} {keywords}")
+
+
+def command_categorize(conn, user_id, args):
+    from categories import apply_rules
+
+    changed = apply_rules(conn, user_id, recategorize=args.all)
+    print(f"Categorised {changed} transactions.")
+
+
+def command_budget(conn, user_id, args):
+    from categories import fetch_budget
+
+    month = args.month or datetime.date.today().strftime("%Y-%m")
+    rows = fetch_budget(conn, user_id, month)
+    if args.format == "json":
+        print(json.dumps([{"category": name, "limit": None if limit is None else format_amount(limit),
+                           "spent": format_amount(spent), "remaining": None if remaining is None
+                           else format_amount(remaining), "currency": currency}
+                          for _, name, limit, currency, spent, remaining in rows], indent=2))
+        return
+    print(f"{'Category':<24} {'Spent':>14} {'Limit':>14} {'Remaining':>14}")
+    for _, name, limit, currency, spent, remaining in rows:
+        print(f"{name:<24} {format_money(spent, currency, ','):>14} "
+              f"{'' if limit is None else format_money(limit, currency, ','):>14} "
+              f"{'' if remaining is None else format_money(remaining, currency, ','):>14}")
+
+
+def command_rebuild_search(conn, user_id, args):
+    from database import rebuild_search_index
+
+    rebuild_search_index(conn)
+    print("Rebuilt the search index.")
+
+
+def is_loopback(host):
+    """Whether host only accepts connections from this machine."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False  # a host name, or "" for every interface
+
+
+def command_password(conn, user_id, args):
+    password = getpass.getpass(f"New password for {args.username}: ")
+    if not password:
+        raise CommandError("The password cannot be empty")
+    if getpass.getpass("Repeat it: ") != password:
+        raise CommandError("The passwords do not match")
+    if not set_password(conn, args.username, password):
+        raise CommandError(f"No such user: {args.username}")
+    print(f"Changed the password of {args.username}.")
+
+
+def command_serve(conn, user_id, args):
+    import asyncio
+    import logging
+    from database import database_path
+    from server import LedgerServer
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    db_path = database_path(conn)
+    if not db_path:
+        raise CommandError("The server needs a database file")
+    if not is_loopback(args.host) and has_default_password(conn):
+        raise CommandError(f"Refusing to serve on {args.host} while user {DEFAULT_USERNAME} has the default "
+                           f"password; change it with 'cli.py password {DEFAULT_USERNAME}' first")
+    server = LedgerServer(db_path, args.host, args.port, args.readers)
+
+    def started(address):
+        print(f"Serving {db_path} on http://{address[0]}:{address[1]}/api/", flush=True)
+
+    try:
+        asyncio.run(server.serve_forever(started))
+    except KeyboardInterrupt:
+        pass
+
+
+def command_backup(conn, user_id, args):
+    from backup import backup_database
+    from database import database_path
+
+    db_path = database_path(conn)
+    if not db_path:
+        raise CommandError("Only a database file can be backed up")
+    path = backup_database(db_path, args.dir, args.keep)
+    print(f"Backed up to {path} ({os.path.getsize(path) / 1e6:.1f} MB).")
+
+
+def command_backups(conn, user_id, args):
+    from backup import list_backups
+
+    for path in list_backups(args.db, args.dir):
+        modified = datetime.datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{modified}  {os.path.getsize(path) / 1e6:8.1f} MB  {path}")
+
+
+def command_restore(conn, user_id, args):
+    from backup import BackupError, restore_backup
+
+    try:
+        previous = restore_backup(args.file, args.db, args.dir)
+    except BackupError as e:
+        raise CommandError(str(e))
+    if previous:
+        print(f"Saved the replaced database to {previous}.")
+    print(f"Restored {args.db} from {args.file}.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Budgeting App batch commands.")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="database file (default: %(default)s)")
+    parser.add_argument("--user", default=os.environ.get("BUDGETING_USER", DEFAULT_USERNAME),
+                        help="user whose ledger is used (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND", required=True)
+
+    sync = commands.add_parser("sync", help="post the recurring transactions that are due")
+    sync.add_argument("--date", type=parse_day, help="post what is due up to this YYYY-MM-DD (default: today)")
+    sync.set_defaults(run=command_sync)
+
+    summary = commands.add_parser("summary", help="print monthly income, expenses and net balance")
+    summary.add_argument("--month", type=parse_month, help="only this YYYY-MM")
+    summary.add_argument("--format", choices=("text", "json", "csv"), default="text")
+    summary.add_argument("--currency", type=parse_currency_code, default=DEFAULT_CURRENCY,
+                         help="currency to convert the totals to (default: %(default)s)")
+    summary.set_defaults(run=command_summary)
+
+    export = commands.add_parser("export", help="write the ledger to a CSV, Parquet or Feather file")
+    export.add_argument("file")
+    export.add_argument("--format", choices=("csv", "parquet", "feather"),
+                        help="default: guessed from the file extension")
+    export.add_argument("--currency", type=parse_currency_code, default=DEFAULT_CURRENCY,
+                        help="currency of the Reporting Amount column (default: %(default)s)")
+    export.set_defaults(run=command_export)
+
+    import_ = commands.add_parser("import", help="import a CSV, OFX/QFX or QIF statement")
+    import_.add_argument("file")
+    import_.add_argument("--format", choices=("csv", "ofx", "qif"),
+                         help="default: guessed from the file extension")
+    import_.add_argument("--dry-run", action="store_true", help="validate the file without writing anything")
+    import_.add_argument("--date-format", help="strptime format of the dates in the file, e.g. %%d/%%m/%%Y")
+    import_.add_argument("--currency", type=parse_currency_code, default=DEFAULT_CURRENCY,
+                         help="currency of rows the file gives none for (default: %(default)s)")
+    import_.set_defaults(run=command_import)
+
+    load_rates = commands.add_parser("load-rates", help="load exchange rates from an ECB-style CSV or zip, see fx.py")
+    load_rates.add_argument("file")
+    load_rates.set_defaults(run=command_load_rates, needs_user=False)
+
+    refresh_rates = commands.add_parser("refresh-rates", help="download the ECB reference rates")
+    # fx.py loads numpy, so it is only imported by the rate commands and the default URL is its ECB_HISTORY_URL
+    refresh_rates.add_argument("--url", help="where to get them instead, e.g. a file:// URL when offline")
+    refresh_rates.set_defaults(run=command_refresh_rates, needs_user=False)
+
+    trade = commands.add_parser("trade", help="record a purchase (or, with a negative quantity, a sale) of shares")
+    trade.add_argument("ticker", help="ticker as Yahoo Finance writes it, e.g. VWRL.L")
+    trade.add_argument("quantity", type=float)
+    trade.add_argument("price", help="price per share, e.g. 95.40")
+    trade.add_argument("--date", type=parse_day, help="YYYY-MM-DD (default: today)")
+    trade.add_argument("--currency", type=parse_currency_code, default=DEFAULT_CURRENCY,
+                       help="currency of the price (default: %(default)s)")
+    trade.set_defaults(run=command_trade)
+
+    trades = commands.add_parser("trades", help="list the trades, or delete some")
+    trades.add_argument("--delete", type=int, nargs="+", metavar="ID", help="delete the trades with these ids")
+    trades.set_defaults(run=command_trades)
+
+    update_prices = commands.add_parser("update-prices",
+                                        help="fetch the missing daily prices of the traded tickers, see investments.py")
+    update_prices.add_argument("--from-dir",
+                               help="read <TICKER>.csv files from this directory instead of Yahoo Finance")
+    update_prices.add_argument("--currency", type=parse_currency_code, default=DEFAULT_CURRENCY,
+                               help="currency of price files without a Currency column (default: %(default)s)")
+    update_prices.set_defaults(run=command_update_prices)
+
+    portfolio = commands.add_parser("portfolio", help="print the holdings and their market value")
+    portfolio.add_argument("--date", type=parse_day, help="value them as of this YYYY-MM-DD (default: today)")
+    portfolio.add_argument("--currency", type=parse_currency_code, default=DEFAULT_CURRENCY,
+                           help="currency of the totals (default: %(default)s)")
+    portfolio.set_defaults(run=command_portfolio)
+
+    category = commands.add_parser("category", help="add a budget category, or change the limit of one")
+    category.add_argument("name")
+    category.add_argument("--limit", type=parse_limit, default=argparse.SUPPRESS,
+                          help="monthly limit, e.g. 400, or 'none' for no limit")
+    category.add_argument("--currency", type=parse_currency_code,
+                          help=f"currency of the limit (default: {DEFAULT_CURRENCY} for a new category)")
+    category.set_defaults(run=command_category)
+
+    categories = commands.add_parser("categories", help="list the budget categories, or delete some")
+    categories.add_argument("--delete", nargs="+", metavar="NAME",
+                            help="delete these categories; their transactions become uncategorised")
+    categories.set_defaults(run=command_categories)
+
+    rule = commands.add_parser("rule", help="put transactions whose name has these words into a category")
+    rule.add_argument("category")
+    rule.add_argument("keywords", nargs="+", help="words to match, e.g. council tax")
+    rule.set_defaults(run=command_rule)
+
+    rules = commands.add_parser("rules", help="list the category rules, or delete some")
+    rules.add_argument("--delete", type=int, nargs="+", metavar="ID", help="delete the rules with these ids")
+    rules.set_defaults(run=command_rules)
+
+    categorize = commands.add_parser("categorize", help="categorise the uncategorised transactions by the rules")
+    categorize.add_argument("--all", action="store_true", help="recategorise every transaction a rule matches")
+    categorize.set_defaults(run=command_categorize)
+
+    budget = commands.add_parser("budget", help="print what was spent in every category against its limit")
+    budget.add_argument("--month", type=parse_month, help="YYYY-MM (default: this month)")
+    budget.add_argument("--format", choices=("text", "json"), default="text")
+    budget.set_defaults(run=command_budget)
+
+    rebuild_search = commands.add_parser("rebuild-search", help="rebuild the full-text search index")
+    rebuild_search.set_defaults(run=command_rebuild_search)
+
+    password = commands.add_parser("password", help="change the password of a user")
+    password.add_argument("username")
+    password.set_defaults(run=command_password, needs_user=False)
+
+    serve = commands.add_parser("serve", help="serve the ledger as an HTTP JSON API, see server.py")
+    serve.add_argument("--host", default="127.0.0.1",
+                       help="address to listen on (default: %(default)s); other addresses need the "
+                            f"{DEFAULT_USERNAME} password changed")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--readers", type=int, default=8, help="read connections (default: %(default)s)")
+    # Clients log in per request, so --user is not needed
+    serve.set_defaults(run=command_serve, needs_user=False)
+
+    backup = commands.add_parser("backup", help="write a compressed snapshot of the database, see backup.py")
+    backup.add_argument("--dir",
+                        help="snapshot directory (default: BUDGETING_BACKUP_DIR or backups/ beside the database)")
+    backup.add_argument("--keep", type=int, default=DEFAULT_KEEP, help="snapshots to keep (default: %(default)s)")
+    backup.set_defaults(run=command_backup, needs_user=False)
+
+    backups = commands.add_parser("backups", help="list the snapshots of the database, newest first")
+    backups.add_argument("--dir", help="snapshot directory")
+    backups.set_defaults(run=command_backups, needs_user=False, needs_database=False)
+
+    restore = commands.add_parser("restore", help="check a snapshot and replace the database with it")
+    restore.add_argument("file")
+    restore.add_argument("--dir", help="where the snapshot of the replaced database goes")
+    # The database may be damaged, so it is not opened first
+    restore.set_defaults(run=command_restore, needs_user=False, needs_database=False)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        if not getattr(args, "needs_database", True):
+            args.run(None, None, args)
+            return 0
+        conn = create_connection(args.db)
+        if conn is None:
+            raise CommandError(f"Could not open {args.db}")
+        try:
+            if initialize_database(conn):
+                add_default_user(conn)
+            user_id = None
+            if getattr(args, "needs_user", True):
+                user_id = find_user(conn, args.user)
+                if user_id is None:
+                    raise CommandError(f"No such user: {args.user}")
+            args.run(conn, user_id, args)
+        finally:
+            conn.close()
+    except (CommandError, ValueError, OSError, sqlite3.Error) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
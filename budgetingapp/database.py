@@ -1,43 +1,620 @@
+import os
+import re
 import sqlite3
+import threading
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import datetime
 
+from changes import RECURRING, change_bus
+from instrumentation import InstrumentedConnection
 
-def create_connection(db_file):
-    """Create a database connection to the SQLite database specified by db_file"""
+# The database lives in the project root unless BUDGETING_DB points elsewhere,
+# so it no longer depends on the directory the app is started from.
+DEFAULT_DB_PATH = os.environ.get(
+    "BUDGETING_DB", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "budgeting.db"))
+
+# Applied to every connection. WAL lets readers run while a write is in
+# progress, and synchronous=NORMAL only fsyncs at checkpoints in WAL mode.
+CONNECTION_PRAGMAS = (
+    ("synchronous", "NORMAL"),
+    ("cache_size", -32000),        # KiB, i.e. 32 MB of page cache per connection
+    ("mmap_size", 268435456),      # 256 MB
+    ("temp_store", "MEMORY"),
+)
+STATEMENT_CACHE_SIZE = 256
+BUSY_TIMEOUT_SECONDS = 10
+
+# Upper bound for how long the recurring sync sleeps, so clock changes and
+# suspend/resume are picked up within a reasonable time.
+MAX_SYNC_DELAY_MS = 60 * 60 * 1000
+
+# All dates are stored as ISO 8601 so that they sort and index correctly.
+# Older versions wrote DD-MM-YYYY, which migrate_database() rewrites.
+DATE_FORMAT = "%Y-%m-%d"
+LEGACY_DATE_FORMAT = "%d-%m-%Y"
+LEGACY_DATE_GLOB = "[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]"
+
+# Bumped whenever the schema or migrate_database() changes, so initialize_database() reruns them
+SCHEMA_VERSION = 8
+MIGRATION_BATCH_SIZE = 5000
+
+# Amounts are stored as integers in minor units (pence), CURRENCY_EXPONENT
+# decimal places of the major unit, so sums are exact; they are only turned
+# into decimals for display, see format_amount()
+CURRENCY_EXPONENT = 2
+MINOR_UNITS = 10 ** CURRENCY_EXPONENT
+# The range of an SQLite INTEGER
+MAX_MINOR_UNITS = 2 ** 63 - 1
+
+# Every amount has a currency, an ISO 4217 code. Rows of versions before
+# currencies were pounds; new amounts and reports default to BUDGETING_CURRENCY.
+# All currencies are kept with CURRENCY_EXPONENT decimal places.
+LEGACY_CURRENCY = "GBP"
+DEFAULT_CURRENCY = os.environ.get("BUDGETING_CURRENCY", LEGACY_CURRENCY).upper()
+CURRENCY_SYMBOLS = {"GBP": "£", "EUR": "€", "USD": "$", "JPY": "¥"}
+
+# The values of transactions.type, which older versions kept in tables of these names
+TRANSACTION_TYPES = ("income", "expenses")
+
+# Ledger columns indexed for full-text search in the transactions_fts table
+SEARCH_COLUMNS = ("name",)
+
+
+def format_date(date):
+    """Returns the storage representation of a datetime.date."""
+    return date.strftime(DATE_FORMAT)
+
+
+def parse_date(date_str):
+    """Parses a stored date, accepting the legacy DD-MM-YYYY format as well."""
+    try:
+        return datetime.datetime.strptime(date_str, DATE_FORMAT).date()
+    except ValueError:
+        return datetime.datetime.strptime(date_str, LEGACY_DATE_FORMAT).date()
+
+
+def to_minor_units(amount):
+    """
+    Converts an amount in major units (a str, int, float or Decimal, e.g. '12.34')
+    to integer minor units, rounding half away from zero.
+
+    Raises:
+        ValueError: If amount is not a finite number or does not fit an SQLite INTEGER.
+    """
+    try:
+        minor = int(Decimal(str(amount).strip()).scaleb(CURRENCY_EXPONENT).to_integral_value(ROUND_HALF_UP))
+    except (InvalidOperation, OverflowError, ValueError):  # ValueError for NaN
+        raise ValueError(f"Invalid amount '{amount}'") from None
+    if abs(minor) > MAX_MINOR_UNITS:
+        raise ValueError(f"Amount '{amount}' is too large")
+    return minor
+
+
+def format_amount(minor, separator=""):
+    """Formats integer minor units as a decimal, e.g. -123456 as '-1234.56' (or '-1,234.56' with separator=',')."""
+    units, fraction = divmod(abs(int(minor)), MINOR_UNITS)
+    text = f"{'-' if minor < 0 else ''}{format(units, separator + 'd')}"
+    return f"{text}.{fraction:0{CURRENCY_EXPONENT}d}" if CURRENCY_EXPONENT else text
+
+
+def parse_currency(code):
+    """
+    Normalises a currency code such as 'usd' to 'USD'.
+
+    Raises:
+        ValueError: If code is not three letters.
+    """
+    currency = str(code).strip().upper()
+    if not re.fullmatch(r"[A-Z]{3}", currency):
+        raise ValueError(f"Invalid currency '{code}'")
+    return currency
+
+
+def format_money(minor, currency=DEFAULT_CURRENCY, separator=""):
+    """Formats integer minor units with their currency, e.g. '-£1234.56', or '12.00 CHF' without a known symbol."""
+    amount = format_amount(abs(int(minor)), separator)
+    symbol = CURRENCY_SYMBOLS.get(currency)
+    text = f"{symbol}{amount}" if symbol else f"{amount} {currency}"
+    return f"-{text}" if minor < 0 else text
+
+
+def create_connection(db_file=DEFAULT_DB_PATH, **kwargs):
+    """
+    Create a database connection to the SQLite database specified by db_file,
+    in WAL mode and with the CONNECTION_PRAGMAS applied. Its queries are timed
+    and counted in instrumentation.query_stats.
+    Extra keyword arguments are passed on to sqlite3.connect.
+    """
     conn = None
+    kwargs.setdefault("factory", InstrumentedConnection)
+    kwargs.setdefault("timeout", BUSY_TIMEOUT_SECONDS)
+    kwargs.setdefault("cached_statements", STATEMENT_CACHE_SIZE)
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, **kwargs)
+        if db_file != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL")
+        for name, value in CONNECTION_PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
     except sqlite3.Error as e:
         print(e)
     return conn
 
+
+class ConnectionManager:
+    """
+    Hands out one connection per thread to the same database file, e.g. for
+    background readers, and closes them all at shutdown.
+    """
+
+    def __init__(self, db_file=DEFAULT_DB_PATH):
+        self.db_file = db_file
+        self.connections = {}
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """Returns the calling thread's connection, opening it on first use."""
+        thread_id = threading.get_ident()
+        with self._lock:
+            conn = self.connections.get(thread_id)
+            if conn is None:
+                # Only used by this thread, but close_all() may run on another one
+                conn = create_connection(self.db_file, check_same_thread=False)
+                self.connections[thread_id] = conn
+            return conn
+
+    def close_all(self):
+        with self._lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections.clear()
+
+def database_path(conn):
+    """Returns the file behind conn, so other threads can open their own connection."""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA database_list")
+    for _, name, file in cursor.fetchall():
+        if name == 'main':
+            return file
+    return ''
+
 def setup_database(conn):
-    """Create tables for income and expenses in the database"""
+    """
+    Creates the transactions table holding the income and expenses of every
+    user, told apart by type, and the income and expenses views over it for
+    readers of the former tables of those names. A user's rows are read through
+    the covering (user_id, date, type, amount, currency) index by date ranges and
+    totals, and through (user_id, type, date) in the (date, id) order of the data view.
+    """
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS income (
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS transactions (
                 id INTEGER PRIMARY KEY,
+                user_id INTEGER REFERENCES users (id),
+                type TEXT NOT NULL CHECK (type IN ('income', 'expenses')),
                 date TEXT NOT NULL,
                 name TEXT NOT NULL,
-                amount REAL NOT NULL
+                amount INTEGER NOT NULL,  -- minor units
+                currency TEXT NOT NULL DEFAULT '{LEGACY_CURRENCY}'
             )
         """)
+        add_currency_column(conn, 'transactions')
+        if needs_amount_migration(conn, 'transactions'):
+            # Views would stop the rebuilt table from being renamed; they are recreated below
+            for type in TRANSACTION_TYPES:
+                cursor.execute(f"DROP VIEW IF EXISTS {type}")
+            migrate_amounts(conn, 'transactions')
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY,
-                date TEXT NOT NULL,
-                name TEXT NOT NULL,
-                amount REAL NOT NULL
-            )
+            CREATE INDEX IF NOT EXISTS idx_transactions_user_type_date ON transactions (user_id, type, date)
         """)
+        cursor.execute("SELECT name FROM pragma_index_info('idx_transactions_user_date')")
+        if 'currency' not in {row[0] for row in cursor.fetchall()}:
+            # The index of versions before currencies no longer covers the totals
+            cursor.execute("DROP INDEX IF EXISTS idx_transactions_user_date")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_transactions_user_date
+            ON transactions (user_id, date, type, amount, currency)
+        """)
+        migrate_ledger_tables(conn)
+        for type in TRANSACTION_TYPES:
+            cursor.execute(f"""
+                CREATE VIEW IF NOT EXISTS {type} AS
+                SELECT id, date, name, amount, user_id FROM transactions WHERE type = '{type}'
+            """)
+        setup_monthly_totals(conn)
+        setup_search_index(conn)
+        setup_fx_rates_table(conn)
+        setup_trades_table(conn)
+        setup_categories_tables(conn)
         conn.commit()
     except sqlite3.Error as e:
         print(e)
 
 
+def migrate_ledger_tables(conn):
+    """
+    Moves the rows of the separate income and expenses tables of older versions
+    into transactions, then drops those tables (with their indexes and triggers)
+    and their search indexes to make way for the views.
+    """
+    cursor = conn.cursor()
+    for type in TRANSACTION_TYPES:
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (type,))
+        if cursor.fetchone()[0] == 0:
+            continue
+        add_user_column(conn, type)
+        cursor.execute(f"""
+            INSERT INTO transactions (user_id, type, date, name, amount)
+            SELECT user_id, '{type}', date, name, CAST(ROUND(amount * {MINOR_UNITS}) AS INTEGER) FROM {type}
+            ORDER BY id
+        """)
+        cursor.execute(f"DROP TABLE {type}")
+        cursor.execute(f"DROP TABLE IF EXISTS {type}_fts")
+
+
+def needs_amount_migration(conn, table):
+    """Whether table still has the REAL amounts in major units of versions before minor units."""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT type FROM pragma_table_info('{table}') WHERE name = 'amount'")
+    row = cursor.fetchone()
+    return row is not None and row[0].upper() == 'REAL'
+
+
+def migrate_amounts(conn, table):
+    """
+    Converts the REAL amounts of table to integer minor units. SQLite can't change
+    a column's type, so the table is rebuilt from its own CREATE statement with
+    amount INTEGER, keeping the ids; its indexes and triggers go with the old
+    table and are recreated by the setup functions.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    create = cursor.fetchone()[0]
+    create = re.sub(rf"^CREATE TABLE {table}\b", f"CREATE TABLE {table}_new", create)
+    create = re.sub(r"\bamount REAL\b", "amount INTEGER", create)
+    columns = [row[0] for row in cursor.execute(f"SELECT name FROM pragma_table_info('{table}')").fetchall()]
+    values = [f"CAST(ROUND(amount * {MINOR_UNITS}) AS INTEGER)" if column == 'amount' else column
+              for column in columns]
+    cursor.execute(f"DROP TABLE IF EXISTS {table}_new")
+    cursor.execute(create)
+    cursor.execute(f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def add_user_column(conn, table):
+    """
+    Adds user_id to a table created before data was kept per user. Its rows are
+    given to the first user, who owned everything in a single-user database.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT count(*) FROM pragma_table_info('{table}') WHERE name = 'user_id'")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN user_id INTEGER REFERENCES users (id)")
+        cursor.execute(f"UPDATE {table} SET user_id = (SELECT MIN(id) FROM users)")
+
+
+def add_currency_column(conn, table):
+    """Adds currency to a table created before amounts had one; its rows were in LEGACY_CURRENCY."""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT count(*) FROM pragma_table_info('{table}') WHERE name = 'currency'")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN currency TEXT NOT NULL DEFAULT '{LEGACY_CURRENCY}'")
+
+
+def setup_monthly_totals(conn):
+    """
+    Creates the monthly_totals rollup of income and expenses per user and
+    currency, and the triggers that keep it current on every insert, update and
+    delete. The rollup is built from the ledger the first time it is created.
+    Rows without an owner are counted under user_id 0.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT name, type FROM pragma_table_info('monthly_totals')")
+    columns = dict(cursor.fetchall())
+    exists = 'user_id' in columns and 'currency' in columns and columns['total'].upper() == 'INTEGER'
+    if not exists:
+        # The rollup of a version without users, with REAL totals or without
+        # currencies: rebuild it, with triggers matching its key
+        cursor.execute("DROP TABLE IF EXISTS monthly_totals")
+        for trigger in ("insert", "delete", "update"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS transactions_monthly_totals_{trigger}")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_totals (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,  -- YYYY-MM
+            type TEXT NOT NULL,   -- 'income' or 'expenses'
+            currency TEXT NOT NULL,
+            total INTEGER NOT NULL,  -- minor units of currency
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month, type, currency)
+        )
+    """)
+    add_row = """
+        INSERT INTO monthly_totals (user_id, month, type, currency, total, count)
+        VALUES (IFNULL(NEW.user_id, 0), substr(NEW.date, 1, 7), NEW.type, NEW.currency, NEW.amount, 1)
+        ON CONFLICT (user_id, month, type, currency)
+        DO UPDATE SET total = total + excluded.total, count = count + 1;
+    """
+    remove_row = """
+        UPDATE monthly_totals SET total = total - OLD.amount, count = count - 1
+        WHERE user_id = IFNULL(OLD.user_id, 0) AND month = substr(OLD.date, 1, 7) AND type = OLD.type
+          AND currency = OLD.currency;
+        DELETE FROM monthly_totals
+        WHERE user_id = IFNULL(OLD.user_id, 0) AND month = substr(OLD.date, 1, 7) AND type = OLD.type
+          AND currency = OLD.currency AND count = 0;
+    """
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS transactions_monthly_totals_insert AFTER INSERT ON transactions
+        BEGIN {add_row} END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS transactions_monthly_totals_delete AFTER DELETE ON transactions
+        BEGIN {remove_row} END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS transactions_monthly_totals_update
+        AFTER UPDATE OF user_id, type, date, amount, currency ON transactions
+        BEGIN {remove_row} {add_row} END
+    """)
+    if not exists:
+        rebuild_monthly_totals(conn)
+
+
+def rebuild_monthly_totals(conn):
+    """Recomputes monthly_totals from the transactions."""
+    with conn:
+        conn.execute("DELETE FROM monthly_totals")
+        conn.execute("""
+            INSERT INTO monthly_totals (user_id, month, type, currency, total, count)
+            SELECT IFNULL(user_id, 0), substr(date, 1, 7), type, currency, SUM(amount), COUNT(*)
+            FROM transactions
+            GROUP BY IFNULL(user_id, 0), substr(date, 1, 7), type, currency
+        """)
+
+
+def setup_search_index(conn):
+    """
+    Creates an FTS5 index over the SEARCH_COLUMNS of the transactions and the
+    triggers that keep it in sync. The index only stores the tokens, the text is
+    read from the transactions table (external content). The index is filled
+    from the table the first time it is created.
+    """
+    cursor = conn.cursor()
+    columns = ", ".join(SEARCH_COLUMNS)
+    new_values = ", ".join(f"NEW.{column}" for column in SEARCH_COLUMNS)
+    old_values = ", ".join(f"OLD.{column}" for column in SEARCH_COLUMNS)
+    cursor.execute("SELECT count(*) FROM sqlite_master WHERE name = 'transactions_fts'")
+    exists = cursor.fetchone()[0] > 0
+    # Prefix indexes make the prefix queries of search-as-you-type fast
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+            {columns}, content='transactions', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    add_row = f"INSERT INTO transactions_fts (rowid, {columns}) VALUES (NEW.id, {new_values});"
+    remove_row = f"""
+        INSERT INTO transactions_fts (transactions_fts, rowid, {columns}) VALUES ('delete', OLD.id, {old_values});
+    """
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_insert AFTER INSERT ON transactions
+        BEGIN {add_row} END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions
+        BEGIN {remove_row} END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE OF id, {columns} ON transactions
+        BEGIN {remove_row} {add_row} END
+    """)
+    if not exists:
+        cursor.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+
+
+def setup_fx_rates_table(conn):
+    """
+    Creates the fx_rates table of exchange rates loaded by fx.load_rates(), as
+    units of the currency per euro like the ECB reference rates, and the
+    fx_rate_loads log of the files they came from.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            currency TEXT NOT NULL,
+            date TEXT NOT NULL,
+            rate REAL NOT NULL,  -- units of currency per EUR
+            PRIMARY KEY (currency, date)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fx_rate_loads (
+            id INTEGER PRIMARY KEY,
+            source TEXT NOT NULL,
+            loaded_at TEXT NOT NULL,
+            rates INTEGER NOT NULL
+        )
+    """)
+
+
+def setup_trades_table(conn):
+    """
+    Creates the trades table of the investments of every user, see
+    investments.py, read per user and ticker in date order.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS trades (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER REFERENCES users (id),
+            date TEXT NOT NULL,
+            ticker TEXT NOT NULL,
+            quantity REAL NOT NULL,  -- shares bought, negative when sold
+            price INTEGER NOT NULL,  -- minor units of currency per share
+            currency TEXT NOT NULL DEFAULT '{LEGACY_CURRENCY}'
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trades_user_ticker_date ON trades (user_id, ticker, date)")
+
+
+def setup_categories_tables(conn):
+    """
+    Creates the budget categories of every user with their monthly limits, the
+    keyword rules that categorise transactions by name (see categories.py), the
+    category_id of the transactions, and the category_totals rollup of the
+    expenses of every category per month and currency with the triggers that
+    keep it current on every insert, update and delete. The rollup is built from
+    the ledger the first time it is created.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER REFERENCES users (id),
+            name TEXT NOT NULL,
+            monthly_limit INTEGER,  -- minor units of currency, NULL without a limit
+            currency TEXT NOT NULL DEFAULT '{LEGACY_CURRENCY}',
+            UNIQUE (user_id, name)
+        )
+    """)
+    # AUTOINCREMENT, so ids are not reused and (count, max id) tells when a user's rules changed
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS category_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES users (id),
+            category_id INTEGER NOT NULL REFERENCES categories (id),
+            keywords TEXT NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_category_rules_user ON category_rules (user_id)")
+    cursor.execute("SELECT count(*) FROM pragma_table_info('transactions') WHERE name = 'category_id'")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("ALTER TABLE transactions ADD COLUMN category_id INTEGER REFERENCES categories (id)")
+    cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'category_totals'")
+    exists = cursor.fetchone()[0] > 0
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS category_totals (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,  -- YYYY-MM
+            category_id INTEGER NOT NULL,
+            currency TEXT NOT NULL,
+            total INTEGER NOT NULL,  -- minor units of currency spent
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month, category_id, currency)
+        )
+    """)
+    add_row = """
+        INSERT INTO category_totals (user_id, month, category_id, currency, total, count)
+        VALUES (IFNULL(NEW.user_id, 0), substr(NEW.date, 1, 7), NEW.category_id, NEW.currency, NEW.amount, 1)
+        ON CONFLICT (user_id, month, category_id, currency)
+        DO UPDATE SET total = total + excluded.total, count = count + 1;
+    """
+    remove_row = """
+        UPDATE category_totals SET total = total - OLD.amount, count = count - 1
+        WHERE user_id = IFNULL(OLD.user_id, 0) AND month = substr(OLD.date, 1, 7)
+          AND category_id = OLD.category_id AND currency = OLD.currency;
+        DELETE FROM category_totals
+        WHERE user_id = IFNULL(OLD.user_id, 0) AND month = substr(OLD.date, 1, 7)
+          AND category_id = OLD.category_id AND currency = OLD.currency AND count = 0;
+    """
+    # Only categorised expenses count against a budget
+    counted_new = "NEW.category_id IS NOT NULL AND NEW.type = 'expenses'"
+    counted_old = "OLD.category_id IS NOT NULL AND OLD.type = 'expenses'"
+    changed_columns = "user_id, type, date, amount, currency, category_id"
+    for name, event, condition, body in (
+            ("insert", "INSERT", counted_new, add_row),
+            ("delete", "DELETE", counted_old, remove_row),
+            # An update takes the old row out and puts the new one in, each only if it counts
+            ("update_old", f"UPDATE OF {changed_columns}", counted_old, remove_row),
+            ("update_new", f"UPDATE OF {changed_columns}", counted_new, add_row)):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS transactions_category_totals_{name} AFTER {event} ON transactions
+            WHEN {condition}
+            BEGIN {body} END
+        """)
+    if not exists:
+        rebuild_category_totals(conn)
+
+
+def rebuild_category_totals(conn):
+    """Recomputes category_totals from the transactions."""
+    with conn:
+        conn.execute("DELETE FROM category_totals")
+        conn.execute("""
+            INSERT INTO category_totals (user_id, month, category_id, currency, total, count)
+            SELECT IFNULL(user_id, 0), substr(date, 1, 7), category_id, currency, SUM(amount), COUNT(*)
+            FROM transactions
+            WHERE category_id IS NOT NULL AND type = 'expenses'
+            GROUP BY IFNULL(user_id, 0), substr(date, 1, 7), category_id, currency
+        """)
+
+
+def rebuild_search_index(conn):
+    """Rebuilds the full-text index from the transactions and merges its segments."""
+    with conn:
+        conn.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('optimize')")
+
+
+def initialize_database(conn):
+    """
+    Creates the schema and runs pending migrations, unless PRAGMA user_version
+    shows the database is already up to date, so a normal start skips the DDL.
+
+    Returns:
+        True if the schema had to be set up or migrated.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return False
+    # users first, existing rows are given to the first user when user_id is added
+    setup_user_database(conn)
+    setup_database(conn)
+    setup_recurring_transactions_table(conn)
+    migrate_database(conn)
+    return True
+
+
+def migrate_database(conn):
+    """
+    Runs the one-time data migrations the database has not seen yet.
+    Progress is recorded in PRAGMA user_version.
+    """
+    cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    try:
+        if version < 1:
+            for table, column in (('transactions', 'date'),
+                                  ('recurring_transactions', 'start_date'),
+                                  ('recurring_transactions', 'last_processed_date')):
+                migrate_legacy_dates(conn, table, column)
+        if version < SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+
+
+def migrate_legacy_dates(conn, table, column, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Rewrites DD-MM-YYYY values of table.column to YYYY-MM-DD, committing every
+    batch_size rows so the database is never locked for long.
+    """
+    cursor = conn.cursor()
+    while True:
+        cursor.execute(f"""
+            UPDATE {table}
+            SET {column} = substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' || substr({column}, 1, 2)
+            WHERE id IN (SELECT id FROM {table} WHERE {column} GLOB ? LIMIT ?)
+        """, (LEGACY_DATE_GLOB, batch_size))
+        conn.commit()
+        if cursor.rowcount < batch_size:
+            break
+
+
 def setup_user_database(conn):
     """
     Sets up the user database table if it does not exist.
@@ -66,16 +643,20 @@ def setup_user_database(conn):
 def setup_recurring_transactions_table(conn):
     try:
         cursor = conn.cursor()
-        cursor.execute("""
+        cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS recurring_transactions (
                 id INTEGER PRIMARY KEY,
                 type TEXT NOT NULL,
                 name TEXT NOT NULL,
-                amount REAL NOT NULL,
+                amount INTEGER NOT NULL,  -- minor units
                 start_date TEXT NOT NULL,
-                frequency TEXT NOT NULL  -- e.g., 'monthly', 'weekly'
+                frequency TEXT NOT NULL,  -- e.g., 'monthly', 'weekly'
+                user_id INTEGER REFERENCES users (id),
+                currency TEXT NOT NULL DEFAULT '{LEGACY_CURRENCY}'
             )
         """)
+        add_user_column(conn, 'recurring_transactions')
+        add_currency_column(conn, 'recurring_transactions')
         
         # Add 'last_processed_date' column if it does not exist
         cursor.execute("""
@@ -85,79 +666,221 @@ def setup_recurring_transactions_table(conn):
         if cursor.fetchone()[0] == 0:
             cursor.execute("ALTER TABLE recurring_transactions ADD COLUMN last_processed_date TEXT")
 
+        # Add 'next_due_date' (ISO formatted so it sorts) and index it per user for the sync
+        cursor.execute("""
+            SELECT count(*) FROM pragma_table_info('recurring_transactions') 
+            WHERE name='next_due_date'
+        """)
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("ALTER TABLE recurring_transactions ADD COLUMN next_due_date TEXT")
+        if needs_amount_migration(conn, 'recurring_transactions'):
+            migrate_amounts(conn, 'recurring_transactions')
+        cursor.execute("DROP INDEX IF EXISTS idx_recurring_next_due")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_recurring_user_next_due
+            ON recurring_transactions (user_id, next_due_date)
+        """)
+        backfill_next_due_dates(conn)
+
         conn.commit()
     except sqlite3.Error as e:
         print(f"An error occurred: {e}")
 
 
-# def sync_recurring_transactions_to_main(conn):
-#     today = datetime.date.today()
-#     cursor = conn.cursor()
-#     cursor.execute("SELECT * FROM recurring_transactions")
-#     recurring_transactions = cursor.fetchall()
-
-#     for transaction in recurring_transactions:
-#         id, type, name, amount, start_date_str, frequency = transaction
-#         start_date = datetime.datetime.strptime(start_date_str, "%d-%m-%Y").date()
-
-#         if is_due_for_addition(today, start_date, frequency):
-#             table = 'income' if type == 'income' else 'expenses'
-#             cursor.execute(f"INSERT INTO {table} (date, name, amount) VALUES (?, ?, ?)", 
-#                            (today.strftime("%d-%m-%Y"), name, amount))
-#             # Update the start_date in the recurring_transactions table to today
-#             cursor.execute("UPDATE recurring_transactions SET start_date = ? WHERE id = ?", 
-#                            (today.strftime("%d-%m-%Y"), id))
-#     conn.commit()
-def sync_recurring_transactions_to_main(conn):
-    today = datetime.date.today()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM recurring_transactions")
-    recurring_transactions = cursor.fetchall()
-
-    for transaction in recurring_transactions:
-        id, type, name, amount, start_date_str, frequency, last_processed_str = transaction
-        start_date = datetime.datetime.strptime(start_date_str, "%d-%m-%Y").date()
-        last_processed = datetime.datetime.strptime(last_processed_str, "%d-%m-%Y").date() if last_processed_str else start_date
-
-        if is_due_for_addition(today, last_processed, frequency):
-            table = 'income' if type == 'income' else 'expenses'
-            cursor.execute(f"INSERT INTO {table} (date, name, amount) VALUES (?, ?, ?)", 
-                           (today.strftime("%d-%m-%Y"), name, amount))
-            cursor.execute("UPDATE recurring_transactions SET last_processed_date = ? WHERE id = ?", 
-                           (today.strftime("%d-%m-%Y"), id))
-    conn.commit()
+def backfill_next_due_dates(conn):
+    """Computes next_due_date for rules created before the column existed."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, start_date, frequency, last_processed_date
+        FROM recurring_transactions
+        WHERE next_due_date IS NULL
+    """)
+    updates = []
+    for id, start_date_str, frequency, last_processed_str in cursor.fetchall():
+        start_date = parse_date(start_date_str)
+        last_processed = parse_date(last_processed_str) if last_processed_str else None
+        next_due = first_due_date(start_date, frequency, last_processed)
+        if next_due is not None:
+            updates.append((format_date(next_due), id))
+    cursor.executemany("UPDATE recurring_transactions SET next_due_date = ? WHERE id = ?", updates)
+
+
+def sync_recurring_transactions_to_main(conn, user_id, today=None):
+    """
+    Posts every occurrence of the user's recurring transactions that fell due since
+    they were last processed, including the ones missed while the app was closed.
+
+    Only the rules whose next_due_date has passed are read (via the
+    idx_recurring_user_next_due index) and all postings are written in one transaction.
+    Each rule is claimed in that transaction by moving its next_due_date on from
+    the date it was read with, so a sync running at the same time on another
+    connection posts every occurrence only once.
+
+    Returns:
+        The number of transactions added to the ledger.
+    """
+    today = today or datetime.date.today()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, type, name, amount, start_date, frequency, next_due_date, currency
+        FROM recurring_transactions
+        WHERE user_id = ? AND next_due_date <= ?
+    """, (user_id, format_date(today)))
+    due_transactions = cursor.fetchall()
+    if not due_transactions:
+        return 0
+
+    postings = {}  # rule id -> its postings
+    updates = []
+    for id, type, name, amount, start_date_str, frequency, next_due_str, currency in due_transactions:
+        start_date = parse_date(start_date_str)
+        due_date = parse_date(next_due_str)
+        last_processed = None
+        postings[id] = []
+        while due_date is not None and due_date <= today:
+            postings[id].append(('income' if type == 'income' else 'expenses', format_date(due_date), name, amount,
+                                 currency, user_id))
+            last_processed = due_date
+            due_date = next_occurrence(start_date, frequency, due_date)
+        updates.append((format_date(last_processed), format_date(due_date) if due_date else None, id, next_due_str))
+
+    # categories.py imports this module
+    from categories import category_matcher
+    matcher = category_matcher(conn, user_id)
+    with conn:
+        claimed = []
+        for update in updates:
+            cursor = conn.execute("""
+                UPDATE recurring_transactions SET last_processed_date = ?, next_due_date = ?
+                WHERE id = ? AND next_due_date = ?
+            """, update)
+            # Otherwise another sync posted this rule since it was read
+            if cursor.rowcount:
+                claimed.append(update[2])
+        # Read under the write lock the claims took, so only this sync's inserts follow it
+        last_id = last_transaction_id(conn)
+        rows = [posting + (matcher.match(posting[2]),) for id in claimed for posting in postings[id]]
+        conn.executemany("""
+            INSERT INTO transactions (type, date, name, amount, currency, user_id, category_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        added = transactions_added_after(conn, user_id, last_id)
+    publish_added_transactions(user_id, added)
+    change_bus.publish(RECURRING, user_id, updated=claimed)
+    return len(rows)
+
+
+def last_transaction_id(conn):
+    cursor = conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions")
+    return cursor.fetchone()[0]
+
+
+def transactions_added_after(conn, user_id, last_id):
+    """
+    Returns the (id, type) rows of the user's transactions with an id above
+    last_id, i.e. those inserted since last_transaction_id() was read. Run it
+    before committing the inserts, so rows added after the commit are not included.
+    Returns [] without querying when no one listens on change_bus.
+    """
+    if not change_bus.listening:
+        return []
+    cursor = conn.execute("SELECT id, type FROM transactions WHERE id > ? AND user_id = ?", (last_id, user_id))
+    return cursor.fetchall()
 
 
+def publish_added_transactions(user_id, added):
+    """Publishes the (id, type) rows of transactions_added_after() on change_bus, one event per type."""
+    for table in TRANSACTION_TYPES:
+        change_bus.publish(table, user_id, inserted=[id for id, type in added if type == table])
 
-# def is_due_for_addition(today, start_date, frequency):
-#     if frequency == 'monthly':
-#         # Check if a month or more has passed since the start date
-#         return (today.year > start_date.year or 
-#                 (today.year == start_date.year and today.month > start_date.month))
-#     # Implement logic for other frequencies ('weekly', 'daily', etc.)
-#     return False
-def is_due_for_addition(today, start_date, frequency):
-    if today < start_date:
-        return False  # Transaction start date is in the future
 
-    delta = today - start_date
+def next_occurrence(start_date, frequency, after):
+    """
+    Returns the first occurrence of a recurring transaction strictly after `after`,
+    or None if the frequency is unknown.
+
+    Occurrences are always counted from start_date so that monthly and yearly rules
+    starting on e.g. the 31st do not drift to the 28th after February.
+    """
+    if after < start_date:
+        return start_date
     if frequency == 'daily':
-        return True  # Every day
-    elif frequency == 'weekly' and delta.days % 7 == 0:
-        return True  # Every week
-    elif frequency == 'monthly' and start_date.day == today.day:
-        return True  # Same day of the month
-    elif frequency == 'yearly' and start_date.day == today.day and start_date.month == today.month:
-        return True  # Same day and month each year
+        return after + timedelta(days=1)
+    if frequency == 'weekly':
+        return after + timedelta(days=7 - (after - start_date).days % 7)
+    if frequency == 'monthly':
+        step = relativedelta(months=1)
+    elif frequency == 'yearly':
+        step = relativedelta(years=1)
+    else:
+        return None
 
-    return False  # Not due for addition
+    months = (after.year - start_date.year) * 12 + after.month - start_date.month
+    count = months // 12 if frequency == 'yearly' else months
+    candidate = start_date + step * count
+    while candidate <= after:
+        count += 1
+        candidate = start_date + step * count
+    return candidate
 
-def add_to_income(conn, name, amount, date):
+
+def first_due_date(start_date, frequency, last_processed=None):
+    """Returns the next date a recurring transaction has to be posted on."""
+    if last_processed is None:
+        return start_date
+    return next_occurrence(start_date, frequency, last_processed)
+
+
+def add_recurring_transaction(conn, user_id, type, name, amount, start_date, frequency,
+                              currency=DEFAULT_CURRENCY):
+    """
+    Stores a new recurring transaction of the user and returns its id; amount is in
+    minor units of currency and start_date is a datetime.date.
+    """
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO income (date, name, amount) VALUES (?, ?, ?)", (date, name, amount))
+    cursor.execute("""
+        INSERT INTO recurring_transactions
+            (type, name, amount, start_date, frequency, next_due_date, currency, user_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (type, name, amount, format_date(start_date), frequency, format_date(start_date), currency, user_id))
     conn.commit()
+    change_bus.publish(RECURRING, user_id, inserted=[cursor.lastrowid])
+    return cursor.lastrowid
 
-def add_to_expenses(conn, name, amount, date):
+
+def delete_recurring_transactions(conn, user_id):
+    """Deletes all recurring transactions of the user."""
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO expenses (date, name, amount) VALUES (?, ?, ?)", (date, name, amount))
+    cursor.execute("DELETE FROM recurring_transactions WHERE user_id = ?", (user_id,))
     conn.commit()
+    change_bus.publish(RECURRING, user_id, reset=True)
+
+
+def fetch_recurring_transactions(conn, user_id, ids=None):
+    """
+    Returns the user's (id, type, name, amount, start_date, frequency, next_due_date,
+    currency) rules, or only those with the given ids.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT id, type, name, amount, start_date, frequency, next_due_date, currency
+        FROM recurring_transactions WHERE user_id = ? {f"AND id IN ({', '.join('?' * len(ids))})" if ids is not None else ''}
+        ORDER BY id
+    """, (user_id, *(ids or ())))
+    return cursor.fetchall()
+
+
+def next_sync_delay_ms(conn, user_id, now=None, max_delay_ms=MAX_SYNC_DELAY_MS):
+    """
+    Returns how many milliseconds the recurring sync can sleep until the
+    user's earliest next_due_date, capped at max_delay_ms.
+    """
+    now = now or datetime.datetime.now()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(next_due_date) FROM recurring_transactions WHERE user_id = ?", (user_id,))
+    next_due_str = cursor.fetchone()[0]
+    if next_due_str is None:
+        return max_delay_ms
+    next_due = datetime.datetime.combine(parse_date(next_due_str), datetime.time.min)
+    delay_ms = int((next_due - now).total_seconds() * 1000)
+    return min(max(delay_ms, 0), max_delay_ms)
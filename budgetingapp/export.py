@@ -0,0 +1,148 @@
+import csv
+import os
+from decimal import Decimal
+
+from database import CURRENCY_EXPONENT, DEFAULT_CURRENCY, format_amount
+
+# Reporting Amount is the amount converted to the reporting currency of the export
+EXPORT_HEADERS = ['ID', 'Date', 'Name', 'Amount', 'Type', 'Currency', 'Reporting Amount']
+EXPORT_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.feather': 'feather'}
+EXPORT_CHUNK_SIZE = 10000
+
+
+class ExportCancelled(Exception):
+    """Raised inside the writers when the caller cancels an export."""
+
+
+def count_export_rows(conn, user_id):
+    """Returns the number of rows an export will write, read from the monthly rollup."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT SUM(count) FROM monthly_totals WHERE user_id = ?", (user_id,))
+    return cursor.fetchone()[0] or 0
+
+
+def iter_export_chunks(conn, user_id, chunk_size=EXPORT_CHUNK_SIZE, currency=DEFAULT_CURRENCY):
+    """
+    Yields lists of the user's (id, date, name, amount, type, currency, reporting
+    amount) rows of at most chunk_size rows, the reporting amount converted to
+    currency at the month's rate (see fx.py) one chunk at a time.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, date, name, amount, type, currency FROM transactions WHERE user_id = ?
+    """, (user_id,))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        if all(row[5] == currency for row in rows):
+            yield [row + (row[3],) for row in rows]
+        else:
+            from fx import rate_table
+
+            converted = rate_table(conn).convert([row[3] for row in rows], [row[5] for row in rows],
+                                                 [row[1] for row in rows], currency)
+            yield [row + (amount,) for row, amount in zip(rows, converted.tolist())]
+
+
+def export_data(conn, user_id, file_path, file_format=None, chunk_size=EXPORT_CHUNK_SIZE,
+                progress=None, is_cancelled=None, currency=DEFAULT_CURRENCY):
+    """
+    Streams the user's income and expenses to file_path without loading the ledger in memory.
+
+    Args:
+        file_format: 'csv', 'parquet' or 'feather'; guessed from the file extension
+            if omitted. Parquet and Feather need pyarrow.
+        progress: Optional callable receiving (rows_written, total_rows) after each chunk.
+        is_cancelled: Optional callable; the export stops and the partial file is
+            removed as soon as it returns True.
+        currency: The reporting currency the amounts are also given in.
+
+    Returns:
+        True if the export completed, False if it was cancelled.
+    """
+    if file_format is None:
+        extension = os.path.splitext(file_path)[1].lower()
+        file_format = EXPORT_FORMATS.get(extension, 'csv')
+    writers = {'csv': _write_csv, 'parquet': _write_parquet, 'feather': _write_feather}
+    if file_format not in writers:
+        raise ValueError(f"Unsupported export format '{file_format}'")
+
+    total = count_export_rows(conn, user_id)
+
+    def chunks():
+        written = 0
+        for rows in iter_export_chunks(conn, user_id, chunk_size, currency):
+            if is_cancelled is not None and is_cancelled():
+                raise ExportCancelled()
+            yield rows
+            written += len(rows)
+            if progress is not None:
+                progress(written, total)
+
+    try:
+        writers[file_format](file_path, chunks(), currency)
+    except ExportCancelled:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return False
+    return True
+
+
+def _write_csv(file_path, chunks, currency):
+    with open(file_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_HEADERS)
+        for rows in chunks:
+            writer.writerows(csv_rows(rows))
+
+
+def csv_rows(rows):
+    """The export rows with their minor-unit amounts written as decimals."""
+    return [(id, date, name, format_amount(amount), type, currency, format_amount(reporting_amount))
+            for id, date, name, amount, type, currency, reporting_amount in rows]
+
+
+def _arrow_schema(currency):
+    import pyarrow as pa
+
+    amount_type = pa.decimal128(18, CURRENCY_EXPONENT)
+    return pa.schema([('id', pa.int64()), ('date', pa.date32()), ('name', pa.string()), ('amount', amount_type),
+                      ('type', pa.string()), ('currency', pa.string()), ('reporting_amount', amount_type)],
+                     metadata={'reporting_currency': currency})
+
+
+def _arrow_batch(schema, rows):
+    import pyarrow as pa
+
+    ids, dates, names, amounts, types, currencies, reporting_amounts = zip(*rows)
+    amount_type = schema.field('amount').type
+    return pa.record_batch([
+        pa.array(ids, pa.int64()),
+        pa.array(dates, pa.string()).cast(pa.date32()),
+        pa.array(names, pa.string()),
+        # Exact decimals, scaled down from the integer minor units
+        pa.array([Decimal(amount).scaleb(-CURRENCY_EXPONENT) for amount in amounts], amount_type),
+        pa.array(types, pa.string()),
+        pa.array(currencies, pa.string()),
+        pa.array([Decimal(amount).scaleb(-CURRENCY_EXPONENT) for amount in reporting_amounts], amount_type),
+    ], schema=schema)
+
+
+def _write_parquet(file_path, chunks, currency):
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(currency)
+    with pq.ParquetWriter(file_path, schema) as writer:
+        for rows in chunks:
+            writer.write_batch(_arrow_batch(schema, rows))
+
+
+def _write_feather(file_path, chunks, currency):
+    import pyarrow as pa
+
+    # Feather v2 is the Arrow IPC file format, which can be written batch by batch
+    schema = _arrow_schema(currency)
+    with pa.ipc.new_file(file_path, schema) as writer:
+        for rows in chunks:
+            writer.write_batch(_arrow_batch(schema, rows))
@@ -0,0 +1,152 @@
+import datetime
+
+import numpy as np
+
+from database import DEFAULT_CURRENCY, format_date, format_money, parse_date
+from ledger import fetch_totals
+
+DEFAULT_HORIZON_YEARS = 5
+
+
+class Forecast:
+    """A daily projected balance, starting with today's balance."""
+
+    def __init__(self, dates, balance, starting_balance, currency=DEFAULT_CURRENCY):
+        self.dates = dates          # datetime64[D] array, one entry per day
+        self.balance = balance      # int64 array, balance in minor units of currency at the end of each day
+        self.starting_balance = starting_balance
+        self.currency = currency
+
+    @property
+    def first_negative_date(self):
+        """The first day the balance drops below zero, or None."""
+        negative = np.flatnonzero(self.balance < 0)
+        return self.dates[negative[0]].astype(datetime.date) if len(negative) else None
+
+    def balance_on(self, date):
+        index = int((np.datetime64(date, 'D') - self.dates[0]).astype(int))
+        return int(self.balance[min(max(index, 0), len(self.balance) - 1)])
+
+    def as_series(self):
+        import pandas as pd
+
+        return pd.Series(self.balance, index=pd.DatetimeIndex(self.dates), name='balance')
+
+
+def current_balance(conn, user_id, currency=DEFAULT_CURRENCY):
+    """The user's income minus expenses so far in currency, read from the monthly rollup."""
+    income, expenses = fetch_totals(conn, user_id, currency)
+    return income - expenses
+
+
+def load_rules(conn, user_id, currency=DEFAULT_CURRENCY):
+    """
+    Returns the user's recurring rules as (type, amount, start_date, frequency,
+    next_due_date) rows, with the amounts converted to currency at this month's rate.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT type, amount, start_date, frequency, next_due_date, currency
+        FROM recurring_transactions
+        WHERE user_id = ?
+    """, (user_id,))
+    rules = cursor.fetchall()
+    if any(rule[5] != currency for rule in rules):
+        from fx import rate_table
+
+        amounts = rate_table(conn).convert([rule[1] for rule in rules], [rule[5] for rule in rules],
+                                           np.full(len(rules), np.datetime64('today', 'M')), currency)
+        rules = [(rule[0], amount) + rule[2:] for rule, amount in zip(rules, amounts.tolist())]
+    return [rule[:5] for rule in rules]
+
+
+def forecast_balance(conn, user_id, years=DEFAULT_HORIZON_YEARS, today=None, currency=DEFAULT_CURRENCY):
+    """
+    Projects the user's balance day by day over the next `years` years by expanding
+    every recurring transaction into its future occurrences.
+
+    Occurrences are generated with numpy per frequency (one array operation for all
+    rules of that frequency), so the cost does not grow with a Python loop per day.
+    """
+    today = today or datetime.date.today()
+    end = today.replace(year=today.year + years) if not (today.month == 2 and today.day == 29) \
+        else today.replace(year=today.year + years, day=28)
+    return project(load_rules(conn, user_id, currency), current_balance(conn, user_id, currency), today, end,
+                   currency)
+
+
+def project(rules, starting_balance, today, end, currency=DEFAULT_CURRENCY):
+    """Builds a Forecast from today to end (inclusive) for the given rules, with amounts in currency."""
+    first_day = np.datetime64(format_date(today), 'D')
+    days = int((np.datetime64(format_date(end), 'D') - first_day).astype(int)) + 1
+    dates = first_day + np.arange(days)
+    changes = np.zeros(days, dtype=np.int64)
+
+    by_frequency = {}
+    for type, amount, start_date, frequency, next_due_date in rules:
+        first_due = parse_date(next_due_date or start_date)
+        signed = amount if type == 'income' else -amount
+        by_frequency.setdefault(frequency, []).append((parse_date(start_date), first_due, signed))
+
+    for frequency, rows in by_frequency.items():
+        starts = np.array([format_date(row[0]) for row in rows], dtype='datetime64[D]')
+        first_dues = np.array([format_date(row[1]) for row in rows], dtype='datetime64[D]')
+        amounts = np.array([row[2] for row in rows], dtype=np.int64)
+        # Days from today to each first due date; negative for overdue rules
+        offsets = (first_dues - first_day).astype(np.int64)
+
+        if frequency == 'daily':
+            # Every day from the first due date on: add the amount once and accumulate,
+            # with the overdue days (not posted by the sync yet) as a lump sum today
+            active = offsets < days
+            rate = np.bincount(np.maximum(offsets[active], 0), weights=amounts[active], minlength=days)
+            changes += np.cumsum(_exact(rate))
+            changes[0] += np.sum(amounts * np.maximum(-offsets, 0))
+        elif frequency == 'weekly':
+            span = days - offsets.min()
+            indices = offsets[:, None] + 7 * np.arange(span // 7 + 1)
+            _add_occurrences(changes, indices, amounts, indices < days)
+        elif frequency in ('monthly', 'yearly'):
+            step = 1 if frequency == 'monthly' else 12
+            start_months = starts.astype('datetime64[M]')
+            start_days = (starts - start_months.astype('datetime64[D]')).astype(np.int64)
+            # Count occurrences from the start date (so the 31st does not drift), beginning
+            # with the month of the first due date and dropping anything earlier
+            first_due_months = first_dues.astype('datetime64[M]')
+            elapsed = (first_due_months - start_months).astype(np.int64) // step
+            span = int((dates[-1].astype('datetime64[M]') - first_due_months.min()).astype(np.int64))
+            months = start_months[:, None] + (elapsed[:, None] + np.arange(span // step + 2)) * step
+            month_lengths = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+            occurrences = months.astype('datetime64[D]') + np.minimum(start_days[:, None], month_lengths - 1)
+            indices = (occurrences - first_day).astype(np.int64)
+            _add_occurrences(changes, indices, amounts,
+                             (occurrences >= first_dues[:, None]) & (indices < days))
+
+    return Forecast(dates, starting_balance + np.cumsum(changes), starting_balance, currency)
+
+
+def _add_occurrences(changes, indices, amounts, valid):
+    """
+    Adds amounts[i] on every day in indices[i] (a rules x occurrences matrix of day
+    offsets from today) where valid is set. Overdue occurrences are booked today.
+    """
+    weights = np.broadcast_to(amounts[:, None], indices.shape)
+    changes += _exact(np.bincount(np.maximum(indices[valid], 0), weights=weights[valid], minlength=len(changes)))
+
+
+def _exact(sums):
+    # bincount adds the weights as float64, which is exact for integer sums below 2**53
+    return np.rint(sums).astype(np.int64)
+
+
+def format_forecast(forecast):
+    """Summarises a Forecast in a few lines of text."""
+    lines = [f"Current balance: {format_money(forecast.starting_balance, forecast.currency, ',')}"]
+    for years in (1, 2, 5, 10, 30):
+        target = forecast.dates[0] + np.timedelta64(365 * years, 'D')
+        if target <= forecast.dates[-1]:
+            lines.append(f"Projected in {years} year{'s' if years > 1 else ''}: "
+                         f"{format_money(forecast.balance_on(target), forecast.currency, ',')}")
+    negative = forecast.first_negative_date
+    lines.append(f"Balance goes negative on: {negative}" if negative else "Balance stays positive")
+    return "\n".join(lines)
@@ -0,0 +1,266 @@
+"""
+Exchange rates for converting the ledger to one reporting currency.
+
+    python cli.py load-rates eurofxref-hist.zip
+    python cli.py refresh-rates
+
+Rates live in the fx_rates table as units of a currency per euro, the way the
+ECB publishes its reference rates, and are loaded from rate files: the ECB
+history (zip or CSV, one column per currency) or a long CSV with date,
+currency and rate columns. refresh_rates() downloads the ECB history; its
+fetch function can be replaced, e.g. to read a local file when offline.
+
+Amounts are converted per month, at the rate as of the last day of the month
+(the latest earlier rate where there is none that day). The rates of a database
+are read once into a RateTable, which is kept until rates are loaded again, and
+its conversion factor of every month is computed once per currency pair, so a
+report over a ledger in several currencies costs one vectorised lookup and
+multiply more than one in a single currency.
+"""
+import csv
+import datetime
+import io
+import threading
+import urllib.request
+import zipfile
+
+import numpy as np
+
+from database import DEFAULT_CURRENCY, database_path, parse_currency
+
+BASE_CURRENCY = "EUR"
+ECB_HISTORY_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip"
+DOWNLOAD_TIMEOUT_SECONDS = 30
+# Dates of the ECB files: ISO in the history, e.g. "17 October 2024" in the daily file
+RATE_DATE_FORMATS = ("%Y-%m-%d", "%d %B %Y")
+LOAD_BATCH_SIZE = 10000
+
+
+class MissingRateError(ValueError):
+    """Raised when an amount has to be converted from or to a currency without rates."""
+
+
+def parse_rates(lines):
+    """
+    Yields (currency, 'YYYY-MM-DD', rate) for every rate of a rate file with a
+    header row: the ECB layout with a Date column followed by one column per
+    currency, or date, currency and rate columns. Empty and N/A cells are skipped.
+
+    Raises:
+        ValueError: If the file is in neither layout or has an invalid value.
+    """
+    reader = csv.reader(lines)
+    header = [column.strip() for column in next(reader, [])]
+    lower = [column.lower() for column in header]
+    if {"date", "currency", "rate"} <= set(lower):
+        date_column, currency_column, rate_column = (lower.index(name) for name in ("date", "currency", "rate"))
+        for row in reader:
+            if len(row) > max(date_column, currency_column, rate_column) and row[rate_column].strip():
+                yield _rate(row[currency_column], row[date_column], row[rate_column])
+    elif lower and lower[0] == "date":
+        currencies = [(column, parse_currency(currency)) for column, currency in enumerate(header)
+                      if column > 0 and currency]
+        for row in reader:
+            if not row or not row[0].strip():
+                continue
+            for column, currency in currencies:
+                value = row[column].strip() if column < len(row) else ""
+                if value and value.upper() != "N/A":
+                    yield _rate(currency, row[0], value)
+    else:
+        raise ValueError("A rate file needs date, currency and rate columns, or a Date column and one per currency")
+
+
+def _rate(currency, date, rate):
+    for date_format in RATE_DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime(date.strip(), date_format).date().isoformat()
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"Invalid rate date '{date}'")
+    try:
+        rate = float(rate)
+    except ValueError:
+        raise ValueError(f"Invalid rate '{rate}'") from None
+    if not rate > 0:
+        raise ValueError(f"Invalid rate '{rate}'")
+    return parse_currency(currency), date, rate
+
+
+def rate_file_lines(data):
+    """The lines of a rate file from its bytes, unpacking the first CSV of a zip."""
+    if zipfile.is_zipfile(io.BytesIO(data)):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = [name for name in archive.namelist() if name.lower().endswith(".csv")]
+            if not names:
+                raise ValueError("The zip file has no CSV file of rates")
+            data = archive.read(names[0])
+    return io.StringIO(data.decode("utf-8-sig"))
+
+
+def store_rates(conn, rates, source):
+    """
+    Stores (currency, date, rate) rows in fx_rates in one transaction, replacing
+    the rates of the same days, and logs the load. Returns the number of rates.
+    """
+    count = 0
+    with conn:
+        batch = []
+        for rate in rates:
+            batch.append(rate)
+            if len(batch) >= LOAD_BATCH_SIZE:
+                conn.executemany("INSERT OR REPLACE INTO fx_rates (currency, date, rate) VALUES (?, ?, ?)", batch)
+                count += len(batch)
+                batch.clear()
+        conn.executemany("INSERT OR REPLACE INTO fx_rates (currency, date, rate) VALUES (?, ?, ?)", batch)
+        count += len(batch)
+        # A new load id also tells rate_table() that its cached rates are stale
+        conn.execute("INSERT INTO fx_rate_loads (source, loaded_at, rates) VALUES (?, ?, ?)",
+                     (source, datetime.datetime.now().isoformat(timespec="seconds"), count))
+    return count
+
+
+def load_rates(conn, file_path):
+    """Loads a rate file (CSV or a zip holding one, see parse_rates) and returns the number of rates."""
+    with open(file_path, "rb") as file:
+        data = file.read()
+    return store_rates(conn, parse_rates(rate_file_lines(data)), file_path)
+
+
+def download(url):
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+        return response.read()
+
+
+def refresh_rates(conn, fetch=None, url=ECB_HISTORY_URL):
+    """
+    Downloads the rates at url (the ECB history by default) and stores them.
+
+    Args:
+        fetch: Optional callable returning the bytes at a URL, in place of
+            download(), e.g. to read a saved copy when offline.
+
+    Returns:
+        The number of rates stored.
+    """
+    data = (fetch or download)(url)
+    return store_rates(conn, parse_rates(rate_file_lines(data)), url)
+
+
+class RateTable:
+    """
+    The rates of fx_rates in memory, one sorted (dates, rates) pair of numpy
+    arrays per currency, with the memoised conversion factors of every month.
+    """
+
+    def __init__(self, rates, version=None):
+        self.rates = rates  # currency -> (datetime64[D] array, float64 array of units per BASE_CURRENCY)
+        self.version = version
+        self._factors = {}  # (from, to) -> (first month, factor of each month from then on)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, conn, version=None):
+        cursor = conn.cursor()
+        cursor.execute("SELECT currency, date, rate FROM fx_rates ORDER BY currency, date")
+        rows = np.array(cursor.fetchall(), dtype=object).reshape(-1, 3)
+        rates = {}
+        currencies, starts = np.unique(rows[:, 0].astype(str), return_index=True)
+        for currency, start, end in zip(currencies, starts, list(starts[1:]) + [len(rows)]):
+            rates[str(currency)] = (rows[start:end, 1].astype("datetime64[D]"), rows[start:end, 2].astype(np.float64))
+        return cls(rates, version)
+
+    @property
+    def currencies(self):
+        return sorted(set(self.rates) | {BASE_CURRENCY})
+
+    def month_end_rates(self, currency, months):
+        """
+        Units of currency per BASE_CURRENCY as of the last day of each of months
+        (datetime64[M]); months before the first rate take the first rate.
+        """
+        if currency == BASE_CURRENCY:
+            return np.ones(len(months))
+        if currency not in self.rates:
+            raise MissingRateError(f"No exchange rates for {currency}; load them with cli.py load-rates")
+        dates, rates = self.rates[currency]
+        month_ends = (months + 1).astype("datetime64[D]") - 1
+        positions = np.searchsorted(dates, month_ends, side="right") - 1
+        return rates[np.maximum(positions, 0)]
+
+    def factors(self, currency, target):
+        """
+        The (first month, factors) of converting currency to target: the factor
+        of every month from the first to the last month either has rates for.
+        Computed once per pair; earlier and later months use the first and last factor.
+        """
+        key = (currency, target)
+        with self._lock:
+            if key not in self._factors:
+                dates = [self.rates[code][0] for code in key if code in self.rates]
+                if not dates:
+                    first = last = np.datetime64("today", "M")
+                else:
+                    first = min(series[0] for series in dates).astype("datetime64[M]")
+                    last = max(series[-1] for series in dates).astype("datetime64[M]")
+                months = np.arange(first, last + 1)
+                self._factors[key] = (first, self.month_end_rates(target, months)
+                                      / self.month_end_rates(currency, months))
+            return self._factors[key]
+
+    def convert(self, amounts, currencies, dates, target=DEFAULT_CURRENCY):
+        """
+        Converts amounts in minor units of currencies to minor units of target at
+        the factor of the month of each of dates (datetime64 or 'YYYY-MM[-DD]'
+        strings), rounded to the nearest unit. Vectorised per currency.
+
+        Raises:
+            MissingRateError: If a currency other than target has no rates.
+        """
+        amounts = np.asarray(amounts, dtype=np.int64)
+        currencies = np.asarray(currencies)
+        converted = amounts.copy()
+        foreign = currencies != target
+        if not foreign.any():
+            return converted
+        months = np.asarray(dates).astype("datetime64[M]")
+        for currency in np.unique(currencies[foreign]):
+            rows = currencies == currency
+            first, factors = self.factors(str(currency), target)
+            index = np.clip((months[rows] - first).astype(np.int64), 0, len(factors) - 1)
+            converted[rows] = np.rint(amounts[rows] * factors[index])
+        return converted
+
+
+_rate_tables = {}
+_rate_tables_lock = threading.Lock()
+
+
+def rate_table(conn):
+    """
+    The RateTable of the database of conn, read from fx_rates only the first
+    time and again after rates were loaded (by any connection). Shared by all threads.
+    """
+    version = conn.execute("SELECT MAX(id) FROM fx_rate_loads").fetchone()[0]
+    key = database_path(conn) or id(conn)
+    table = _rate_tables.get(key)
+    if table is None or table.version != version:
+        table = RateTable.load(conn, version)
+        with _rate_tables_lock:
+            _rate_tables[key] = table
+    return table
+
+
+def convert_monthly_rows(conn, rows, target=DEFAULT_CURRENCY):
+    """
+    Converts (month, currency, *totals) rows, with month as 'YYYY-MM' and totals
+    in minor units of currency, to (month, target, *totals) rows in target.
+    """
+    if not rows:
+        return []
+    months, currencies, *columns = zip(*rows)
+    table = rate_table(conn)
+    columns = [table.convert(column, currencies, months, target).tolist() for column in columns]
+    return [(month, target, *totals) for month, *totals in zip(months, *columns)]
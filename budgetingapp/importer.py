@@ -0,0 +1,340 @@
+import csv
+import functools
+import os
+import re
+import datetime
+
+from categories import category_matcher
+from database import (DEFAULT_CURRENCY, format_date, parse_currency, to_minor_units, last_transaction_id,
+                      transactions_added_after, publish_added_transactions)
+
+IMPORT_FORMATS = {'.csv': 'csv', '.ofx': 'ofx', '.qfx': 'ofx', '.qif': 'qif'}
+IMPORT_CHUNK_SIZE = 5000
+# Tried in order when no date_format is given
+DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%Y/%m/%d", "%d.%m.%Y")
+# A file writes all its dates one way, month first (US) or day first (UK); parse_qif()
+# picks one of these for the whole file (see detect_date_formats()), the GUI lets the user choose
+MONTH_FIRST_DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%m/%d'%y", "%m-%d-%Y", "%Y-%m-%d", "%Y/%m/%d")
+DAY_FIRST_DATE_FORMATS = ("%d/%m/%Y", "%d/%m/%y", "%d/%m'%y", "%d-%m-%Y", "%d.%m.%Y", "%Y-%m-%d", "%Y/%m/%d")
+QIF_DATE_FORMATS = (MONTH_FIRST_DATE_FORMATS, DAY_FIRST_DATE_FORMATS)
+MAX_REPORTED_ERRORS = 100
+
+# Lower-case header names recognised in CSV files, most specific first
+CSV_DATE_COLUMNS = ("date", "transaction date", "posting date", "booking date")
+CSV_NAME_COLUMNS = ("name", "description", "payee", "merchant", "details", "memo", "reference")
+CSV_AMOUNT_COLUMNS = ("amount", "value", "transaction amount")
+CSV_DEBIT_COLUMNS = ("debit", "paid out", "money out", "withdrawal")
+CSV_CREDIT_COLUMNS = ("credit", "paid in", "money in", "deposit")
+CSV_TYPE_COLUMNS = ("type",)
+CSV_CURRENCY_COLUMNS = ("currency", "ccy")
+
+# An amount with commas between its thousands, e.g. 1,234,567.89
+THOUSANDS_AMOUNT = re.compile(r"\d{1,3}(,\d{3})+(\.\d+)?")
+
+OFX_TAG = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+
+class ImportResult:
+    """Counts of what an import wrote (or would write, for a dry run)."""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.income = 0
+        self.expenses = 0
+        self.skipped = 0
+        self.errors = []  # (line number, message), at most MAX_REPORTED_ERRORS
+
+    @property
+    def imported(self):
+        return self.income + self.expenses
+
+    def add_error(self, line, message):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def __repr__(self):
+        return (f"ImportResult(income={self.income}, expenses={self.expenses}, "
+                f"skipped={self.skipped}, dry_run={self.dry_run})")
+
+
+def import_transactions(conn, user_id, file_path, file_format=None, dry_run=False, date_format=None,
+                        chunk_size=IMPORT_CHUNK_SIZE, progress=None, currency=DEFAULT_CURRENCY):
+    """
+    Imports transactions from a CSV, OFX/QFX or QIF file into the user's income and expenses.
+
+    The file is parsed as a stream; valid rows are categorised by the user's
+    rules (see categories.py), inserted with executemany and committed every
+    chunk_size rows, invalid rows are skipped and reported.
+
+    Args:
+        file_format: 'csv', 'ofx' or 'qif'; guessed from the file extension if omitted.
+        dry_run: Parse and validate only, without writing to the database.
+        date_format: strptime format (or tuple of formats) of the dates in the
+            file, if the default guesses are ambiguous for it, e.g.
+            DAY_FIRST_DATE_FORMATS for a QIF file from a UK bank.
+        progress: Optional callable receiving the number of rows processed so far.
+        currency: The currency of rows the file does not give one for (a CSV
+            currency column, or the CURDEF of an OFX statement).
+
+    Returns:
+        An ImportResult.
+    """
+    if file_format is None:
+        extension = os.path.splitext(file_path)[1].lower()
+        file_format = IMPORT_FORMATS.get(extension, 'csv')
+    parsers = {'csv': parse_csv, 'ofx': parse_ofx, 'qif': parse_qif}
+    if file_format not in parsers:
+        raise ValueError(f"Unsupported import format '{file_format}'")
+
+    parser = parsers[file_format]
+    if file_format == 'qif':
+        parser = functools.partial(parse_qif, date_format=date_format)
+    result = ImportResult(dry_run)
+    chunk = []
+
+    def flush():
+        if not dry_run:
+            matcher = category_matcher(conn, user_id)
+            last_id = last_transaction_id(conn)
+            with conn:
+                conn.executemany("""
+                    INSERT INTO transactions (type, date, name, amount, currency, user_id, category_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (row + (matcher.match(row[2]),) for row in chunk))
+                added = transactions_added_after(conn, user_id, last_id)
+            publish_added_transactions(user_id, added)
+        income = sum(1 for row in chunk if row[0] == 'income')
+        result.income += income
+        result.expenses += len(chunk) - income
+        chunk.clear()
+        if progress is not None:
+            progress(result.imported + result.skipped)
+
+    with open(file_path, newline='', encoding='utf-8-sig') as file:
+        for line, record in parser(file):
+            try:
+                table, row = validate_record(record, date_format, currency)
+            except ValueError as e:
+                result.add_error(line, str(e))
+                continue
+            chunk.append((table,) + row + (user_id,))
+            if len(chunk) >= chunk_size:
+                flush()
+    flush()
+    return result
+
+
+def validate_record(record, date_format=None, currency=DEFAULT_CURRENCY):
+    """
+    Turns a parsed record (a dict with date, name, amount and optionally type and
+    currency) into its transaction type ('income' or 'expenses') and its (date,
+    name, amount, currency) row, with the amount in minor units and currency as
+    the default.
+
+    Raises:
+        ValueError: If the record cannot be imported.
+    """
+    name = (record.get('name') or record.get('memo') or '').strip()
+    if not name:
+        raise ValueError("Missing name")
+    date = parse_import_date(record.get('date') or '', date_format or record.get('date_formats'))
+    amount = parse_amount(record.get('amount') or '')
+    if (record.get('currency') or '').strip():
+        currency = parse_currency(record['currency'])
+    type = (record.get('type') or '').strip().lower()
+    if type in ('income', 'credit'):
+        table = 'income'
+    elif type in ('expenses', 'expense', 'debit'):
+        table = 'expenses'
+    else:
+        # Empty, or what kind of transaction it was, as bank CSVs have it, e.g. 'CARD PAYMENT'
+        table = 'expenses' if amount < 0 else 'income'
+    return table, (format_date(date), name, abs(amount), currency)
+
+
+def parse_import_date(value, date_formats=None):
+    value = value.strip()
+    if isinstance(date_formats, str):
+        date_formats = (date_formats,)
+    for date_format in date_formats or DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid date '{value}'")
+
+
+def parse_amount(value):
+    """
+    Parses a statement amount such as '£1,234.50' or '(12.00)' into signed minor
+    units. Commas are only taken as thousands separators; decimal commas, as in
+    European exports, are rejected rather than misread.
+
+    >>> parse_amount('£1,234.50'), parse_amount('(12.00)')
+    (123450, -1200)
+    >>> parse_amount('-2,50')
+    Traceback (most recent call last):
+    ValueError: Invalid amount '-2,50'
+    """
+    cleaned = re.sub(r"[^0-9.,\-+()]", "", value.strip())
+    if cleaned.startswith('(') and cleaned.endswith(')'):
+        cleaned = '-' + cleaned[1:-1]  # accounting style negative
+    if ',' in cleaned:
+        if not THOUSANDS_AMOUNT.fullmatch(cleaned.lstrip('+-')):
+            raise ValueError(f"Invalid amount '{value}'")
+        cleaned = cleaned.replace(',', '')
+    try:
+        return to_minor_units(cleaned)
+    except ValueError:
+        raise ValueError(f"Invalid amount '{value}'") from None
+
+
+def parse_csv(file):
+    """
+    Yields (line number, record) for each row of a CSV file with a header row.
+    Understands the app's own export as well as the usual bank layouts with either
+    a signed amount column or separate debit and credit columns. A type column
+    is only used where it says income/credit or expense(s)/debit; otherwise,
+    e.g. for a bank's 'CARD PAYMENT', the sign of the amount decides.
+
+    >>> import io
+    >>> statement = io.StringIO("Date,Type,Description,Amount\\n"
+    ...                         "01/05/2024,CARD PAYMENT,TESCO STORES,-12.50\\n"
+    ...                         "02/05/2024,FASTER PAYMENT,ACME LTD SALARY,1500.00\\n")
+    >>> for _, record in parse_csv(statement):
+    ...     print(validate_record(record, currency='GBP'))
+    ('expenses', ('2024-05-01', 'TESCO STORES', 1250, 'GBP'))
+    ('income', ('2024-05-02', 'ACME LTD SALARY', 150000, 'GBP'))
+    """
+    reader = csv.reader(file)
+    header = [column.strip().lower() for column in next(reader, [])]
+
+    def find(candidates):
+        for candidate in candidates:
+            if candidate in header:
+                return header.index(candidate)
+        return None
+
+    date_column = find(CSV_DATE_COLUMNS)
+    name_column = find(CSV_NAME_COLUMNS)
+    amount_column = find(CSV_AMOUNT_COLUMNS)
+    debit_column = find(CSV_DEBIT_COLUMNS)
+    credit_column = find(CSV_CREDIT_COLUMNS)
+    type_column = find(CSV_TYPE_COLUMNS)
+    currency_column = find(CSV_CURRENCY_COLUMNS)
+    if date_column is None or name_column is None or \
+            (amount_column is None and debit_column is None and credit_column is None):
+        raise ValueError("The CSV file needs date, name/description and amount (or debit/credit) columns")
+
+    def cell(row, column):
+        return row[column] if column is not None and column < len(row) else ''
+
+    for line, row in enumerate(reader, start=2):
+        if not any(row):
+            continue
+        record = {'date': cell(row, date_column), 'name': cell(row, name_column),
+                  'type': cell(row, type_column), 'currency': cell(row, currency_column)}
+        if amount_column is not None:
+            record['amount'] = cell(row, amount_column)
+        elif cell(row, debit_column).strip():
+            record['amount'] = '-' + cell(row, debit_column).strip().lstrip('-')
+        else:
+            record['amount'] = cell(row, credit_column)
+        yield line, record
+
+
+def parse_ofx(file):
+    """
+    Yields (line number, record) for each STMTTRN of an OFX/QFX statement, in
+    the CURDEF currency of its statement.
+    """
+    record = None
+    start_line = 0
+    currency = ''
+    for line, text in enumerate(file, start=1):
+        for closing, tag, value in OFX_TAG.findall(text):
+            tag = tag.upper()
+            if tag == 'CURDEF' and not closing:
+                currency = value.strip()
+            elif tag == 'STMTTRN':
+                if record is not None:
+                    yield start_line, record
+                    record = None
+                if not closing:
+                    record, start_line = {'currency': currency}, line
+            elif record is not None and not closing:
+                value = value.strip()
+                if tag == 'DTPOSTED':
+                    # YYYYMMDD, optionally followed by a time and time zone
+                    record['date'] = f"{value[:4]}-{value[4:6]}-{value[6:8]}"
+                elif tag == 'TRNAMT':
+                    record['amount'] = value
+                elif tag in ('NAME', 'PAYEE'):
+                    record['name'] = value
+                elif tag == 'MEMO':
+                    record['memo'] = value
+    if record is not None:
+        yield start_line, record
+
+
+def detect_date_formats(dates, conventions=QIF_DATE_FORMATS):
+    """
+    Returns the one of conventions (tuples of strptime formats) that dates are
+    written in, going by the first date only one of them can read, e.g.
+    '13/03/2024' is day first. Without such a date the first convention is
+    taken, unless that would read a date differently from another.
+
+    Raises:
+        ValueError: If the dates can be read more than one way.
+    """
+    ambiguous = None
+    for value in dates:
+        parsed = []
+        for formats in conventions:
+            try:
+                parsed.append(parse_import_date(value, formats))
+            except ValueError:
+                parsed.append(None)
+        readable = [formats for formats, date in zip(conventions, parsed) if date is not None]
+        if len(readable) == 1:
+            return readable[0]
+        if ambiguous is None and len(set(parsed)) > 1:
+            ambiguous = value
+    if ambiguous is not None:
+        raise ValueError(f"Cannot tell whether dates such as '{ambiguous}' are day or month first; "
+                         f"give the date format")
+    return conventions[0]
+
+
+def parse_qif(file, date_format=None):
+    """
+    Yields (line number, record) for each entry of a QIF file. Unless a
+    date_format is given, the file is read twice: first to find out how all its
+    dates are written, see detect_date_formats().
+    """
+    date_formats = date_format
+    if date_formats is None:
+        date_formats = detect_date_formats(text[1:].strip().replace(' ', '0') for text in file if text[:1] == 'D')
+        file.seek(0)
+    record, start_line = {}, 1
+    for line, text in enumerate(file, start=1):
+        text = text.rstrip('\r\n')
+        if not text or text.startswith('!'):
+            continue
+        code, value = text[0], text[1:].strip()
+        if code == '^':
+            if record:
+                yield start_line, record
+            record, start_line = {}, line + 1
+        elif code == 'D':
+            record['date'] = value.replace(' ', '0')
+            record['date_formats'] = date_formats
+        elif code in ('T', 'U'):
+            record['amount'] = value
+        elif code == 'P':
+            record['name'] = value
+        elif code == 'M':
+            record['memo'] = value
+    if record:
+        yield start_line, record
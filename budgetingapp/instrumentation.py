@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+# Statements that take longer than this (execute plus fetching) are logged with
+# their query plan. Set BUDGETING_SLOW_QUERY_MS to change it, 0 logs everything.
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("BUDGETING_SLOW_QUERY_MS", 100))
+MAX_SLOW_QUERIES = 200
+MAX_CALL_SITES = 10
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    """
+    Per-statement counters for every query run through an InstrumentedConnection:
+    calls, total and max latency, rows and where the statement was called from.
+    Shared by all threads.
+    """
+
+    def __init__(self, slow_threshold_ms=SLOW_QUERY_THRESHOLD_MS):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.statements = {}
+        self.slow_queries = deque(maxlen=MAX_SLOW_QUERIES)
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, sql, elapsed_ms, rows, site, new_call):
+        with self._lock:
+            entry = self.statements.get(sql)
+            if entry is None:
+                entry = self.statements[sql] = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                                'rows': 0, 'sites': Counter()}
+            if new_call:
+                entry['calls'] += 1
+                entry['sites'][site] += 1
+            entry['total_ms'] += elapsed_ms
+            if elapsed_ms > entry['max_ms']:
+                entry['max_ms'] = elapsed_ms
+            entry['rows'] += rows
+
+    def add_slow_query(self, sql, elapsed_ms, site, plan):
+        site = format_site(site)
+        logger.warning("Slow query (%.1f ms) at %s: %s%s", elapsed_ms, site, sql,
+                       "".join(f"\n  {line}" for line in plan))
+        with self._lock:
+            self.slow_queries.append({'sql': sql, 'elapsed_ms': elapsed_ms, 'site': site, 'plan': plan,
+                                      'time': time.strftime("%Y-%m-%d %H:%M:%S")})
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.slow_queries.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        """Returns one dict per statement, slowest total time first."""
+        with self._lock:
+            rows = [{'sql': sql, 'calls': entry['calls'], 'total_ms': entry['total_ms'],
+                     'mean_ms': entry['total_ms'] / entry['calls'] if entry['calls'] else 0.0,
+                     'max_ms': entry['max_ms'], 'rows': entry['rows'],
+                     'sites': {format_site(site): count
+                               for site, count in entry['sites'].most_common(MAX_CALL_SITES)}}
+                    for sql, entry in self.statements.items()]
+        return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+    def to_dict(self):
+        with self._lock:
+            slow_queries = list(self.slow_queries)
+        return {'since': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+                'slow_threshold_ms': self.slow_threshold_ms,
+                'statements': self.snapshot(),
+                'slow_queries': slow_queries}
+
+    def dump_json(self, file_path):
+        with open(file_path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+
+# Collects the statements of every connection made by database.create_connection
+query_stats = QueryStats()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that times execute/executemany and the fetch calls that follow them.
+
+    Rows are counted from rowcount for writes and from fetchone/fetchmany/fetchall
+    for queries; iterating over the cursor directly is not timed, to keep bulk
+    reads such as np.fromiter(cursor) at full speed.
+    """
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._begin(sql, parameters, start)
+
+    def executemany(self, sql, seq_of_parameters):
+        if isinstance(seq_of_parameters, (list, tuple)):
+            first = seq_of_parameters[0] if seq_of_parameters else None
+        else:
+            first = None  # a generator can't be peeked at without consuming it
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._begin(sql, first, start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._add(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._add(start, len(rows))
+        return rows
+
+    def _begin(self, sql, parameters, start):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._sql = normalize(sql)
+        self._parameters = parameters
+        self._site = call_site()
+        self._elapsed_ms = elapsed_ms
+        self._logged = False
+        query_stats.record(self._sql, elapsed_ms, max(self.rowcount, 0), self._site, True)
+        self._check_slow()
+
+    def _add(self, start, rows):
+        if getattr(self, '_sql', None) is None:
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._elapsed_ms += elapsed_ms
+        query_stats.record(self._sql, elapsed_ms, rows, self._site, False)
+        self._check_slow()
+
+    def _check_slow(self):
+        if not self._logged and self._elapsed_ms >= query_stats.slow_threshold_ms:
+            self._logged = True
+            query_stats.add_slow_query(self._sql, self._elapsed_ms, self._site,
+                                       explain(self.connection, self._sql, self._parameters))
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors, including those of conn.execute(), are instrumented."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3 creates the cursor of these shortcuts internally, bypassing cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+_normalized = {}
+
+
+def normalize(sql):
+    """Collapses whitespace, so one statement is counted once however it is indented."""
+    normalized = _normalized.get(sql)
+    if normalized is None:
+        normalized = _normalized[sql] = " ".join(sql.split())
+    return normalized
+
+
+def call_site():
+    """
+    Returns (code, line) of the first caller outside this module and sqlite3;
+    format_site() turns it into text only when the counters are read.
+    """
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename in (__file__, sqlite3.__file__):
+        frame = frame.f_back
+    return (frame.f_code, frame.f_lineno) if frame is not None else None
+
+
+def format_site(site):
+    """'file:line function' for a call_site() result."""
+    if site is None:
+        return "?"
+    code, line = site
+    return f"{os.path.basename(code.co_filename)}:{line} {code.co_name}"
+
+
+def explain(conn, sql, parameters):
+    """Returns the EXPLAIN QUERY PLAN lines of a statement, or why there are none."""
+    if not sql.upper().startswith(EXPLAINABLE):
+        return []
+    if parameters is None and "?" in sql:
+        return ["(no plan: parameters not available)"]
+    try:
+        # A plain cursor, so explaining is not recorded itself
+        cursor = sqlite3.Cursor(conn)
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ())
+        return [detail for _, _, _, detail in cursor.fetchall()]
+    except sqlite3.Error as e:
+        return [f"(no plan: {e})"]
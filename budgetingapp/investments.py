@@ -0,0 +1,468 @@
+"""
+Investment holdings: the trades of every user and a local cache of daily prices.
+
+    python cli.py trade VWRL.L 10 95.40 --date 2024-05-01
+    python cli.py update-prices
+    python cli.py portfolio
+
+Trades are kept apart from income and expenses. A purchase costs its quantity
+times its price in the currency of the trade, which is taken out of the cash
+balance when the net worth is worked out (see charts.fetch_net_worth()).
+
+Closing prices are cached in one Parquet file per ticker in the price directory
+(BUDGETING_PRICE_DIR or prices/ next to the database) together with the date
+range that was fetched, so update_prices() only asks its PriceProvider for the
+days before and after that range. YahooPriceProvider downloads them with
+yfinance; CsvPriceProvider reads CSV files saved earlier, for offline use.
+
+value_portfolio() joins the daily position of every ticker against its price as
+of each day with numpy, so hundreds of tickers over decades of daily prices are
+valued in well under a second. Price files are kept in memory until they change.
+"""
+import csv
+import datetime
+import os
+import re
+import tempfile
+import threading
+import urllib.parse
+
+import numpy as np
+
+from database import DEFAULT_CURRENCY, MINOR_UNITS, database_path, format_date, parse_currency, parse_date
+
+PRICE_SUFFIX = ".parquet"
+# Tickers the way Yahoo Finance writes them, e.g. VWRL.L, BRK-B, ^GSPC or EURUSD=X
+TICKER_PATTERN = re.compile(r"[A-Z0-9.^=\-]{1,20}")
+# Quotes in a fraction of a currency, e.g. London prices in pence, with the currency and divisor they are kept in
+SUBUNIT_CURRENCIES = {"GBp": ("GBP", 100), "GBX": ("GBP", 100), "ZAc": ("ZAR", 100), "ILA": ("ILS", 100)}
+# Positions smaller than this are what is left of selling everything in fractions
+MIN_QUANTITY = 1e-9
+
+
+class PriceError(Exception):
+    """Raised when the prices of a ticker cannot be fetched."""
+
+
+def parse_ticker(value):
+    """
+    Normalises a ticker such as 'vwrl.l' to 'VWRL.L'.
+
+    Raises:
+        ValueError: If value is not a ticker.
+    """
+    ticker = str(value).strip().upper()
+    if not TICKER_PATTERN.fullmatch(ticker):
+        raise ValueError(f"Invalid ticker '{value}'")
+    return ticker
+
+
+def add_trade(conn, user_id, date, ticker, quantity, price, currency=DEFAULT_CURRENCY):
+    """
+    Records that the user bought quantity shares of ticker (sold them, if
+    negative) on date (a datetime.date) at price minor units of currency each.
+    Returns the id of the trade.
+    """
+    quantity = float(quantity)
+    if not np.isfinite(quantity) or quantity == 0:
+        raise ValueError(f"Invalid quantity '{quantity}'")
+    with conn:
+        cursor = conn.execute("""
+            INSERT INTO trades (user_id, date, ticker, quantity, price, currency) VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, format_date(date), parse_ticker(ticker), quantity, price, parse_currency(currency)))
+    return cursor.lastrowid
+
+
+def fetch_trades(conn, user_id):
+    """Returns the user's (id, date, ticker, quantity, price, currency) trades by ticker and date."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, date, ticker, quantity, price, currency FROM trades WHERE user_id = ?
+        ORDER BY ticker, date, id
+    """, (user_id,))
+    return cursor.fetchall()
+
+
+def delete_trades(conn, user_id, ids):
+    """Deletes the user's trades with the given ids in a single transaction."""
+    with conn:
+        conn.executemany("DELETE FROM trades WHERE id = ? AND user_id = ?", ((id, user_id) for id in ids))
+
+
+class PriceSeries:
+    """
+    The cached closes of a ticker: sorted datetime64[D] dates and float64 closes
+    in major units of currency, and the (start, end) dates that were fetched.
+    """
+
+    def __init__(self, dates, closes, currency, start, end):
+        self.dates = dates
+        self.closes = closes
+        self.currency = currency
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return len(self.dates)
+
+
+class PriceProvider:
+    """
+    Where update_prices() gets closing prices from. fetch() returns the (dates,
+    closes, currency) of a ticker from start to end (datetime.date, inclusive):
+    the trading days as a sorted datetime64[D] array, the closes as float64 major
+    units and the currency of the quote, e.g. 'USD' or 'GBp'.
+    Raises PriceError if it has no prices for the ticker.
+    """
+
+    def fetch(self, ticker, start, end):
+        raise NotImplementedError
+
+
+class YahooPriceProvider(PriceProvider):
+    """Downloads daily closes from Yahoo Finance with yfinance, which is only imported when used."""
+
+    def fetch(self, ticker, start, end):
+        import yfinance
+
+        quote = yfinance.Ticker(ticker)
+        # end is exclusive for Yahoo; a range without trading days gives an empty frame
+        history = quote.history(start=start.isoformat(), end=(end + datetime.timedelta(days=1)).isoformat(),
+                                interval="1d", auto_adjust=False, actions=False)
+        currency = quote.get_history_metadata().get("currency")
+        if not currency:
+            raise PriceError(f"Yahoo Finance has no prices for {ticker}")
+        history = history[history["Close"].notna()]
+        # The index is in the exchange's time zone, whose calendar day is the trading day
+        dates = history.index.tz_localize(None).values.astype("datetime64[D]")
+        return dates, history["Close"].to_numpy(dtype=np.float64), currency
+
+
+class CsvPriceProvider(PriceProvider):
+    """
+    Reads the closes of a ticker from <TICKER>.csv in a directory, e.g. as saved
+    from Yahoo Finance: a Date column (YYYY-MM-DD), a Close column and optionally
+    a Currency column, without which the prices are in `currency`.
+    """
+
+    def __init__(self, directory, currency=DEFAULT_CURRENCY):
+        self.directory = directory
+        self.currency = currency
+
+    def fetch(self, ticker, start, end):
+        path = os.path.join(self.directory, ticker + ".csv")
+        if not os.path.exists(path):
+            raise PriceError(f"No price file {path}")
+        currency = self.currency
+        prices = {}
+        with open(path, newline="", encoding="utf-8-sig") as file:
+            reader = csv.DictReader(file)
+            columns = {name.strip().lower() for name in reader.fieldnames or ()}
+            if not {"date", "close"} <= columns:
+                raise PriceError(f"{path} needs Date and Close columns")
+            for row in reader:
+                row = {key.strip().lower(): value.strip() for key, value in row.items() if key and value}
+                # Yahoo writes null for days without a close
+                if row.get("close", "null") == "null":
+                    continue
+                try:
+                    date = datetime.date.fromisoformat(row["date"])
+                    close = float(row["close"])
+                except (KeyError, ValueError):
+                    raise PriceError(f"{path} has an invalid row: {row}") from None
+                if start <= date <= end:
+                    prices[date] = close
+                currency = row.get("currency", currency)
+        dates = sorted(prices)
+        return (np.array(dates, dtype="datetime64[D]"), np.array([prices[date] for date in dates], dtype=np.float64),
+                currency)
+
+
+def default_price_dir(db_path):
+    """BUDGETING_PRICE_DIR, or a prices directory next to the database."""
+    return os.environ.get("BUDGETING_PRICE_DIR") or \
+        os.path.join(os.path.dirname(os.path.abspath(db_path)), "prices")
+
+
+class PriceStore:
+    """
+    The cached prices of every ticker, one Parquet file of date and close columns
+    each, with the currency and the fetched range as file metadata. Files that
+    were read are kept in memory until they change. Shared by all threads; a file
+    is replaced in one step, so readers see either the old or the new prices.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._series = {}  # ticker -> (modification time, PriceSeries)
+        self._lock = threading.Lock()
+
+    def path(self, ticker):
+        return os.path.join(self.directory, urllib.parse.quote(ticker, safe="") + PRICE_SUFFIX)
+
+    def read(self, ticker):
+        """The PriceSeries of ticker, or None if it has none cached."""
+        path = self.path(ticker)
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        cached = self._series.get(ticker)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+        # pyarrow is only loaded once there are prices to read
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+        metadata = {key.decode(): value.decode() for key, value in table.schema.metadata.items()}
+        series = PriceSeries(table.column("date").to_numpy(), table.column("close").to_numpy(),
+                             metadata["currency"], datetime.date.fromisoformat(metadata["start"]),
+                             datetime.date.fromisoformat(metadata["end"]))
+        with self._lock:
+            self._series[ticker] = (modified, series)
+        return series
+
+    def write(self, ticker, series):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(self.directory, exist_ok=True)
+        table = pa.table({"date": pa.array(series.dates, type=pa.date32()),
+                          "close": pa.array(series.closes, type=pa.float64())})
+        table = table.replace_schema_metadata({"ticker": ticker, "currency": series.currency,
+                                               "start": series.start.isoformat(), "end": series.end.isoformat()})
+        path = self.path(ticker)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            pq.write_table(table, temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self._lock:
+            self._series[ticker] = (os.stat(path).st_mtime_ns, series)
+
+
+_price_stores = {}
+_price_stores_lock = threading.Lock()
+
+
+def price_store(conn):
+    """The PriceStore of the price directory of the database of conn, shared by all threads."""
+    directory = default_price_dir(database_path(conn))
+    with _price_stores_lock:
+        store = _price_stores.get(directory)
+        if store is None:
+            store = _price_stores[directory] = PriceStore(directory)
+    return store
+
+
+class PriceUpdate:
+    """What update_prices() fetched."""
+
+    def __init__(self):
+        self.tickers = 0
+        self.prices = 0
+        self.errors = []  # (ticker, message)
+
+    def __repr__(self):
+        return f"PriceUpdate(tickers={self.tickers}, prices={self.prices}, errors={len(self.errors)})"
+
+
+def missing_ranges(series, start, end):
+    """The (first, last) date ranges from start to end that series (None if nothing is cached) lacks."""
+    if series is None:
+        return [(start, end)] if start <= end else []
+    ranges = []
+    if start < series.start:
+        ranges.append((start, min(end, series.start - datetime.timedelta(days=1))))
+    if series.end < end:
+        ranges.append((max(start, series.end + datetime.timedelta(days=1)), end))
+    return ranges
+
+
+def quote_currency(closes, currency):
+    """Turns closes quoted in a fraction of a currency (see SUBUNIT_CURRENCIES) into the currency itself."""
+    if currency in SUBUNIT_CURRENCIES:
+        currency, divisor = SUBUNIT_CURRENCIES[currency]
+        closes = closes / divisor
+    return closes, parse_currency(currency)
+
+
+def update_prices(conn, user_id, provider, store=None, today=None):
+    """
+    Adds the missing closes of every ticker the user traded to the store
+    (price_store() if None), from the day of its first trade through today. Only
+    the days before and after the range fetched earlier are asked for; today is
+    asked for again next time, as its close may still change.
+
+    Returns:
+        A PriceUpdate. Tickers the provider fails for are listed in its errors.
+    """
+    store = store or price_store(conn)
+    today = today or datetime.date.today()
+    result = PriceUpdate()
+    cursor = conn.cursor()
+    cursor.execute("SELECT ticker, MIN(date) FROM trades WHERE user_id = ? GROUP BY ticker", (user_id,))
+    for ticker, first_trade in cursor.fetchall():
+        series = store.read(ticker)
+        ranges = missing_ranges(series, parse_date(first_trade), today)
+        if not ranges:
+            continue
+        try:
+            fetched = []
+            for first, last in ranges:
+                dates, closes, currency = provider.fetch(ticker, first, last)
+                closes, currency = quote_currency(closes, currency)
+                if series is not None and currency != series.currency:
+                    raise PriceError(f"{ticker} is now quoted in {currency}, its cached prices in {series.currency}")
+                fetched.append((dates, closes, currency))
+        except (PriceError, OSError, ValueError) as e:
+            result.errors.append((ticker, str(e)))
+            continue
+        result.tickers += 1
+        result.prices += sum(len(dates) for dates, _, _ in fetched)
+        store.write(ticker, merge_prices(series, fetched, ranges, today))
+    return result
+
+
+def merge_prices(series, fetched, ranges, today):
+    """
+    The PriceSeries of series (None if nothing was cached) with the fetched
+    (dates, closes, currency) of ranges added; fetched closes replace cached ones
+    of the same day.
+    """
+    # Newly fetched days come first, so np.unique keeps them over the cached ones
+    parts = fetched + ([(series.dates, series.closes, series.currency)] if series is not None else [])
+    dates, first = np.unique(np.concatenate([part[0] for part in parts]).astype("datetime64[D]"),
+                             return_index=True)
+    closes = np.concatenate([part[1] for part in parts])[first]
+    start = min([first_day for first_day, _ in ranges] + ([series.start] if series is not None else []))
+    end = max([last_day for _, last_day in ranges] + ([series.end] if series is not None else []))
+    # The range ends before today, so today's close is fetched again
+    return PriceSeries(dates, closes, parts[0][2], start, min(end, today - datetime.timedelta(days=1)))
+
+
+class Valuation:
+    """
+    The daily holdings of a user from the day of the first trade through an end
+    day, see value_portfolio(). Row i of quantities and prices (T x days float64
+    arrays) is tickers[i], quoted in currencies[i]; prices are major units as of
+    each day.
+    """
+
+    def __init__(self, dates, tickers, currencies, quantities, prices, costs):
+        self.dates = dates
+        self.tickers = tickers
+        self.currencies = currencies
+        self.quantities = quantities
+        self.prices = prices
+        self.costs = costs  # (trade dates, cash paid in minor units, currencies) of every trade
+
+    def market_values(self, conn, currency=DEFAULT_CURRENCY):
+        """The market value of the holdings on each day in minor units of currency, as an int64 array."""
+        values = np.rint(self.quantities * self.prices * MINOR_UNITS).astype(np.int64)
+        totals = np.zeros(len(self.dates), dtype=np.int64)
+        for code in np.unique(self.currencies):
+            subtotals = values[self.currencies == code].sum(axis=0)
+            if code != currency:
+                from fx import rate_table
+
+                # Converted at the rate of the month of each day, like the ledger
+                subtotals = rate_table(conn).convert(subtotals, np.full(len(subtotals), code), self.dates, currency)
+            totals += subtotals
+        return totals
+
+    def invested(self, conn, currency=DEFAULT_CURRENCY):
+        """The cash paid for trades less the cash received up to each day, in minor units of currency."""
+        dates, amounts, currencies = self.costs
+        if np.any(currencies != currency):
+            from fx import rate_table
+
+            amounts = rate_table(conn).convert(amounts, currencies, dates, currency)
+        daily = np.zeros(len(self.dates), dtype=np.int64)
+        np.add.at(daily, (dates - self.dates[0]).astype(np.int64), amounts)
+        return np.cumsum(daily)
+
+    def day(self, date=None):
+        """The index of date (the last day if None) in dates, or None if it is before the first trade."""
+        if date is None:
+            return len(self.dates) - 1
+        day = int((np.datetime64(date, "D") - self.dates[0]).astype(np.int64))
+        return None if day < 0 else min(day, len(self.dates) - 1)
+
+    def holdings(self, date=None):
+        """
+        Returns the (ticker, quantity, price, currency, value) of every position
+        held at the end of date (the last day if None), the value in minor units of currency.
+        """
+        day = self.day(date)
+        if day is None:
+            return []
+        return [(str(ticker), float(quantity), float(price), str(currency),
+                 int(np.rint(quantity * price * MINOR_UNITS)))
+                for ticker, quantity, price, currency in zip(self.tickers, self.quantities[:, day],
+                                                             self.prices[:, day], self.currencies)
+                if abs(quantity) > MIN_QUANTITY]
+
+
+def value_portfolio(conn, user_id, end=None, store=None):
+    """
+    Values the user's holdings on every day from the first trade through end (a
+    datetime.date, today if None). Positions are the running sum of the trades of
+    each ticker and are priced at the latest cached close on or before the day
+    (see update_prices()), or at the latest trade price where there is none.
+    A ticker is valued in the currency of its cached prices, or else of its last
+    trade; trade prices in another currency are converted at the rate of their month.
+
+    Returns:
+        A Valuation, or None if the user has no trades.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT ticker, date, quantity, price, currency FROM trades WHERE user_id = ? ORDER BY ticker, date, id
+    """, (user_id,))
+    trades = cursor.fetchall()
+    if not trades:
+        return None
+    store = store or price_store(conn)
+    columns = [np.array(column) for column in zip(*trades)]
+    trade_tickers, trade_dates, quantities, trade_prices, trade_currencies = columns
+    trade_dates = trade_dates.astype("datetime64[D]")
+    quantities = quantities.astype(np.float64)
+    trade_prices = trade_prices.astype(np.int64)
+    end = np.datetime64(end or datetime.date.today(), "D")
+    dates = np.arange(trade_dates.min(), max(end, trade_dates.max()) + 1)
+
+    # The trades are sorted by ticker, so each ticker's are one slice
+    tickers, starts = np.unique(trade_tickers, return_index=True)
+    stops = np.append(starts[1:], len(trades))
+    positions = np.zeros((len(tickers), len(dates)))
+    np.add.at(positions, (np.repeat(np.arange(len(tickers)), stops - starts),
+                          (trade_dates - dates[0]).astype(np.int64)), quantities)
+    np.cumsum(positions, axis=1, out=positions)
+
+    prices = np.empty_like(positions)
+    currencies = trade_currencies[stops - 1]
+    for i, (ticker, start, stop) in enumerate(zip(tickers, starts, stops)):
+        series = store.read(str(ticker))
+        first_close = len(dates)
+        if series is not None and len(series):
+            # An as-of join: the last close on or before every day from the first close on
+            first_close = np.searchsorted(dates, series.dates[0])
+            last_close = np.searchsorted(series.dates, dates[first_close:], side="right") - 1
+            prices[i, first_close:] = series.closes[last_close]
+            currencies[i] = series.currency
+        # Before that, the price of the last trade on or before the day, in the ticker's currency
+        ticker_prices = trade_prices[start:stop]
+        if np.any(trade_currencies[start:stop] != currencies[i]):
+            from fx import rate_table
+
+            ticker_prices = rate_table(conn).convert(ticker_prices, trade_currencies[start:stop],
+                                                     trade_dates[start:stop], currencies[i])
+        last_trade = np.searchsorted(trade_dates[start:stop], dates[:first_close], side="right") - 1
+        prices[i, :first_close] = ticker_prices[np.maximum(last_trade, 0)] / MINOR_UNITS
+
+    costs = (trade_dates, np.rint(quantities * trade_prices).astype(np.int64), trade_currencies)
+    return Valuation(dates, tickers, currencies, positions, prices, costs)
@@ -0,0 +1,227 @@
+"""Data access for the ledger that does not depend on Qt, for the app as well as the CLI."""
+import re
+
+from categories import category_matcher
+from changes import change_bus
+from database import DEFAULT_CURRENCY, format_date
+from export import export_data
+
+
+def fetch_data(conn, user_id, table):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, date, name, amount FROM transactions WHERE user_id = ? AND type = ?",
+                   (user_id, table))
+    rows = cursor.fetchall()
+    return rows
+
+
+# Columns the data view can be sorted on, in display order
+DATA_COLUMNS = ("id", "date", "name", "amount", "currency")
+
+# A "quoted phrase" or a single word of a search
+SEARCH_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def build_search_query(text):
+    """
+    Turns what the user typed into an FTS5 query: "quoted text" is matched as a
+    phrase and every other word as a prefix, so results show up while typing.
+    Returns None if there is nothing to search for.
+    """
+    terms = []
+    for phrase, word in SEARCH_TERM.findall(text):
+        if phrase.strip():
+            terms.append(f'"{phrase}"')
+        else:
+            word = word.replace('"', '').rstrip('*')
+            if word:
+                terms.append(f'"{word}"*')
+    return " ".join(terms) or None
+
+
+def range_conditions(date_from=None, date_to=None, min_amount=None, max_amount=None, column_prefix=""):
+    """
+    Returns the SQL conditions and parameters for the optional inclusive date
+    range (datetime.date) and amount range (minor units) of the data view.
+    """
+    conditions, params = [], []
+    for column, operator, value in (("date", ">=", date_from and format_date(date_from)),
+                                    ("date", "<=", date_to and format_date(date_to)),
+                                    ("amount", ">=", min_amount), ("amount", "<=", max_amount)):
+        if value is not None:
+            conditions.append(f"{column_prefix}{column} {operator} ?")
+            params.append(value)
+    return conditions, params
+
+
+def fetch_page(conn, user_id, table, limit, sort_column="id", descending=False, after=None, search=None,
+               **ranges):
+    """
+    Fetches one page of the user's (id, date, name, amount, currency) rows using keyset pagination.
+
+    Args:
+        table: The transaction type, 'income' or 'expenses'.
+        sort_column: One of DATA_COLUMNS; ties are broken by id.
+        after: The (sort value, id) of the last row of the previous page, or None
+            for the first page.
+        search: Optional search text the name has to match, see build_search_query.
+        ranges: Optional date_from, date_to, min_amount and max_amount, see range_conditions.
+    """
+    if sort_column not in DATA_COLUMNS:
+        raise ValueError(f"Cannot sort on '{sort_column}'")
+    direction = "DESC" if descending else "ASC"
+    conditions, params = ["user_id = ?", "type = ?"], [user_id, table]
+    if after is not None:
+        conditions.append(f"({sort_column}, id) {'<' if descending else '>'} (?, ?)")
+        params.extend(after)
+    query = build_search_query(search) if search else None
+    if query is not None:
+        # Start from the matches rather than walking the user's rows in index order,
+        # which is slow when few rows match (the unary + keeps SQLite off that index)
+        conditions[0] = "+user_id = ?"
+        conditions.append("id IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH ?)")
+        params.append(query)
+    range_sql, range_params = range_conditions(**ranges)
+    conditions += range_sql
+    params += range_params
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT id, date, name, amount, currency FROM transactions
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {sort_column} {direction}, id {direction}
+        LIMIT ?
+    """, params + [limit])
+    return cursor.fetchall()
+
+
+def fetch_rows(conn, user_id, table, ids, search=None, **ranges):
+    """
+    Fetches the user's (id, date, name, amount, currency) rows with the given ids that
+    match search and the ranges, as fetch_page would, e.g. to add rows that were
+    just inserted to a view.
+    """
+    conditions = ["user_id = ?", "type = ?", f"id IN ({', '.join('?' * len(ids))})"]
+    params = [user_id, table, *ids]
+    query = build_search_query(search) if search else None
+    if query is not None:
+        conditions.append("id IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH ?)")
+        params.append(query)
+    range_sql, range_params = range_conditions(**ranges)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT id, date, name, amount, currency FROM transactions WHERE {' AND '.join(conditions + range_sql)}
+    """, params + range_params)
+    return cursor.fetchall()
+
+
+def search_page(conn, user_id, table, search, limit, offset=0, **ranges):
+    """
+    Fetches one page of the user's rows matching search, best matches (by FTS5
+    bm25 rank) first. Takes the same ranges as fetch_page.
+    """
+    query = build_search_query(search)
+    if query is None:
+        return []
+    conditions, params = range_conditions(column_prefix="t.", **ranges)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT t.id, t.date, t.name, t.amount, t.currency
+        FROM transactions_fts JOIN transactions t ON t.id = transactions_fts.rowid
+        WHERE transactions_fts MATCH ? AND t.user_id = ? AND t.type = ?
+              {''.join(f' AND {condition}' for condition in conditions)}
+        ORDER BY transactions_fts.rank
+        LIMIT ? OFFSET ?
+    """, [query, user_id, table] + params + [limit, offset])
+    return cursor.fetchall()
+
+
+def add_entry(conn, user_id, table, date, name, amount, currency=DEFAULT_CURRENCY, category_id=None):
+    """
+    Adds a row to the user's income or expenses and returns its id; amount is in
+    minor units of currency and date is a datetime.date. Without a category_id
+    the row is categorised by the user's rules, see categories.py.
+    """
+    if category_id is None:
+        category_id = category_matcher(conn, user_id).match(name)
+    with conn:
+        cursor = conn.execute("""
+            INSERT INTO transactions (type, date, name, amount, currency, user_id, category_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (table, format_date(date), name, amount, currency, user_id, category_id))
+    change_bus.publish(table, user_id, inserted=[cursor.lastrowid])
+    return cursor.lastrowid
+
+
+def delete_all_data(conn, user_id, table):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM transactions WHERE user_id = ? AND type = ?", (user_id, table))
+    conn.commit()
+    change_bus.publish(table, user_id, reset=True)
+
+
+def delete_entries(conn, user_id, table, ids):
+    """Deletes the user's rows with the given ids in a single transaction."""
+    ids = list(ids)
+    with conn:
+        conn.executemany("DELETE FROM transactions WHERE id = ? AND user_id = ? AND type = ?",
+                         ((id, user_id, table) for id in ids))
+    change_bus.publish(table, user_id, deleted=ids)
+
+
+def fetch_monthly_summary(conn, user_id, month=None, currency=DEFAULT_CURRENCY):
+    """
+    Returns (month, income, expenses) rows of every month, or only of month
+    ('YYYY-MM'), with the totals in minor units of currency. Totals in other
+    currencies are converted at the month's rate, see fx.py.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT month as Month, currency,
+               SUM(case when type = 'income' then total else 0 end) as Total_Income,
+               SUM(case when type = 'expenses' then total else 0 end) as Total_Expenses
+        FROM monthly_totals
+        WHERE user_id = ? {'AND month = ?' if month else ''}
+        GROUP BY month, currency
+        ORDER BY month
+    """, (user_id, month) if month else (user_id,))
+    return sum_by_month(conn, cursor.fetchall(), currency)
+
+
+def sum_by_month(conn, rows, currency=DEFAULT_CURRENCY):
+    """
+    Adds up (month, currency, *totals) rows into one (month, *totals) row per
+    month in currency, keeping their order. Totals are exact if every row is in currency.
+    """
+    if any(row[1] != currency for row in rows):
+        # numpy is only loaded once a ledger is in more than one currency
+        from fx import convert_monthly_rows
+        rows = convert_monthly_rows(conn, rows, currency)
+    sums = {}
+    for month, _, *totals in rows:
+        previous = sums.get(month)
+        sums[month] = totals if previous is None else [a + b for a, b in zip(previous, totals)]
+    return [(month, *totals) for month, totals in sums.items()]
+
+
+def fetch_total(conn, user_id, table, currency=DEFAULT_CURRENCY):
+    """The total of the user's income or expenses in minor units of currency."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT currency, SUM(total) FROM monthly_totals WHERE user_id = ? AND type = ? GROUP BY currency",
+                   (user_id, table))
+    totals = cursor.fetchall()
+    if all(code == currency for code, _ in totals):
+        return sum(total for _, total in totals)
+    # Other currencies are converted month by month
+    cursor.execute("""
+        SELECT month, currency, SUM(total) FROM monthly_totals WHERE user_id = ? AND type = ?
+        GROUP BY month, currency
+    """, (user_id, table))
+    return sum(total for _, total in sum_by_month(conn, cursor.fetchall(), currency))
+
+
+def fetch_totals(conn, user_id, currency=DEFAULT_CURRENCY):
+    return fetch_total(conn, user_id, "income", currency), fetch_total(conn, user_id, "expenses", currency)
+
+
+def export_data_to_file(conn, user_id, file_path):
+    return export_data(conn, user_id, file_path)
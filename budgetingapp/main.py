@@ -1,46 +1,78 @@
+import logging
 import sys
+import time
+
+STARTUP_TIME = time.perf_counter()
 
 from PyQt5.QtWidgets import \
-    QApplication, QMainWindow, QTabWidget, QAction, QMessageBox, QFileDialog, QDialog
+    QApplication, QMainWindow, QTabWidget, QAction, QMessageBox, QFileDialog, QDialog, QProgressDialog, QInputDialog
 from PyQt5.QtGui import QColor, QPalette
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import QApplication
-from database import create_connection, setup_database
-from ui_components import TabOne, TabTwo, TabThree
-from utils import export_data_to_file
+from database import create_connection, database_path, rebuild_search_index
+from ui_components import TabOne, TabTwo, TabThree, AnalyticsTab, DiagnosticsTab, LazyTab
+from workers import ExportThread, ImportThread, BackupThread, DatabaseExecutor, ChangeNotifier
 from budgetingapp.authentication import create_user, LoginDialog, add_default_user
 from database import \
-    setup_user_database, setup_recurring_transactions_table, sync_recurring_transactions_to_main
+    sync_recurring_transactions_to_main, next_sync_delay_ms, initialize_database, MAX_SYNC_DELAY_MS
 from recurring_tasks import RecurringTransactionTab
+from instrumentation import query_stats
+from importer import DAY_FIRST_DATE_FORMATS, MONTH_FIRST_DATE_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# How the dates of an imported file are written, as offered by File > Import
+IMPORT_DATE_FORMATS = {
+    "Detect automatically": None,
+    "Day first (31/12/2024)": DAY_FIRST_DATE_FORMATS,
+    "Month first (12/31/2024)": MONTH_FIRST_DATE_FORMATS,
+}
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, db_conn):
+    def __init__(self, db_conn, user_id):
         super().__init__()
         self.db_conn = db_conn
+        self.user_id = user_id
+        self.executor = DatabaseExecutor(db_conn, self)
+        # Writes from any thread are announced here, so the tabs patch the rows that changed
+        self.changes = ChangeNotifier(parent=self)
+        self.sync_task = None
+        self.backup_thread = None
         self.setWindowTitle("Budgeting App")
 
         # Create the tab widget
         self.tab_widget = QTabWidget()
         self.setCentralWidget(self.tab_widget)
 
-        # Initialize tabs with database connection
-        self.tab_one = TabOne(self.db_conn)
-        self.tab_two = TabTwo(self.db_conn)
-        self.tab_three = TabThree(self.db_conn)
-        self.recurring_tab = RecurringTransactionTab(self.db_conn)
+        # Initialize tabs with database connection; each one is built when first opened
+        self.tab_one = LazyTab(lambda: TabOne(self.db_conn, self.user_id, self.executor, self.changes))
+        self.tab_two = LazyTab(lambda: TabTwo(self.db_conn, self.user_id, self.executor, self.changes))
+        self.tab_three = LazyTab(lambda: TabThree(self.db_conn, self.user_id, self.executor))
+        self.recurring_tab = LazyTab(self.create_recurring_tab)
+        self.analytics_tab = LazyTab(lambda: AnalyticsTab(self.db_conn, self.user_id, self.executor))
+        self.diagnostics_tab = LazyTab(DiagnosticsTab)
 
         # Add tabs to the tab widget
         self.tab_widget.addTab(self.tab_one, "Add Data")
         self.tab_widget.addTab(self.tab_two, "View Data")
         self.tab_widget.addTab(self.recurring_tab, "Recurring Transactions")
         self.tab_widget.addTab(self.tab_three, "View Graph")
+        self.tab_widget.addTab(self.analytics_tab, "Analytics")
+        self.tab_widget.addTab(self.diagnostics_tab, "Diagnostics")
         self.create_menu_bar()
         
-        # Setup a timer to sync recurring transactions
+        # Setup a timer that wakes up when the next recurring transaction is due.
+        # The first catch-up runs once the window is up rather than before login.
         self.sync_timer = QTimer(self)
+        self.sync_timer.setSingleShot(True)
         self.sync_timer.timeout.connect(lambda: self.sync_recurring_transactions())
-        self.sync_timer.start(60000)  # Time in milliseconds (60000 ms = 1 minute)
+        self.sync_timer.start(0)
+
+    def create_recurring_tab(self):
+        recurring_tab = RecurringTransactionTab(self.db_conn, self.user_id, self.changes)
+        recurring_tab.recurring_transactions_changed.connect(self.sync_recurring_transactions)
+        return recurring_tab
 
     def create_menu_bar(self):
         menu_bar = self.menuBar()
@@ -53,6 +85,21 @@ class MainWindow(QMainWindow):
         save_action.triggered.connect(self.on_save_data)
         file_menu.addAction(save_action)
 
+        # Import action
+        import_action = QAction("&Import...", self)
+        import_action.triggered.connect(self.on_import_data)
+        file_menu.addAction(import_action)
+
+        # Backup action
+        backup_action = QAction("&Back Up Now", self)
+        backup_action.triggered.connect(self.on_backup)
+        file_menu.addAction(backup_action)
+
+        # Rebuild search index action
+        rebuild_search_action = QAction("&Rebuild Search Index", self)
+        rebuild_search_action.triggered.connect(self.on_rebuild_search_index)
+        file_menu.addAction(rebuild_search_action)
+
         # Add Exit action
         exit_action = QAction("&Exit", self)
         exit_action.triggered.connect(self.close)
@@ -70,14 +117,139 @@ class MainWindow(QMainWindow):
         QMessageBox.information(self, "About", "Budgeting App\nVersion 1.0")
 
     def on_save_data(self):
-        file_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", "CSV Files (*.csv)")
-        if file_path:
-            export_data_to_file(self.db_conn, file_path)
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "Save File", "",
+            "CSV Files (*.csv);;Parquet Files (*.parquet);;Feather Files (*.feather)")
+        if not file_path:
+            return
+        # Commit pending writes so the export connection sees them
+        self.db_conn.commit()
+        self.export_thread = ExportThread(database_path(self.db_conn), self.user_id, file_path, self)
+        self.export_progress = QProgressDialog("Exporting data...", "Cancel", 0, 0, self)
+        self.export_progress.setWindowModality(Qt.WindowModal)
+        self.export_progress.canceled.connect(self.export_thread.cancel)
+        self.export_thread.progress.connect(self.on_export_progress)
+        self.export_thread.completed.connect(self.on_export_completed)
+        self.export_thread.failed.connect(self.on_export_failed)
+        self.export_thread.start()
+
+    def on_export_progress(self, written, total):
+        self.export_progress.setMaximum(total)
+        self.export_progress.setValue(written)
+
+    def on_export_completed(self, finished):
+        self.export_progress.reset()
+        if finished:
             QMessageBox.information(self, "Success", "Data saved successfully.")
 
+    def on_export_failed(self, message):
+        self.export_progress.reset()
+        QMessageBox.warning(self, "Export Failed", f"An error occurred: {message}")
+
+    def on_import_data(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "Import File", "",
+            "Statements (*.csv *.ofx *.qfx *.qif);;CSV Files (*.csv);;OFX Files (*.ofx *.qfx);;QIF Files (*.qif)")
+        if not file_path:
+            return
+        choice, ok = QInputDialog.getItem(self, "Import File", "Dates in the file:", list(IMPORT_DATE_FORMATS),
+                                          0, False)
+        if ok:
+            # Validate the whole file first, then ask before writing anything
+            self.start_import(file_path, dry_run=True, date_format=IMPORT_DATE_FORMATS[choice])
+
+    def start_import(self, file_path, dry_run, date_format=None):
+        self.db_conn.commit()
+        self.import_thread = ImportThread(database_path(self.db_conn), self.user_id, file_path, dry_run, self,
+                                          date_format=date_format)
+        self.import_progress = QProgressDialog("Reading transactions..." if dry_run else "Importing transactions...",
+                                               None, 0, 0, self)
+        self.import_progress.setWindowModality(Qt.WindowModal)
+        self.import_progress.show()
+        self.import_thread.completed.connect(lambda result: self.on_import_completed(file_path, result, date_format))
+        self.import_thread.failed.connect(self.on_import_failed)
+        self.import_thread.start()
+
+    def on_import_completed(self, file_path, result, date_format=None):
+        self.import_progress.reset()
+        errors = "\n".join(f"Line {line}: {message}" for line, message in result.errors[:10])
+        skipped = f"\n\n{result.skipped} invalid rows will be skipped:\n{errors}" if result.skipped else ""
+        if result.dry_run:
+            confirm_reply = QMessageBox.question(
+                self, "Confirm Import",
+                f"Import {result.income} income and {result.expenses} expense transactions?{skipped}",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if confirm_reply == QMessageBox.Yes and result.imported:
+                self.start_import(file_path, dry_run=False, date_format=date_format)
+        else:
+            QMessageBox.information(self, "Success", f"Imported {result.imported} transactions.")
+
+    def on_import_failed(self, message):
+        self.import_progress.reset()
+        QMessageBox.warning(self, "Import Failed", f"An error occurred: {message}")
+
+    def on_backup(self):
+        if self.backup_thread is not None:
+            return
+        db_path = database_path(self.db_conn)
+        if not db_path:
+            QMessageBox.warning(self, "Backup Failed", "Only a database file can be backed up.")
+            return
+        # Commit pending writes so the snapshot includes them
+        self.db_conn.commit()
+        # Progress goes to the status bar rather than a modal dialog, so the app stays usable
+        self.backup_thread = BackupThread(db_path, self)
+        self.backup_thread.progress.connect(
+            lambda copied, total: self.statusBar().showMessage(f"Backing up... {copied * 100 // max(total, 1)}%"))
+        self.backup_thread.completed.connect(lambda path: self.statusBar().showMessage(f"Backed up to {path}", 10000))
+        self.backup_thread.failed.connect(self.on_backup_failed)
+        self.backup_thread.finished.connect(self.on_backup_finished)
+        self.statusBar().showMessage("Backing up...")
+        self.backup_thread.start()
+
+    def on_backup_failed(self, message):
+        self.statusBar().clearMessage()
+        QMessageBox.warning(self, "Backup Failed", f"An error occurred: {message}")
+
+    def on_backup_finished(self):
+        self.backup_thread = None
+
+    def on_rebuild_search_index(self):
+        self.executor.submit(
+            rebuild_search_index,
+            on_result=lambda _: QMessageBox.information(self, "Success", "The search index has been rebuilt."),
+            on_error=lambda message: QMessageBox.warning(self, "Rebuild Failed", f"An error occurred: {message}"))
+
     def sync_recurring_transactions(self):
-        sync_recurring_transactions_to_main(self.db_conn)
-        # Optionally, refresh views if necessary
+        if self.sync_task is not None:
+            return
+        self.sync_timer.stop()
+        self.sync_task = self.executor.submit(
+            run_recurring_sync, self.user_id,
+            on_result=lambda delay: self.sync_timer.start(delay),
+            # Retried on the next timer tick, so it is logged rather than shown in a dialog every time
+            on_error=lambda message: logger.error("Recurring sync failed: %s", message),
+            on_done=self.on_sync_done)
+        # The posted transactions reach the open views through self.changes
+
+    def on_sync_done(self):
+        self.sync_task = None
+        if not self.sync_timer.isActive():
+            self.sync_timer.start(MAX_SYNC_DELAY_MS)  # retry later after a failure
+
+    def closeEvent(self, event):
+        self.changes.close()
+        if self.backup_thread is not None:
+            self.backup_thread.cancel()
+            self.backup_thread.wait()
+        self.executor.shutdown()
+        super().closeEvent(event)
+
+
+def run_recurring_sync(conn, user_id):
+    """Posts the user's due recurring transactions and returns the delay until the next run."""
+    sync_recurring_transactions_to_main(conn, user_id)
+    return next_sync_delay_ms(conn, user_id)
 
 
 def set_dark_theme(app):
@@ -107,24 +279,65 @@ def set_dark_theme(app):
 
     app.setPalette(palette)
     
+class StartupProfiler:
+    """Records how long each startup phase took, for --profile-startup."""
+
+    def __init__(self, enabled, start=STARTUP_TIME):
+        self.enabled = enabled
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, title):
+        if not self.enabled:
+            return
+        print(f"Startup profile ({title}):", file=sys.stderr)
+        for phase, seconds in self.phases:
+            print(f"  {phase:<24} {seconds * 1000:8.1f} ms", file=sys.stderr)
+        print(f"  {'total':<24} {(self.last - self.start) * 1000:8.1f} ms", file=sys.stderr)
+
+
 def main():
+    profile_startup = "--profile-startup" in sys.argv
+    if profile_startup:
+        sys.argv.remove("--profile-startup")
+    # --query-stats FILE writes the query counters as JSON when the app exits
+    query_stats_file = None
+    if "--query-stats" in sys.argv[:-1]:
+        index = sys.argv.index("--query-stats")
+        query_stats_file = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
+    profiler = StartupProfiler(profile_startup)
+    profiler.mark("imports")
+
     app = QApplication(sys.argv)
     set_dark_theme(app)
+    profiler.mark("application")
 
-    db_conn = create_connection("budgeting.db")
-    setup_database(db_conn)
-    setup_recurring_transactions_table(db_conn)
-    sync_recurring_transactions_to_main(db_conn)
-    add_default_user(db_conn)
-
-    setup_user_database(db_conn)  # Set up user database
+    db_conn = create_connection()
+    profiler.mark("connection")
+    if initialize_database(db_conn):
+        add_default_user(db_conn)
+    profiler.mark("schema")
 
     # Show login dialog
     login_dialog = LoginDialog(db_conn)
+    QTimer.singleShot(0, lambda: (profiler.mark("login dialog shown"), profiler.report("login")))
     if login_dialog.exec() == QDialog.Accepted:
-        main_window = MainWindow(db_conn)
+        profiler.mark("login (waiting for user)")
+        main_window = MainWindow(db_conn, login_dialog.user_id)
         main_window.show()
-        sys.exit(app.exec_())
+        profiler.mark("main window")
+        QTimer.singleShot(0, lambda: (profiler.mark("main window painted"), profiler.report("main window")))
+        exit_code = app.exec_()
+        if query_stats_file:
+            query_stats.dump_json(query_stats_file)
+        sys.exit(exit_code)
     else:
         sys.exit(0)  # Exit the application if login fails
 
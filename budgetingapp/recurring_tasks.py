@@ -1,13 +1,25 @@
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QDateEdit, QComboBox, QTableWidget, QTableWidgetItem, QMessageBox)
-from PyQt5.QtCore import QDate
+from PyQt5.QtCore import QDate, pyqtSignal
 import sqlite3
-import datetime
+
+from changes import RECURRING
+from database import (add_recurring_transaction, delete_recurring_transactions, fetch_recurring_transactions,
+                      format_money, parse_currency, to_minor_units)
+from utils import create_currency_combo_box
+from workers import ChangeNotifier
 
 class RecurringTransactionTab(QWidget):
-    def __init__(self, db_conn):
+    # Emitted whenever the set of recurring transactions changes
+    recurring_transactions_changed = pyqtSignal()
+
+    def __init__(self, db_conn, user_id, changes=None):
         super().__init__()
         self.db_conn = db_conn
+        self.user_id = user_id
+        self.changes = changes or ChangeNotifier(parent=self)
         self.init_ui()
+        # Rules added, processed or cleared anywhere are patched into the table
+        self.changes.changed.connect(self.on_change)
 
     def init_ui(self):
         layout = QVBoxLayout(self)
@@ -19,8 +31,9 @@ class RecurringTransactionTab(QWidget):
         # Transaction name
         self.name_line_edit = QLineEdit()
 
-        # Transaction amount
+        # Transaction amount and its currency
         self.amount_line_edit = QLineEdit()
+        self.currency_combo_box = create_currency_combo_box()
 
         # Start date for the recurring transaction
         self.start_date_edit = QDateEdit(calendarPopup=True)
@@ -43,6 +56,7 @@ class RecurringTransactionTab(QWidget):
         form_layout.addWidget(self.name_line_edit)
         form_layout.addWidget(QLabel("Amount:"))
         form_layout.addWidget(self.amount_line_edit)
+        form_layout.addWidget(self.currency_combo_box)
         form_layout.addWidget(QLabel("Start Date:"))
         form_layout.addWidget(self.start_date_edit)
         form_layout.addWidget(QLabel("Frequency:"))
@@ -68,36 +82,63 @@ class RecurringTransactionTab(QWidget):
         type = self.type_combo_box.currentText().lower()
         name = self.name_line_edit.text()
         amount = self.amount_line_edit.text()
-        start_date = self.start_date_edit.date().toString("dd-MM-yyyy")
+        start_date = self.start_date_edit.date().toPyDate()
         frequency = self.frequency_combo_box.currentText().lower()
 
         # Validate input
-        if not name or not amount.isdigit() or float(amount) <= 0:
+        try:
+            amount = to_minor_units(amount)
+            currency = parse_currency(self.currency_combo_box.currentText())
+        except ValueError:
+            amount = 0
+        if not name or amount <= 0:
             QMessageBox.warning(self, "Invalid Input", "Please enter valid transaction details.")
             return
 
         # Insert into database
         try:
-            cursor = self.db_conn.cursor()
-            cursor.execute("""
-                INSERT INTO recurring_transactions (type, name, amount, start_date, frequency)
-                VALUES (?, ?, ?, ?, ?)
-            """, (type, name, float(amount), start_date, frequency))
-            self.db_conn.commit()
-            self.load_recurring_transactions()
+            add_recurring_transaction(self.db_conn, self.user_id, type, name, amount, start_date, frequency,
+                                      currency)
+            self.recurring_transactions_changed.emit()
         except sqlite3.Error as e:
             QMessageBox.warning(self, "Database Error", f"An error occurred: {e}")
 
     def load_recurring_transactions(self):
         self.table_widget.setRowCount(0)
         try:
-            cursor = self.db_conn.cursor()
-            cursor.execute("SELECT * FROM recurring_transactions")
-            for row in cursor.fetchall():
-                current_row = self.table_widget.rowCount()
-                self.table_widget.insertRow(current_row)
-                for column, item in enumerate(row):
-                    self.table_widget.setItem(current_row, column, QTableWidgetItem(str(item)))
+            for rule in fetch_recurring_transactions(self.db_conn, self.user_id):
+                self.show_rule(rule)
+        except sqlite3.Error as e:
+            QMessageBox.warning(self, "Database Error", f"An error occurred: {e}")
+
+    def show_rule(self, rule, row=None):
+        """Shows a rule of fetch_recurring_transactions() in a new row, or in place of row."""
+        if row is None:
+            row = self.table_widget.rowCount()
+            self.table_widget.insertRow(row)
+        id, type, name, amount, start_date, frequency, next_due_date, currency = rule
+        for column, text in enumerate((str(id), type, name, format_money(amount, currency), frequency)):
+            self.table_widget.setItem(row, column, QTableWidgetItem(text))
+
+    def on_change(self, event):
+        """Patches the rows of a changes.ChangeEvent instead of reloading the table."""
+        if event.table != RECURRING or event.user_id != self.user_id:
+            return
+        if event.reset:
+            self.load_recurring_transactions()
+            return
+        try:
+            rows = {int(self.table_widget.item(row, 0).text()): row for row in range(self.table_widget.rowCount())}
+            if event.updated:
+                for rule in fetch_recurring_transactions(self.db_conn, self.user_id, event.updated):
+                    if rule[0] in rows:
+                        self.show_rule(rule, rows[rule[0]])
+            for row in sorted((rows[id] for id in event.deleted if id in rows), reverse=True):
+                self.table_widget.removeRow(row)
+            if event.inserted:
+                # New ids are the largest, so they go at the end like in ORDER BY id
+                for rule in fetch_recurring_transactions(self.db_conn, self.user_id, event.inserted):
+                    self.show_rule(rule)
         except sqlite3.Error as e:
             QMessageBox.warning(self, "Database Error", f"An error occurred: {e}")
             
@@ -110,10 +151,8 @@ class RecurringTransactionTab(QWidget):
             
     def execute_clear_database(self):
         try:
-            cursor = self.db_conn.cursor()
-            cursor.execute("DELETE FROM recurring_transactions")
-            self.db_conn.commit()
-            self.load_recurring_transactions()  # Reload to reflect changes
+            delete_recurring_transactions(self.db_conn, self.user_id)
+            self.recurring_transactions_changed.emit()
             QMessageBox.information(self, "Success", "All recurring transactions have been cleared.")
         except sqlite3.Error as e:
             QMessageBox.warning(self, "Database Error", f"An error occurred: {e}")
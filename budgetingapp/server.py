@@ -0,0 +1,531 @@
+"""
+Optional HTTP JSON API over the ledger, for dashboards and other tools.
+
+    python cli.py serve --port 8080
+
+It listens on 127.0.0.1 by default. Credentials travel as HTTP Basic auth over
+plain HTTP, so only serve it on another address (--host) on a network you
+trust; cli.py refuses to while the admin user still has its default password.
+
+Every request authenticates with HTTP Basic auth as an app user and sees only
+that user's ledger:
+
+    GET    /api/transactions/{income|expenses}  ?limit, sort, order, search, date_from,
+                                                date_to, min_amount, max_amount, cursor
+    POST   /api/transactions/{income|expenses}  {"date", "name", "amount", optional "currency"}
+    DELETE /api/transactions/{income|expenses}/{id}
+    GET    /api/summary                         ?month=YYYY-MM, currency
+    GET    /api/recurring
+    POST   /api/recurring                       {"type", "name", "amount", "start_date", "frequency",
+                                                 optional "currency"}
+    GET    /api/export                          ?format=json|csv, currency, streamed
+
+Amounts are exchanged in major units (e.g. pounds) of their currency and kept
+in minor units inside. Summaries and the reporting amounts of exports are
+converted to the currency parameter, BUDGETING_CURRENCY by default (see fx.py).
+
+Queries run on a pool of reader threads with one connection each; all writes
+go through a single writer thread, so writers never compete for the lock among
+themselves and WAL keeps readers from blocking on them. GET responses carry an
+ETag derived from PRAGMA data_version, and If-None-Match is answered with 304
+without querying while the database is unchanged.
+"""
+import asyncio
+import base64
+import csv
+import datetime
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from database import (DEFAULT_CURRENCY, MINOR_UNITS, ConnectionManager, create_connection, add_recurring_transaction,
+                      fetch_recurring_transactions, parse_currency, sync_recurring_transactions_to_main,
+                      to_minor_units)
+from export import EXPORT_HEADERS, csv_rows, iter_export_chunks
+from ledger import (DATA_COLUMNS, fetch_page, search_page, add_entry, delete_entries, fetch_monthly_summary)
+from users import authenticate
+
+READ_POOL_SIZE = 8
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 1000
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+KEEP_ALIVE_TIMEOUT_SECONDS = 30
+LISTEN_BACKLOG = 1024
+
+TRANSACTION_COLUMNS = ("id", "date", "name", "amount", "currency")
+RECURRING_COLUMNS = ("id", "type", "name", "amount", "start_date", "frequency", "next_due_date", "currency")
+RECURRING_TYPES = ("income", "expense")
+FREQUENCIES = ("daily", "weekly", "monthly", "yearly")
+JSON_TYPE = "application/json; charset=utf-8"
+CSV_TYPE = "text/csv; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # lower-case names
+        self.body = body
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self):
+        try:
+            data = json.loads(self.body or b"null")
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid JSON: {e}")
+        if not isinstance(data, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected a JSON object")
+        return data
+
+
+class Response:
+    """A response with either a body or chunks, an async iterator of bytes sent with chunked encoding."""
+
+    def __init__(self, status=HTTPStatus.OK, body=b"", content_type=JSON_TYPE, chunks=None, headers=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.chunks = chunks
+        self.headers = headers or {}
+
+
+def json_response(data, status=HTTPStatus.OK):
+    return Response(status, json.dumps(data).encode())
+
+
+class ConnectionPool:
+    """
+    Runs blocking database functions fn(conn, ...) off the event loop: reads on
+    a pool of threads that keep a connection each, writes on a single thread.
+    """
+
+    def __init__(self, db_path, readers=READ_POOL_SIZE):
+        self.db_path = db_path
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix="api-read")
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="api-write")
+        self.connections = ConnectionManager(db_path)
+        # Never writes, so its data_version changes with every commit of any other connection
+        self.version_conn = create_connection(db_path, check_same_thread=False)
+        self._version_lock = threading.Lock()
+
+    def _call(self, fn, args, kwargs):
+        return fn(self.connections.connection(), *args, **kwargs)
+
+    async def read(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, self._call, fn, args, kwargs)
+
+    async def write(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.writer, self._call, fn, args, kwargs)
+
+    async def stream(self, fn, *args, **kwargs):
+        """
+        Iterates fn(conn, ...), a generator, on its own connection so a long
+        stream doesn't hold on to a pool connection between chunks.
+        """
+        loop = asyncio.get_running_loop()
+        conn = await loop.run_in_executor(
+            self.readers, functools.partial(create_connection, self.db_path, check_same_thread=False))
+        try:
+            iterator = fn(conn, *args, **kwargs)
+            while True:
+                item = await loop.run_in_executor(self.readers, next, iterator, None)
+                if item is None:
+                    break
+                yield item
+        finally:
+            await loop.run_in_executor(self.readers, conn.close)
+
+    def version(self):
+        """The database's change counter; it differs after every commit by any connection."""
+        with self._version_lock:
+            return self.version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        self.readers.shutdown()
+        self.writer.shutdown()
+        self.connections.close_all()
+        self.version_conn.close()
+
+
+class LedgerServer:
+    def __init__(self, db_path, host="127.0.0.1", port=8080, readers=READ_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.pool = ConnectionPool(db_path, readers)
+        # Part of every ETag, since data_version starts over with a new connection
+        self.instance = f"{os.getpid():x}{time.time_ns():x}"
+        table = r"(income|expenses)"
+        self.routes = [
+            ("GET", re.compile(rf"/api/transactions/{table}"), self.list_transactions),
+            ("POST", re.compile(rf"/api/transactions/{table}"), self.add_transaction),
+            ("DELETE", re.compile(rf"/api/transactions/{table}/(\d+)"), self.delete_transaction),
+            ("GET", re.compile(r"/api/summary"), self.summary),
+            ("GET", re.compile(r"/api/recurring"), self.list_recurring),
+            ("POST", re.compile(r"/api/recurring"), self.add_recurring),
+            ("GET", re.compile(r"/api/export"), self.export),
+        ]
+
+    async def serve_forever(self, started=None):
+        """Serves until cancelled; started is called with the listening server's (host, port)."""
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=LISTEN_BACKLOG)
+        if started is not None:
+            started(server.sockets[0].getsockname()[:2])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.close()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_TIMEOUT_SECONDS)
+                except HTTPError as e:
+                    await self.send(writer, json_response({'error': str(e)}, e.status), keep_alive=False)
+                    break
+                if request is None:
+                    break
+                await self.send(writer, await self.respond(request), request.keep_alive)
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, request):
+        try:
+            handler, args = self.route(request)
+            user_id = await self.pool.read(authenticate_request, request.headers.get("authorization"))
+            if user_id is None:
+                return Response(HTTPStatus.UNAUTHORIZED, json.dumps({'error': "Authentication required"}).encode(),
+                                headers={'WWW-Authenticate': 'Basic realm="Budgeting App"'})
+            if request.method != "GET":
+                return await handler(request, user_id, *args)
+            etag = self.etag(request, user_id)
+            if etag in request.headers.get("if-none-match", ""):
+                return Response(HTTPStatus.NOT_MODIFIED, headers={'ETag': etag})
+            response = await handler(request, user_id, *args)
+            response.headers.update({'ETag': etag, 'Cache-Control': "no-cache"})
+            return response
+        except HTTPError as e:
+            return json_response({'error': str(e)}, e.status)
+        except ValueError as e:
+            return json_response({'error': str(e)}, HTTPStatus.BAD_REQUEST)
+        except sqlite3.Error as e:
+            logger.error("Database error in %s %s: %s", request.method, request.path, e)
+            return json_response({'error': f"Database error: {e}"}, HTTPStatus.SERVICE_UNAVAILABLE)
+        except Exception:
+            logger.exception("Error in %s %s", request.method, request.path)
+            return json_response({'error': "Internal server error"}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def route(self, request):
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.fullmatch(request.path)
+            if match is None:
+                continue
+            if method == request.method:
+                return handler, match.groups()
+            allowed = True
+        raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED if allowed else HTTPStatus.NOT_FOUND)
+
+    def etag(self, request, user_id):
+        """
+        Read before the data, so a commit landing in between gives the client an
+        older tag with newer data, which only costs one more full response.
+        """
+        key = f"{self.instance}:{self.pool.version()}:{user_id}:{request.target}"
+        return f'"{hashlib.sha1(key.encode()).hexdigest()[:20]}"'
+
+    async def send(self, writer, response, keep_alive):
+        status = HTTPStatus(response.status)
+        headers = {'Connection': "keep-alive" if keep_alive else "close"}
+        if status != HTTPStatus.NOT_MODIFIED:
+            headers['Content-Type'] = response.content_type
+            if response.chunks is not None:
+                headers['Transfer-Encoding'] = "chunked"
+            else:
+                headers['Content-Length'] = str(len(response.body))
+        headers.update(response.headers)
+        head = f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode("latin-1") + b"\r\n")
+        if response.chunks is not None:
+            try:
+                async for chunk in response.chunks:
+                    if chunk:
+                        writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                        await writer.drain()
+            finally:
+                # Closes the stream's connection at once if the client went away
+                await response.chunks.aclose()
+            writer.write(b"0\r\n\r\n")
+        elif status != HTTPStatus.NOT_MODIFIED:
+            writer.write(response.body)
+        await writer.drain()
+
+    async def list_transactions(self, request, user_id, table):
+        query = request.query
+        limit = min(parse_int(query.get("limit", DEFAULT_PAGE_SIZE), "limit", minimum=1), MAX_PAGE_SIZE)
+        search = query.get("search")
+        ranges = parse_ranges(query)
+        cursor = decode_cursor(query["cursor"]) if "cursor" in query else None
+        if search and "sort" not in query:
+            # Best matches first, paged by offset since a rank can't be resumed from
+            offset = cursor or 0
+            if not isinstance(offset, int):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid cursor")
+            rows = await self.pool.read(search_page, user_id, table, search, limit, offset, **ranges)
+            next_cursor = offset + len(rows)
+        else:
+            sort = query.get("sort", "id")
+            if sort not in DATA_COLUMNS:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, f"sort must be one of {', '.join(DATA_COLUMNS)}")
+            if cursor is not None and not (isinstance(cursor, list) and len(cursor) == 2):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid cursor")
+            rows = await self.pool.read(fetch_page, user_id, table, limit, sort, query.get("order") == "desc",
+                                        cursor, search, **ranges)
+            next_cursor = [rows[-1][DATA_COLUMNS.index(sort)], rows[-1][0]] if rows else None
+        next_url = None
+        # A full page may have more after it; an empty one never does
+        if rows and len(rows) == limit:
+            next_url = f"{request.path}?{urlencode({**query, 'cursor': encode_cursor(next_cursor)})}"
+        return json_response({'rows': [with_major_amount(dict(zip(TRANSACTION_COLUMNS, row))) for row in rows],
+                              'next': next_url})
+
+    async def add_transaction(self, request, user_id, table):
+        data = request.json()
+        date = parse_iso_date(data.get("date"), "date")
+        name = data.get("name")
+        if not isinstance(name, str) or not name.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "name is required")
+        amount = parse_amount(data.get("amount"))
+        currency = parse_currency_value(data.get("currency", DEFAULT_CURRENCY))
+        id = await self.pool.write(add_entry, user_id, table, date, name.strip(), amount, currency)
+        return json_response({'id': id}, HTTPStatus.CREATED)
+
+    async def delete_transaction(self, request, user_id, table, id):
+        await self.pool.write(delete_entries, user_id, table, [int(id)])
+        return Response(HTTPStatus.NO_CONTENT)
+
+    async def summary(self, request, user_id):
+        month = request.query.get("month")
+        if month is not None and not re.fullmatch(r"\d{4}-\d{2}", month):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "month must be YYYY-MM")
+        currency = parse_currency_value(request.query.get("currency", DEFAULT_CURRENCY))
+        rows = await self.pool.read(fetch_monthly_summary, user_id, month, currency)
+        # Summed exactly in minor units, converted last
+        income = sum(row[1] for row in rows)
+        expenses = sum(row[2] for row in rows)
+        return json_response({
+            'currency': currency,
+            'months': [{'month': month, 'income': month_income / MINOR_UNITS,
+                        'expenses': month_expenses / MINOR_UNITS,
+                        'net': (month_income - month_expenses) / MINOR_UNITS}
+                       for month, month_income, month_expenses in rows],
+            'income': income / MINOR_UNITS, 'expenses': expenses / MINOR_UNITS,
+            'net': (income - expenses) / MINOR_UNITS,
+        })
+
+    async def list_recurring(self, request, user_id):
+        rows = await self.pool.read(fetch_recurring_transactions, user_id)
+        return json_response({'rows': [with_major_amount(dict(zip(RECURRING_COLUMNS, row))) for row in rows]})
+
+    async def add_recurring(self, request, user_id):
+        data = request.json()
+        type = data.get("type")
+        if type not in RECURRING_TYPES:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"type must be one of {', '.join(RECURRING_TYPES)}")
+        frequency = data.get("frequency")
+        if frequency not in FREQUENCIES:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"frequency must be one of {', '.join(FREQUENCIES)}")
+        name = data.get("name")
+        if not isinstance(name, str) or not name.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "name is required")
+        amount = parse_amount(data.get("amount"))
+        start_date = parse_iso_date(data.get("start_date"), "start_date")
+        currency = parse_currency_value(data.get("currency", DEFAULT_CURRENCY))
+        id = await self.pool.write(add_recurring_and_sync, user_id, type, name.strip(), amount, start_date,
+                                   frequency, currency)
+        return json_response({'id': id}, HTTPStatus.CREATED)
+
+    async def export(self, request, user_id):
+        file_format = request.query.get("format", "json")
+        currency = parse_currency_value(request.query.get("currency", DEFAULT_CURRENCY))
+        if file_format == "csv":
+            return Response(content_type=CSV_TYPE, chunks=self.export_csv(user_id, currency))
+        if file_format == "json":
+            return Response(chunks=self.export_json(user_id, currency))
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "format must be json or csv")
+
+    async def export_csv(self, user_id, currency):
+        yield csv_lines([EXPORT_HEADERS])
+        async for rows in self.pool.stream(iter_export_chunks, user_id, STREAM_CHUNK_SIZE, currency):
+            yield csv_lines(csv_rows(rows))
+
+    async def export_json(self, user_id, currency):
+        # One JSON array, written a chunk of rows at a time
+        columns = [header.lower().replace(" ", "_") for header in EXPORT_HEADERS]
+        separator = "["
+        async for rows in self.pool.stream(iter_export_chunks, user_id, STREAM_CHUNK_SIZE, currency):
+            yield (separator + ",".join(json.dumps(with_major_amount(dict(zip(columns, row))))
+                                        for row in rows)).encode()
+            separator = ","
+        yield b"[]" if separator == "[" else b"]"
+
+
+async def read_request(reader):
+    """Reads one request, or returns None once the client has closed the connection."""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = parse_int(headers.get("content-length", 0), "Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), target, version.upper(), headers, body)
+
+
+def authenticate_request(conn, authorization):
+    """Returns the id of the user of a Basic Authorization header, or None."""
+    if not authorization or not authorization.lower().startswith("basic "):
+        return None
+    try:
+        username, _, password = base64.b64decode(authorization[6:]).decode().partition(":")
+    except ValueError:
+        return None
+    return authenticate(conn, username, password)
+
+
+def add_recurring_and_sync(conn, user_id, type, name, amount, start_date, frequency, currency=DEFAULT_CURRENCY):
+    """Adds a recurring transaction and posts its occurrences that are already due, as the app does."""
+    id = add_recurring_transaction(conn, user_id, type, name, amount, start_date, frequency, currency)
+    sync_recurring_transactions_to_main(conn, user_id)
+    return id
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+def decode_cursor(text):
+    try:
+        return json.loads(base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid cursor")
+
+
+def parse_int(value, name, minimum=0):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+    if number < minimum:
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        f"{name} must not be negative" if minimum == 0 else f"{name} must be at least {minimum}")
+    return number
+
+
+def parse_iso_date(value, name):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a YYYY-MM-DD date")
+
+
+def with_major_amount(row):
+    """A row dict with its minor-unit amounts converted for JSON; int / MINOR_UNITS prints exactly."""
+    for key in ("amount", "reporting_amount"):
+        if key in row:
+            row[key] = row[key] / MINOR_UNITS
+    return row
+
+
+def parse_amount(value, name="amount"):
+    """A positive amount in major units (JSON number or string) as minor units."""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a number")
+    try:
+        amount = to_minor_units(value)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a number")
+    if amount <= 0:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be positive")
+    return amount
+
+
+def parse_currency_value(value, name="currency"):
+    if not isinstance(value, str):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a currency code such as GBP")
+    try:
+        return parse_currency(value)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a currency code such as GBP")
+
+
+def parse_ranges(query):
+    """The date_from, date_to, min_amount and max_amount filters of fetch_page from the query string."""
+    ranges = {}
+    for name in ("date_from", "date_to"):
+        if name in query:
+            ranges[name] = parse_iso_date(query[name], name)
+    for name in ("min_amount", "max_amount"):
+        if name in query:
+            try:
+                ranges[name] = to_minor_units(query[name])
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a number")
+    return ranges
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
@@ -0,0 +1,148 @@
+import datetime
+import random
+
+from database import MINOR_UNITS, format_date
+
+PAYEES = (
+    "Tesco", "Sainsbury's", "Amazon", "Shell", "Netflix", "Spotify", "Rent", "Council Tax",
+    "British Gas", "Thames Water", "Vodafone", "Trainline", "Uber", "Deliveroo", "Boots",
+    "Costa Coffee", "Pret A Manger", "John Lewis", "IKEA", "Gym",
+)
+INCOME_SOURCES = ("Salary", "Bonus", "Freelance", "Dividends", "Interest", "Refund")
+FREQUENCIES = ("daily", "weekly", "monthly", "yearly")
+CHUNK_SIZE = 100000
+
+
+def parse_size(size):
+    """Turns '10k', '1M' or '250000' into a row count."""
+    size = str(size).strip()
+    multipliers = {'k': 1000, 'm': 1000000}
+    if size[-1].lower() in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1].lower()])
+    return int(size)
+
+
+def generate_ledger(conn, rows, recurring=None, seed=0, years=10, today=None, income_share=0.3, users=1):
+    """
+    Fills the ledger with `rows` reproducible random transactions spread over the
+    last `years` years, plus `recurring` recurring rules (rows // 100 by default,
+    capped at 10000) that started within the last 60 days and were never processed.
+    Rows and rules are shared out between user ids 1 to `users`.
+    """
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    first_day = today - datetime.timedelta(days=365 * years)
+    span = (today - first_day).days
+    # Many more distinct names than PAYEES, like a real statement
+    expense_names = [f"{payee} {n}" if n else payee for payee in PAYEES for n in range(25)]
+
+    def transactions(type, count, names, low, high):
+        for _ in range(count):
+            date = first_day + datetime.timedelta(days=rng.randrange(span))
+            amount = rng.randint(low * MINOR_UNITS, high * MINOR_UNITS)
+            yield type, format_date(date), rng.choice(names), amount, rng.randint(1, users)
+
+    income_rows = int(rows * income_share)
+    for type, count, names, low, high in (('income', income_rows, INCOME_SOURCES, 50, 3000),
+                                          ('expenses', rows - income_rows, expense_names, 1, 250)):
+        generator = transactions(type, count, names, low, high)
+        remaining = count
+        while remaining > 0:
+            chunk = [next(generator) for _ in range(min(CHUNK_SIZE, remaining))]
+            with conn:
+                conn.executemany("INSERT INTO transactions (type, date, name, amount, user_id) VALUES (?, ?, ?, ?, ?)",
+                                 chunk)
+            remaining -= len(chunk)
+
+    if recurring is None:
+        recurring = min(rows // 100, 10000)
+    rules = []
+    for _ in range(recurring):
+        start_date = today - datetime.timedelta(days=rng.randrange(60))
+        rules.append((rng.choice(('income', 'expenses')), rng.choice(PAYEES), rng.randint(5 * MINOR_UNITS, 500 * MINOR_UNITS),
+                      format_date(start_date), rng.choice(FREQUENCIES), format_date(start_date),
+                      rng.randint(1, users)))
+    with conn:
+        conn.executemany("""
+            INSERT INTO recurring_transactions (type, name, amount, start_date, frequency, next_due_date, user_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rules)
+
+
+def generate_categories(conn, categories=300, rules=2, user_id=1, seed=0):
+    """
+    Adds `categories` reproducible categories with random monthly limits for
+    user_id, and `rules` rules for each (see categories.py). The first categories
+    take the PAYEES of generate_ledger(), with a longer rule for one of their
+    numbered names; the others get words no transaction has. Returns the number of rules.
+    """
+    rng = random.Random(seed)
+    category_rows, rule_rows = [], []
+    for number in range(categories):
+        name = PAYEES[number] if number < len(PAYEES) else f"Category {number:03d}"
+        category_rows.append((user_id, name, rng.randint(50, 2000) * MINOR_UNITS))
+        keywords = (name, f"{name} {rng.randrange(1, 25)}") if number < len(PAYEES) else (f"merchant{number}",)
+        keywords += tuple(f"merchant{number} {rule}" for rule in range(rules - len(keywords)))
+        rule_rows += [(name, keyword) for keyword in keywords[:rules]]
+    with conn:
+        conn.executemany("INSERT INTO categories (user_id, name, monthly_limit) VALUES (?, ?, ?)", category_rows)
+        conn.executemany("""
+            INSERT INTO category_rules (user_id, category_id, keywords)
+            SELECT ?, id, ? FROM categories WHERE user_id = ? AND name = ?
+        """, ((user_id, keyword, user_id, name) for name, keyword in rule_rows))
+    return len(rule_rows)
+
+
+def generate_rates(conn, currencies=("GBP", "USD"), years=10, seed=0, today=None):
+    """
+    Stores reproducible random-walk exchange rates per euro for every weekday of
+    the last `years` years, like the ECB publishes them. Returns the number of rates.
+    """
+    from fx import store_rates
+
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    day = today - datetime.timedelta(days=365 * years)
+    levels = {currency: rng.uniform(0.5, 2.0) for currency in currencies}
+    rates = []
+    while day <= today:
+        if day.weekday() < 5:
+            for currency in currencies:
+                levels[currency] *= 1 + rng.gauss(0, 0.005)
+                rates.append((currency, format_date(day), round(levels[currency], 4)))
+        day += datetime.timedelta(days=1)
+    return store_rates(conn, rates, "synthetic")
+
+
+def generate_portfolio(conn, store, tickers=300, years=30, trades=20, user_id=1, currencies=("GBP", "USD"),
+                       seed=0, today=None):
+    """
+    Stores reproducible random-walk closes of `tickers` tickers for every weekday
+    of the last `years` years in store (an investments.PriceStore), and `trades`
+    trades of each ticker for user_id at the close of their day, mostly purchases.
+    Returns the number of closes.
+    """
+    import numpy as np
+    from investments import PriceSeries
+
+    rng = np.random.default_rng(seed)
+    today = today or datetime.date.today()
+    first_day = today - datetime.timedelta(days=365 * years)
+    days = np.arange(np.datetime64(first_day), np.datetime64(today) + 1)
+    days = days[np.is_busday(days)]
+    rows = []
+    for number in range(tickers):
+        ticker = f"SYN{number:04d}"
+        currency = currencies[number % len(currencies)]
+        closes = np.round(rng.uniform(5, 500) * np.exp(np.cumsum(rng.normal(0.0002, 0.015, len(days)))), 4)
+        store.write(ticker, PriceSeries(days, closes, currency, first_day, today))
+        picked = np.sort(rng.choice(len(days), trades, replace=False))
+        quantities = np.round(rng.uniform(1, 100, trades), 2) * np.where(rng.random(trades) < 0.8, 1, -0.5)
+        rows += [(user_id, format_date(days[day].item()), ticker, float(quantity),
+                  int(round(closes[day] * MINOR_UNITS)), currency)
+                 for day, quantity in zip(picked, quantities)]
+    with conn:
+        conn.executemany("""
+            INSERT INTO trades (user_id, date, ticker, quantity, price, currency) VALUES (?, ?, ?, ?, ?, ?)
+        """, rows)
+    return tickers * len(days)
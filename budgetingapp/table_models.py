@@ -0,0 +1,191 @@
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, pyqtSignal
+
+from database import format_amount
+from ledger import DATA_COLUMNS, fetch_page, fetch_rows, search_page
+
+
+class LedgerTableModel(QAbstractTableModel):
+    """
+    Table model over the user's income or expenses that only loads the rows the
+    view asks for, one page at a time. Sorting, searching and filtering run in SQL.
+
+    While there is search text the rows are ranked by relevance, until a column
+    is sorted on.
+
+    on_change() patches the loaded rows for a changes.ChangeEvent, so writes do
+    not reload the view.
+    """
+    PAGE_SIZE = 500
+    HEADERS = ["ID", "Date", "Name", "Amount", "Currency"]
+    RANK = "rank"  # sort_column of relevance ordering
+
+    # Emitted with True while a page is being fetched in the background
+    loading_changed = pyqtSignal(bool)
+
+    def __init__(self, executor, user_id, table="income", parent=None):
+        super().__init__(parent)
+        self.executor = executor
+        self.user_id = user_id
+        self.table = table
+        self.sort_column = "id"
+        self.descending = False
+        self.search = ""
+        self.ranges = {}  # date_from, date_to, min_amount, max_amount
+        self.rows = []
+        self.row_ids = set()  # ids of self.rows, so pages and patches do not add a row twice
+        self.exhausted = False
+        self.pending = None
+        self.generation = 0
+
+    def set_table(self, table):
+        self.table = table
+        self.refresh()
+
+    def set_search(self, text, **ranges):
+        """Shows the rows matching text (see ledger.build_search_query) within the ranges."""
+        text = text.strip()
+        if text and not self.search:
+            self.sort_column, self.descending = self.RANK, False
+        elif not text and self.sort_column == self.RANK:
+            self.sort_column = "id"
+        self.search = text
+        self.ranges = ranges
+        self.refresh()
+
+    def refresh(self):
+        """Drops the loaded pages and fetches the first one again."""
+        self.generation += 1  # results of pages still in flight are ignored
+        if self.pending is not None:
+            self.pending.cancel()
+            self.set_pending(None)
+        self.beginResetModel()
+        self.rows = []
+        self.row_ids = set()
+        self.exhausted = False
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def set_pending(self, task):
+        self.pending = task
+        self.loading_changed.emit(task is not None)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        value = self.rows[index.row()][index.column()]
+        if DATA_COLUMNS[index.column()] == "amount":
+            return format_amount(value)
+        return str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted or self.pending is not None:
+            return
+        generation = self.generation
+        callbacks = dict(on_result=lambda page: self.on_page_fetched(generation, page),
+                         on_done=lambda: self.on_fetch_done(generation))
+        if self.sort_column == self.RANK:
+            # Ranks are not stored, so relevance ordered pages use an offset
+            task = self.executor.submit(search_page, self.user_id, self.table, self.search, self.PAGE_SIZE,
+                                        len(self.rows), **self.ranges, **callbacks)
+        else:
+            after = None
+            if self.rows:
+                last_row = self.rows[-1]
+                after = (last_row[DATA_COLUMNS.index(self.sort_column)], last_row[0])
+            task = self.executor.submit(fetch_page, self.user_id, self.table, self.PAGE_SIZE,
+                                        self.sort_column, self.descending, after, self.search,
+                                        **self.ranges, **callbacks)
+        if not task.finished:
+            self.set_pending(task)
+
+    def on_page_fetched(self, generation, page):
+        if generation != self.generation:
+            return
+        self.exhausted = len(page) < self.PAGE_SIZE
+        # A row inserted while the page was in flight may already have been patched in
+        page = [row for row in page if row[0] not in self.row_ids]
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+            self.rows.extend(page)
+            self.row_ids.update(row[0] for row in page)
+            self.endInsertRows()
+
+    def on_fetch_done(self, generation):
+        if generation == self.generation and self.pending is not None:
+            self.set_pending(None)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = DATA_COLUMNS[column]
+        self.descending = order == Qt.DescendingOrder
+        self.refresh()
+
+    def on_change(self, event):
+        """
+        Applies a changes.ChangeEvent to the loaded rows: deleted rows are removed,
+        and inserted or updated rows are fetched by id and put in their sorted place.
+        """
+        if event.user_id != self.user_id or event.table != self.table:
+            return
+        changed = event.inserted + event.updated
+        # Relevance ranks are not known without the query, and big batches are cheaper to reload
+        if event.reset or len(changed) > self.PAGE_SIZE or (changed and self.sort_column == self.RANK):
+            self.refresh()
+            return
+        self.remove_rows(set(event.deleted + event.updated))
+        if changed:
+            generation = self.generation
+            self.executor.submit(fetch_rows, self.user_id, self.table, changed, self.search, **self.ranges,
+                                 on_result=lambda rows: self.insert_rows(generation, rows))
+
+    def remove_rows(self, ids):
+        ids &= self.row_ids
+        if not ids:
+            return
+        for position in reversed([position for position, row in enumerate(self.rows) if row[0] in ids]):
+            self.beginRemoveRows(QModelIndex(), position, position)
+            del self.rows[position]
+            self.endRemoveRows()
+        self.row_ids -= ids
+
+    def insert_rows(self, generation, rows):
+        if generation != self.generation:
+            return
+        for row in rows:
+            if row[0] in self.row_ids:
+                continue
+            position = self.sort_position(row)
+            # Past the last loaded row it belongs to a page that is not loaded yet
+            if position == len(self.rows) and not self.exhausted:
+                continue
+            self.beginInsertRows(QModelIndex(), position, position)
+            self.rows.insert(position, row)
+            self.row_ids.add(row[0])
+            self.endInsertRows()
+
+    def sort_position(self, row):
+        """Where row goes in the loaded rows, which are ordered by (sort column, id) like fetch_page."""
+        column = DATA_COLUMNS.index(self.sort_column)
+        key = (row[column], row[0])
+        low, high = 0, len(self.rows)
+        while low < high:
+            middle = (low + high) // 2
+            middle_key = (self.rows[middle][column], self.rows[middle][0])
+            if (middle_key > key) if self.descending else (middle_key < key):
+                low = middle + 1
+            else:
+                high = middle
+        return low
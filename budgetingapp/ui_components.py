@@ -1,26 +1,81 @@
-import sys
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, 
                              QDateEdit, QListWidget, QMessageBox, QTreeWidget, QTreeWidgetItem, 
-                             QComboBox, QRadioButton, QButtonGroup, QTableWidget, QTableWidgetItem
+                             QComboBox, QRadioButton, QButtonGroup, QTableWidget, QTableWidgetItem,
+                             QTableView, QPlainTextEdit, QFileDialog, QHeaderView, QSplitter
 )
-from PyQt5.QtCore import QDate
-from utils import (add_transaction, calculate_summary, display_summary, 
-                   fetch_total, fetch_data, update_data_view, delete_selected_entry,
-                   clear_treeview, plot_data, clear_data)
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
+from PyQt5.QtCore import Qt, QDate, QTimer
+from PyQt5.QtGui import QFontDatabase, QDoubleValidator, QBrush, QColor
+from utils import add_transaction, create_currency_combo_box, budget_status
+from categories import fetch_budget, transaction_budget
+from changes import CATEGORIES
+from database import DEFAULT_CURRENCY, format_money, to_minor_units
+from table_models import LedgerTableModel
+from workers import DatabaseExecutor, ChangeNotifier
+from instrumentation import query_stats
+from ledger import fetch_totals, delete_all_data
+
+class LazyTab(QWidget):
+    """
+    Placeholder page for a QTabWidget that builds the real tab with factory()
+    the first time it is shown.
+    """
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+        self.tab = None
+        self.tab_layout = QVBoxLayout(self)
+        self.tab_layout.setContentsMargins(0, 0, 0, 0)
+
+    def widget(self):
+        """Returns the real tab, building it if needed."""
+        if self.tab is None:
+            self.tab = self.factory()
+            self.tab_layout.addWidget(self.tab)
+        return self.tab
+
+    def showEvent(self, event):
+        self.widget()
+        super().showEvent(event)
+
 
 class TabOne(QWidget):
-    def __init__(self, db_conn):
+    # Milliseconds to wait for more changes before the shown summary is refreshed
+    SUMMARY_REFRESH_DELAY_MS = 100
+    BUDGET_COLUMNS = ("Category", "Spent", "Limit", "Remaining")
+    OVER_BUDGET_COLOR = QColor(224, 108, 117)
+
+    def __init__(self, db_conn, user_id, executor=None, changes=None):
         super().__init__()
         self.db_conn = db_conn
+        self.user_id = user_id
+        self.executor = executor or DatabaseExecutor(db_conn, self)
+        self.changes = changes or ChangeNotifier(parent=self)
+        self.summary_shown = False
+        self.budget_month = None  # 'YYYY-MM' of the budget shown
+        self.budget_items = {}  # category id -> QTreeWidgetItem
+        self.category_names = ()  # (id, name) of the categories in category_combo_box
         self.init_ui()
+        # Once shown, the summary follows changes made anywhere, e.g. by the recurring sync
+        self.summary_timer = QTimer(self)
+        self.summary_timer.setSingleShot(True)
+        self.summary_timer.setInterval(self.SUMMARY_REFRESH_DELAY_MS)
+        self.summary_timer.timeout.connect(self.on_calculate_summary)
+        # The budget follows changes of the expenses and categories the same way
+        self.budget_timer = QTimer(self)
+        self.budget_timer.setSingleShot(True)
+        self.budget_timer.setInterval(self.SUMMARY_REFRESH_DELAY_MS)
+        self.budget_timer.timeout.connect(self.refresh_budget)
+        self.changes.changed.connect(self.on_change)
+        self.date_edit.dateChanged.connect(self.on_date_changed)
+        self.refresh_budget()
 
     def init_ui(self):
         layout = QVBoxLayout(self)
         self.setup_transaction_type_dropdown(layout)
         self.setup_date_edit(layout)
         self.setup_transaction_fields(layout)
+        self.setup_budget_section(layout)
         self.setup_summary_section(layout)
 
     def setup_transaction_type_dropdown(self, layout):
@@ -45,18 +100,35 @@ class TabOne(QWidget):
         add_btn.clicked.connect(self.on_add_transaction)
         layout.addWidget(QLabel("Description:"))
         layout.addWidget(self.name_line_edit)
+        self.currency_combo_box = create_currency_combo_box()
         layout.addWidget(QLabel("Amount:"))
-        layout.addWidget(self.amount_line_edit)
+        amount_layout = QHBoxLayout()
+        amount_layout.addWidget(self.amount_line_edit)
+        amount_layout.addWidget(self.currency_combo_box)
+        layout.addLayout(amount_layout)
+        # "Auto" leaves it to the category rules
+        self.category_combo_box = QComboBox()
+        self.category_combo_box.addItem("Auto", None)
+        layout.addWidget(QLabel("Category:"))
+        layout.addWidget(self.category_combo_box)
         layout.addWidget(add_btn)
         layout.addWidget(self.transaction_list_widget)
 
+    def setup_budget_section(self, layout):
+        self.budget_label = QLabel()
+        self.budget_tree = QTreeWidget()
+        self.budget_tree.setRootIsDecorated(False)
+        self.budget_tree.setHeaderLabels(self.BUDGET_COLUMNS)
+        layout.addWidget(self.budget_label)
+        layout.addWidget(self.budget_tree)
+
     def setup_summary_section(self, layout):
-        summary_btn = QPushButton("Calculate Summary")
-        summary_btn.clicked.connect(self.on_calculate_summary)
-        self.total_income_label = QLabel("Total Income: £0.00")
-        self.total_expenses_label = QLabel("Total Expenses: £0.00")
-        self.net_balance_label = QLabel("Net Balance: £0.00")
-        layout.addWidget(summary_btn)
+        self.summary_btn = QPushButton("Calculate Summary")
+        self.summary_btn.clicked.connect(self.on_calculate_summary)
+        self.total_income_label = QLabel(f"Total Income: {format_money(0)}")
+        self.total_expenses_label = QLabel(f"Total Expenses: {format_money(0)}")
+        self.net_balance_label = QLabel(f"Net Balance: {format_money(0)}")
+        layout.addWidget(self.summary_btn)
         layout.addWidget(self.total_income_label)
         layout.addWidget(self.total_expenses_label)
         layout.addWidget(self.net_balance_label)
@@ -64,35 +136,124 @@ class TabOne(QWidget):
     def on_add_transaction(self):
         # Get the selected transaction type from the dropdown
         transaction_type = self.transaction_type.currentData()
-        add_transaction(self.db_conn,
-                        self.transaction_list_widget,
-                        self.date_edit,
-                        self.name_line_edit,
-                        self.amount_line_edit,
-                        transaction_type)  # Example for 'income'
+        id = add_transaction(self.db_conn,
+                             self.user_id,
+                             self.transaction_list_widget,
+                             self.date_edit,
+                             self.name_line_edit,
+                             self.amount_line_edit,
+                             transaction_type,
+                             self.currency_combo_box.currentText(),
+                             self.category_combo_box.currentData())
+        if id is None or transaction_type != "expenses":
+            return
+        # A few primary key lookups in category_totals, so this is done right away
+        row = transaction_budget(self.db_conn, self.user_id, id)
+        if row is None:
+            self.budget_label.setText("Uncategorised, so not counted against a budget")
+            return
+        month = self.date_edit.date().toString("yyyy-MM")
+        self.budget_label.setText(budget_status(row, month))
+        item = self.budget_items.get(row[0])
+        if item is not None and month == self.budget_month:
+            self.update_budget_item(item, row)
+
+    def refresh_budget(self):
+        """Loads the budget of the month of the entered date in the background."""
+        month = self.budget_month = self.date_edit.date().toString("yyyy-MM")
+        self.executor.submit(fetch_budget, self.user_id, month,
+                             on_result=lambda rows: self.show_budget(month, rows),
+                             on_error=lambda message: QMessageBox.warning(self, "Database Error",
+                                                                          f"An error occurred: {message}"))
+
+    def show_budget(self, month, rows):
+        if month != self.budget_month:
+            return  # the date moved to another month meanwhile
+        self.budget_tree.clear()
+        self.budget_items = {}
+        for row in rows:
+            item = self.budget_items[row[0]] = QTreeWidgetItem()
+            self.update_budget_item(item, row)
+        self.budget_tree.addTopLevelItems(list(self.budget_items.values()))
+        self.update_category_combo_box([(row[0], row[1]) for row in rows])
+
+    def update_budget_item(self, item, row):
+        _, name, limit, currency, spent, remaining = row
+        item.setText(0, name)
+        item.setText(1, format_money(spent, currency))
+        item.setText(2, "" if limit is None else format_money(limit, currency))
+        item.setText(3, "" if remaining is None else format_money(remaining, currency))
+        item.setForeground(3, QBrush(self.OVER_BUDGET_COLOR) if remaining is not None and remaining < 0 else QBrush())
+
+    def update_category_combo_box(self, categories):
+        """Lists categories, (id, name) pairs, after "Auto", keeping the selection."""
+        categories = tuple(categories)
+        if categories == self.category_names:
+            return
+        self.category_names = categories
+        selected = self.category_combo_box.currentData()
+        self.category_combo_box.clear()
+        self.category_combo_box.addItem("Auto", None)
+        for id, name in categories:
+            self.category_combo_box.addItem(name, id)
+        if selected is not None:
+            self.category_combo_box.setCurrentIndex(max(self.category_combo_box.findData(selected), 0))
+
+    def on_date_changed(self, date):
+        if date.toString("yyyy-MM") != self.budget_month:
+            self.refresh_budget()
     
     def on_calculate_summary(self):
-        # Assuming you have functions to fetch data for income and expenses
-        income = fetch_total(self.db_conn, "income")
-        expenses = fetch_total(self.db_conn, "expenses")
+        self.set_busy(True)
+        self.executor.submit(fetch_totals, self.user_id,
+                             on_result=self.show_summary,
+                             on_error=lambda message: QMessageBox.warning(self, "Database Error", f"An error occurred: {message}"),
+                             on_done=lambda: self.set_busy(False))
+
+    def set_busy(self, busy):
+        self.summary_btn.setEnabled(not busy)
+        if busy:
+            self.setCursor(Qt.BusyCursor)
+        else:
+            self.unsetCursor()
+
+    def on_change(self, event):
+        if event.user_id != self.user_id:
+            return
+        if self.summary_shown and event.table in ("income", "expenses"):
+            self.summary_timer.start()
+        if event.table in ("expenses", CATEGORIES):
+            self.budget_timer.start()
+
+    def show_summary(self, totals):
+        self.summary_shown = True
+        income, expenses = totals
         net_balance = income - expenses
 
-        self.total_income_label.setText(f"Total Income: £{income:.2f}")
-        self.total_expenses_label.setText(f"Total Expenses: £{expenses:.2f}")
-        self.net_balance_label.setText(f"Net Balance: £{net_balance:.2f}")
+        # fetch_totals converts every currency to DEFAULT_CURRENCY
+        self.total_income_label.setText(f"Total Income: {format_money(income)}")
+        self.total_expenses_label.setText(f"Total Expenses: {format_money(expenses)}")
+        self.net_balance_label.setText(f"Net Balance: {format_money(net_balance)}")
 
 
 class TabTwo(QWidget):
-    def __init__(self, db_conn):
+    def __init__(self, db_conn, user_id, executor=None, changes=None):
         super().__init__()
         self.db_conn = db_conn
+        self.user_id = user_id
+        self.executor = executor or DatabaseExecutor(db_conn, self)
+        self.changes = changes or ChangeNotifier(parent=self)
         self.init_ui()
 
     def init_ui(self):
         layout = QVBoxLayout(self)
         self.setup_radio_buttons(layout)
+        self.setup_filter(layout)
         self.setup_table_widget(layout)
         self.setup_buttons(layout)
+        # Sorting loads the first page, so enable it once the buttons exist
+        self.table_widget.setSortingEnabled(True)
+        self.table_widget.sortByColumn(0, Qt.AscendingOrder)
 
     def setup_radio_buttons(self, layout):
         self.radio_group = QButtonGroup(self)
@@ -106,10 +267,71 @@ class TabTwo(QWidget):
         radio_layout.addWidget(expenses_radio)
         layout.addLayout(radio_layout)
 
+    # Milliseconds of no typing before the search runs
+    SEARCH_DELAY_MS = 200
+
+    def setup_filter(self, layout):
+        self.search_line_edit = QLineEdit()
+        self.search_line_edit.setPlaceholderText('Search names: words match as prefixes, "quotes" match a phrase')
+        self.search_line_edit.setClearButtonEnabled(True)
+        self.search_line_edit.returnPressed.connect(self.on_update_data)
+        # Search as you type, once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(self.SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.on_update_data)
+        self.search_line_edit.textChanged.connect(lambda: self.search_timer.start())
+        layout.addWidget(self.search_line_edit)
+
+        filter_layout = QHBoxLayout()
+        self.date_from_edit = self.create_filter_date_edit()
+        self.date_to_edit = self.create_filter_date_edit()
+        self.min_amount_line_edit = self.create_filter_amount_edit("Min")
+        self.max_amount_line_edit = self.create_filter_amount_edit("Max")
+        for label, widget in (("From:", self.date_from_edit), ("To:", self.date_to_edit),
+                              ("Amount:", self.min_amount_line_edit), ("-", self.max_amount_line_edit)):
+            filter_layout.addWidget(QLabel(label))
+            filter_layout.addWidget(widget)
+        layout.addLayout(filter_layout)
+
+    def create_filter_date_edit(self):
+        # The minimum date stands for "no limit" and is shown as "Any"
+        date_edit = QDateEdit(calendarPopup=True)
+        date_edit.setDisplayFormat("dd-MM-yyyy")
+        date_edit.setMinimumDate(QDate(1900, 1, 1))
+        date_edit.setSpecialValueText("Any")
+        date_edit.setDate(date_edit.minimumDate())
+        date_edit.dateChanged.connect(lambda: self.search_timer.start())
+        return date_edit
+
+    def create_filter_amount_edit(self, placeholder):
+        line_edit = QLineEdit()
+        line_edit.setPlaceholderText(placeholder)
+        line_edit.setValidator(QDoubleValidator(0, 1e12, 2, line_edit))
+        line_edit.textChanged.connect(lambda: self.search_timer.start())
+        return line_edit
+
+    def search_ranges(self):
+        """The date and amount ranges of the filter fields, None where not set."""
+        def date(date_edit):
+            return None if date_edit.date() == date_edit.minimumDate() else date_edit.date().toPyDate()
+
+        def amount(line_edit):
+            try:
+                return to_minor_units(line_edit.text())
+            except ValueError:
+                return None
+
+        return {'date_from': date(self.date_from_edit), 'date_to': date(self.date_to_edit),
+                'min_amount': amount(self.min_amount_line_edit), 'max_amount': amount(self.max_amount_line_edit)}
+
     def setup_table_widget(self, layout):
-        self.table_widget = QTableWidget()
-        self.table_widget.setColumnCount(4)
-        self.table_widget.setHorizontalHeaderLabels(["ID", "Date", "Name", "Amount"])
+        self.table_model = LedgerTableModel(self.executor, self.user_id, parent=self)
+        self.table_model.loading_changed.connect(self.set_busy)
+        # Writes patch the loaded rows instead of reloading them
+        self.changes.changed.connect(self.table_model.on_change)
+        self.table_widget = QTableView()
+        self.table_widget.setModel(self.table_model)
         layout.addWidget(self.table_widget)
 
     def setup_buttons(self, layout):
@@ -126,28 +348,40 @@ class TabTwo(QWidget):
         self.update_data_view(table)
 
     def update_data_view(self, table):
-        self.table_widget.setRowCount(0)
-        data = fetch_data(self.db_conn, table)
-        for row_data in data:
-            row = self.table_widget.rowCount()
-            self.table_widget.insertRow(row)
-            for column, data in enumerate(row_data):
-                item = QTableWidgetItem(str(data))
-                self.table_widget.setItem(row, column, item)
+        self.search_timer.stop()
+        self.table_model.table = table
+        self.table_model.set_search(self.search_line_edit.text(), **self.search_ranges())
 
     def on_clear_db(self):
         selected_type = self.radio_group.checkedId()
         table = "income" if selected_type == 1 else "expenses"
         confirm_reply = QMessageBox.question(self, 'Confirm Clear', f"Are you sure you want to clear all data from '{table}'?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if confirm_reply == QMessageBox.Yes:
-            clear_data(self.db_conn, table)
-            self.update_data_view(table)
+            self.set_busy(True)
+            self.executor.submit(delete_all_data, self.user_id, table,
+                                 on_result=lambda _: self.on_data_cleared(table),
+                                 on_error=lambda message: QMessageBox.warning(self, "Database Error", f"An error occurred: {message}"),
+                                 on_done=lambda: self.set_busy(False))
+
+    def on_data_cleared(self, table):
+        # The table model has already been emptied through its change event
+        QMessageBox.information(self, "Data Cleared", f"All data from '{table}' has been cleared.")
+
+    def set_busy(self, busy):
+        self.update_btn.setEnabled(not busy)
+        self.clear_db_btn.setEnabled(not busy)
+        if busy:
+            self.setCursor(Qt.BusyCursor)
+        else:
+            self.unsetCursor()
 
 class TabThree(QWidget):
 
-    def __init__(self, db_conn):
+    def __init__(self, db_conn, user_id, executor=None):
         super().__init__()
         self.db_conn = db_conn
+        self.user_id = user_id
+        self.executor = executor or DatabaseExecutor(db_conn, self)
         self.init_ui()
 
     def init_ui(self):
@@ -155,30 +389,159 @@ class TabThree(QWidget):
         self.setup_plot_section(layout)
 
     def setup_plot_section(self, layout):
+        # matplotlib is slow to import, so only load it once the graph tab is opened
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+        from matplotlib.figure import Figure
+        from charts import ChartEngine, RESOLUTIONS
+
         self.canvas = FigureCanvas(Figure())
+        self.chart = ChartEngine(self.canvas)
         self.update_btn = QPushButton("Plot Data")
         self.update_btn.clicked.connect(self.on_plot_data)
-        layout.addWidget(self.update_btn)
+        self.resolution_combo_box = QComboBox()
+        self.resolution_combo_box.addItem("Auto", None)
+        for resolution in RESOLUTIONS:
+            self.resolution_combo_box.addItem(resolution.capitalize(), resolution)
+        self.resolution_combo_box.currentIndexChanged.connect(
+            lambda: self.chart.set_resolution(self.resolution_combo_box.currentData()))
+
+        controls_layout = QHBoxLayout()
+        controls_layout.addWidget(self.update_btn)
+        controls_layout.addWidget(QLabel("Resolution:"))
+        controls_layout.addWidget(self.resolution_combo_box)
+        layout.addLayout(controls_layout)
+        layout.addWidget(NavigationToolbar(self.canvas, self))
         layout.addWidget(self.canvas)
 
     def on_plot_data(self):
-        plot_data(self.db_conn, self.canvas)
+        from charts import load_chart_data
+
+        self.set_busy(True)
+        self.executor.submit(load_chart_data, self.user_id,
+                             on_result=self.chart.set_data,
+                             on_error=lambda message: QMessageBox.warning(self, "Database Error", f"An error occurred: {message}"),
+                             on_done=lambda: self.set_busy(False))
+
+    def set_busy(self, busy):
+        self.update_btn.setEnabled(not busy)
+        if busy:
+            self.setCursor(Qt.BusyCursor)
+        else:
+            self.unsetCursor()
+
+
+class AnalyticsTab(QWidget):
+
+    def __init__(self, db_conn, user_id, executor=None):
+        super().__init__()
+        self.db_conn = db_conn
+        self.user_id = user_id
+        self.executor = executor or DatabaseExecutor(db_conn, self)
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout(self)
+        self.analyze_btn = QPushButton("Analyze")
+        self.analyze_btn.clicked.connect(self.on_analyze)
+        self.report_text_edit = QPlainTextEdit()
+        self.report_text_edit.setReadOnly(True)
+        self.report_text_edit.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout.addWidget(self.analyze_btn)
+        layout.addWidget(self.report_text_edit)
+
+    def on_analyze(self):
+        self.set_busy(True)
+        self.executor.submit(build_analytics_report, self.user_id,
+                             on_result=self.report_text_edit.setPlainText,
+                             on_error=lambda message: QMessageBox.warning(self, "Database Error", f"An error occurred: {message}"),
+                             on_done=lambda: self.set_busy(False))
+
+    def set_busy(self, busy):
+        self.analyze_btn.setEnabled(not busy)
+        if busy:
+            self.setCursor(Qt.BusyCursor)
+        else:
+            self.unsetCursor()
+
+
+class DiagnosticsTab(QWidget):
+    """Shows the per-statement query counters and the slow-query log."""
+    COLUMNS = ("Statement", "Calls", "Total ms", "Mean ms", "Max ms", "Rows", "Called from")
+
+    def __init__(self, stats=query_stats):
+        super().__init__()
+        self.stats = stats
+        self.init_ui()
+        self.on_refresh()
+
+    def init_ui(self):
+        layout = QVBoxLayout(self)
+        button_layout = QHBoxLayout()
+        for text, slot in (("Refresh", self.on_refresh), ("Reset", self.on_reset), ("Save JSON...", self.on_save_json)):
+            button = QPushButton(text)
+            button.clicked.connect(slot)
+            button_layout.addWidget(button)
+        layout.addLayout(button_layout)
+
+        self.summary_label = QLabel()
+        layout.addWidget(self.summary_label)
+        self.stats_table = QTableWidget(0, len(self.COLUMNS))
+        self.stats_table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.stats_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.stats_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.slow_text_edit = QPlainTextEdit()
+        self.slow_text_edit.setReadOnly(True)
+        self.slow_text_edit.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(self.stats_table)
+        splitter.addWidget(self.slow_text_edit)
+        layout.addWidget(splitter)
+
+    def on_refresh(self):
+        statements = self.stats.snapshot()
+        self.stats_table.setSortingEnabled(False)
+        self.stats_table.setRowCount(len(statements))
+        for row, statement in enumerate(statements):
+            values = (statement['sql'], statement['calls'], statement['total_ms'], statement['mean_ms'],
+                      statement['max_ms'], statement['rows'],
+                      ", ".join(f"{site} ({count})" for site, count in statement['sites'].items()))
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                # Numbers as display data, so sorting the columns is numeric
+                item.setData(Qt.DisplayRole, round(value, 2) if isinstance(value, float) else value)
+                if column == 0:
+                    item.setToolTip(value)
+                self.stats_table.setItem(row, column, item)
+        self.stats_table.setSortingEnabled(True)
+
+        slow_queries = list(self.stats.slow_queries)
+        self.summary_label.setText(f"{len(statements)} statements, {sum(s['calls'] for s in statements)} calls, "
+                                   f"{len(slow_queries)} slower than {self.stats.slow_threshold_ms:g} ms")
+        self.slow_text_edit.setPlainText("\n\n".join(
+            f"{query['time']}  {query['elapsed_ms']:.1f} ms  {query['site']}\n{query['sql']}"
+            + "".join(f"\n    {line}" for line in query['plan'])
+            for query in reversed(slow_queries)))
 
+    def on_reset(self):
+        self.stats.reset()
+        self.on_refresh()
 
-def create_main_window(db_conn):
-    app = QApplication(sys.argv)
-    main_window = QMainWindow()
-    main_window.setWindowTitle("Budgeting App")
+    def on_save_json(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Query Statistics", "query_stats.json", "JSON Files (*.json)")
+        if not file_path:
+            return
+        try:
+            self.stats.dump_json(file_path)
+        except OSError as e:
+            QMessageBox.warning(self, "Save Failed", f"An error occurred: {e}")
 
-    tab_widget = QTabWidget()
-    tab_one = TabOne(db_conn)
-    tab_two = TabTwo(db_conn)
-    tab_three = TabThree(db_conn)
 
-    tab_widget.addTab(tab_one, "Add Data")
-    tab_widget.addTab(tab_two, "View Data")
-    tab_widget.addTab(tab_three, "View Graph")
+def build_analytics_report(conn, user_id):
+    # pandas is only imported once the analytics are actually used
+    from analytics import analyze, format_report
+    from forecast import forecast_balance, format_forecast
 
-    main_window.setCentralWidget(tab_widget)
-    main_window.show()
-    sys.exit(app.exec_())
+    return "\n\n".join([format_report(analyze(conn, user_id)),
+                        "Cash-flow forecast (recurring transactions)",
+                        format_forecast(forecast_balance(conn, user_id))])
@@ -0,0 +1,58 @@
+import sqlite3
+from hashlib import sha256
+
+DEFAULT_USERNAME = "admin"
+DEFAULT_PASSWORD = "admin"
+
+
+def create_user(conn, username, password):
+    hashed_password = sha256(password.encode()).hexdigest()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        return False
+    return True
+
+
+def authenticate(conn, username, password):
+    """Returns the id of the user with these credentials, or None."""
+    hashed_password = sha256(password.encode()).hexdigest()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users WHERE username = ? AND password = ?", (username, hashed_password))
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+def find_user(conn, username):
+    """Returns the id of the user called username, or None."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+def check_user(conn, username, password):
+    return authenticate(conn, username, password) is not None
+
+
+def set_password(conn, username, password):
+    """Changes the password of the user called username; returns False if there is no such user."""
+    hashed_password = sha256(password.encode()).hexdigest()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET password = ? WHERE username = ?", (hashed_password, username))
+    conn.commit()
+    return cursor.rowcount > 0
+
+
+def has_default_password(conn):
+    """Whether the default user still has the password add_default_user() gave it."""
+    return check_user(conn, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+
+
+def add_default_user(conn):
+    username = DEFAULT_USERNAME
+    password = DEFAULT_PASSWORD  # change it with cli.py password before serving the API on the network
+    if not check_user(conn, username, password):
+        create_user(conn, username, password)
@@ -1,56 +1,72 @@
-from PyQt5.QtWidgets import QMessageBox, QTreeWidgetItem
-from PyQt5.QtCore import QDate
+from PyQt5.QtWidgets import QComboBox, QMessageBox, QTreeWidgetItem
+from PyQt5.QtCore import QRegExp
+from PyQt5.QtGui import QRegExpValidator
 import sqlite3
-import csv
-from datetime import datetime
 
-def add_transaction(conn, transaction_list_widget, date_edit, name_line_edit, amount_line_edit, table):
+from database import (CURRENCY_SYMBOLS, DEFAULT_CURRENCY, format_date, format_amount, format_money, parse_currency,
+                      to_minor_units, MINOR_UNITS)
+from ledger import fetch_data, DATA_COLUMNS, add_entry, delete_all_data, delete_entries, fetch_monthly_summary
+
+def add_transaction(conn, user_id, transaction_list_widget, date_edit, name_line_edit, amount_line_edit, table,
+                    currency=DEFAULT_CURRENCY, category_id=None):
+    """Adds the entered transaction and returns its id, or None if it was not valid."""
     name = name_line_edit.text()
     amount = amount_line_edit.text()
     selected_date = date_edit.date().toPyDate()
-    formatted_date = selected_date.strftime("%Y-%m-%d")
+    formatted_date = format_date(selected_date)
 
     try:
-        amount = float(amount)
-        cursor = conn.cursor()
-        cursor.execute(f"INSERT INTO {table} (date, name, amount) VALUES (?, ?, ?)", 
-                       (formatted_date, name, amount))
-        conn.commit()
+        amount = to_minor_units(amount)
+        currency = parse_currency(currency)
+        id = add_entry(conn, user_id, table, selected_date, name, amount, currency, category_id)
 
-        transaction_list_widget.addItem(f"{formatted_date} - {name}: £{amount:.2f}")
+        transaction_list_widget.addItem(f"{formatted_date} - {name}: {format_money(amount, currency)}")
         name_line_edit.clear()
         amount_line_edit.clear()
+        return id
     except ValueError:
-        QMessageBox.warning(None, "Invalid Entry", "Please enter a valid amount.")
-
-def calculate_summary(income_list_widget, expense_list_widget):
-    income = sum(float(item.text().split(': £')[1]) for item in income_list_widget.findItems("", Qt.MatchContains))
-    expenses = sum(float(item.text().split(': £')[1]) for item in expense_list_widget.findItems("", Qt.MatchContains))
-    net_balance = income - expenses
-    return income, expenses, net_balance
-
-def display_summary(income, expenses, net_balance):
+        QMessageBox.warning(None, "Invalid Entry", "Please enter a valid amount and currency.")
+        return None
+
+
+def budget_status(row, month):
+    """
+    What is left of a fetch_budget() row in month ('YYYY-MM'), e.g.
+    'Groceries: £12.50 left of £400.00 in 2024-05'.
+    """
+    _, name, limit, currency, spent, remaining = row
+    if limit is None:
+        return f"{name}: {format_money(spent, currency)} spent in {month}, no limit"
+    if remaining < 0:
+        return (f"{name}: {format_money(-remaining, currency)} over the limit of "
+                f"{format_money(limit, currency)} in {month}")
+    return f"{name}: {format_money(remaining, currency)} left of {format_money(limit, currency)} in {month}"
+
+
+def create_currency_combo_box():
+    """An editable combo box of currency codes, starting with DEFAULT_CURRENCY."""
+    combo_box = QComboBox()
+    combo_box.setEditable(True)
+    combo_box.addItems([DEFAULT_CURRENCY] + sorted(set(CURRENCY_SYMBOLS) - {DEFAULT_CURRENCY}))
+    combo_box.setValidator(QRegExpValidator(QRegExp("[A-Za-z]{0,3}"), combo_box))
+    return combo_box
+
+def display_summary(income, expenses, net_balance, currency=DEFAULT_CURRENCY):
     QMessageBox.information(None, "Financial Summary",
-                            f"Total Income: £{income:.2f}\n"
-                            f"Total Expenses: £{expenses:.2f}\n"
-                            f"Net Balance: £{net_balance:.2f}")
-
-def fetch_data(conn, table):
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT id, date, name, amount FROM {table}")
-    rows = cursor.fetchall()
-    return rows
+                            f"Total Income: {format_money(income, currency)}\n"
+                            f"Total Expenses: {format_money(expenses, currency)}\n"
+                            f"Net Balance: {format_money(net_balance, currency)}")
 
 
-def update_data_view(conn, table, tree_widget):
+def update_data_view(conn, user_id, table, tree_widget):
     tree_widget.clear()
-    data = fetch_data(conn, table)
+    data = fetch_data(conn, user_id, table)
     for row in data:
         # Create a QTreeWidgetItem for each row
         item = QTreeWidgetItem(tree_widget)
         # Set values for each column
         for i, value in enumerate(row):
-            item.setText(i, str(value))
+            item.setText(i, format_amount(value) if DATA_COLUMNS[i] == "amount" else str(value))
 
 
 
@@ -58,81 +74,45 @@ def clear_treeview(tree_widget):
     tree_widget.clear()
 
 
-def clear_data(conn, table):
+def clear_data(conn, user_id, table):
     try:
-        cursor = conn.cursor()
-        cursor.execute(f"DELETE FROM {table}")
-        conn.commit()
+        delete_all_data(conn, user_id, table)
         QMessageBox.information(None, "Data Cleared", f"All data from '{table}' has been cleared.")
     except sqlite3.Error as e:
         QMessageBox.warning(None, "Database Error", f"An error occurred: {e}")
 
 
-def delete_selected_entry(conn, tree_widget, table):
+def delete_selected_entry(conn, user_id, tree_widget, table):
     selected_items = tree_widget.selectedItems()
     if not selected_items:
         QMessageBox.information(None, "Selection Required", "Please select an item to delete.")
         return
 
     if QMessageBox.question(None, "Confirm Deletion", "Are you sure you want to delete this item?") == QMessageBox.Yes:
+        delete_entries(conn, user_id, table, [int(item.text(0)) for item in selected_items])
+        # Only the deleted items are taken out rather than reloading the tree
         for item in selected_items:
-            item_id = item.text().split(" - ")[0]
-            cursor = conn.cursor()
-            cursor.execute(f"DELETE FROM {table} WHERE id = ?", (item_id,))
-            conn.commit()
-        update_data_view(conn, table, tree_widget)
-
-
-def fetch_monthly_summary(conn):
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT strftime('%Y-%m', date) as Month, 
-               SUM(case when table_name = 'income' then amount else 0 end) as Total_Income,
-               SUM(case when table_name = 'expenses' then amount else 0 end) as Total_Expenses
-        FROM (
-            SELECT date, amount, 'income' as table_name FROM income
-            UNION ALL
-            SELECT date, amount, 'expenses' FROM expenses
-        )
-        GROUP BY Month
-        ORDER BY Month
-    """)
-    return cursor.fetchall()
-
-
-def plot_data(conn, matplotlib_widget):
-    data = fetch_monthly_summary(conn)
+            tree_widget.takeTopLevelItem(tree_widget.indexOfTopLevelItem(item))
+
+
+def plot_data(conn, user_id, matplotlib_widget):
+    draw_monthly_summary(matplotlib_widget, fetch_monthly_summary(conn, user_id))
+
+
+def draw_monthly_summary(matplotlib_widget, data):
     if data:
-        months, incomes, expenses = zip(*data)
+        months = [row[0] for row in data]
+        incomes = [row[1] / MINOR_UNITS for row in data]
+        expenses = [row[2] / MINOR_UNITS for row in data]
         matplotlib_widget.figure.clear()
         ax = matplotlib_widget.figure.add_subplot(111)
         ax.plot(months, incomes, label='Income', marker='o')
         ax.plot(months, expenses, label='Expenses', marker='o')
         ax.set_xlabel('Month')
-        ax.set_ylabel('Amount')
+        ax.set_ylabel(f'Amount ({DEFAULT_CURRENCY})')
         ax.set_title('Monthly Income and Expenses')
         ax.legend()
         matplotlib_widget.draw()
     else:
         # Handle case with no data
         pass
-
-
-def fetch_total(conn, table):
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT SUM(amount) FROM {table}")
-    result = cursor.fetchone()
-    return result[0] if result[0] is not None else 0
-
-
-def export_data_to_file(conn, file_path):
-    cursor = conn.cursor()
-    # Assuming you have a unified way to fetch all relevant data
-    cursor.execute("SELECT * FROM income UNION ALL SELECT * FROM expenses")
-    rows = cursor.fetchall()
-
-    with open(file_path, 'w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow(['ID', 'Date', 'Name', 'Amount'])  # Writing headers
-        for row in rows:
-            writer.writerow(row)
\ No newline at end of file
@@ -0,0 +1,226 @@
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThread, QThreadPool, pyqtSignal
+
+from backup import backup_database
+from changes import change_bus
+from database import create_connection, database_path, ConnectionManager
+from export import export_data
+from importer import import_transactions
+
+
+class ExportThread(QThread):
+    """Runs export_data on its own connection so the window stays responsive."""
+    progress = pyqtSignal(int, int)  # rows written, total rows
+    failed = pyqtSignal(str)
+    completed = pyqtSignal(bool)  # False if the export was cancelled
+
+    def __init__(self, db_path, user_id, file_path, parent=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self.user_id = user_id
+        self.file_path = file_path
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        conn = create_connection(self.db_path)
+        try:
+            finished = export_data(conn, self.user_id, self.file_path,
+                                   progress=self.progress.emit,
+                                   is_cancelled=lambda: self._cancelled)
+            self.completed.emit(finished)
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            conn.close()
+
+
+class BackupThread(QThread):
+    """Runs backup_database on its own connection while the app keeps reading and writing."""
+    progress = pyqtSignal(int, int)  # pages copied, total pages
+    failed = pyqtSignal(str)
+    completed = pyqtSignal(str)  # the snapshot file
+
+    def __init__(self, db_path, parent=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        try:
+            path = backup_database(self.db_path, progress=self.progress.emit,
+                                   is_cancelled=lambda: self._cancelled)
+            if path:
+                self.completed.emit(path)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class ImportThread(QThread):
+    """Runs import_transactions on its own connection."""
+    progress = pyqtSignal(int)  # rows processed
+    failed = pyqtSignal(str)
+    completed = pyqtSignal(object)  # ImportResult
+
+    def __init__(self, db_path, user_id, file_path, dry_run=False, parent=None, date_format=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self.user_id = user_id
+        self.file_path = file_path
+        self.dry_run = dry_run
+        self.date_format = date_format  # see import_transactions
+
+    def run(self):
+        conn = create_connection(self.db_path)
+        try:
+            result = import_transactions(conn, self.user_id, self.file_path, dry_run=self.dry_run,
+                                         date_format=self.date_format, progress=self.progress.emit)
+            self.completed.emit(result)
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            conn.close()
+
+
+class TaskSignals(QObject):
+    result = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    done = pyqtSignal()  # always emitted last, also after failures and cancellation
+
+
+class DatabaseTask(QRunnable):
+    """
+    Runs fn(conn, *args, **kwargs) on a pool thread with that thread's own connection.
+    Results are delivered through signals, which Qt queues to the GUI thread.
+    """
+
+    def __init__(self, executor, fn, args, kwargs=None):
+        super().__init__()
+        self.executor = executor
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.signals = TaskSignals()
+        self.conn = None
+        self.cancelled = False
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Drops the result; a query that is already running is interrupted."""
+        with self._lock:
+            self.cancelled = True
+            if self.conn is not None:
+                self.conn.interrupt()
+
+    def run(self):
+        try:
+            with self._lock:
+                if self.cancelled:
+                    return
+                self.conn = self.executor.connection()
+            try:
+                result = self.fn(self.conn, *self.args, **self.kwargs)
+            finally:
+                with self._lock:
+                    self.conn = None
+            if not self.cancelled:
+                self.signals.result.emit(result)
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.failed.emit(str(e))
+        finally:
+            self.finished = True
+            self.signals.done.emit()
+            self.executor.release(self)
+
+
+class DatabaseExecutor(QObject):
+    """
+    Runs database work off the GUI thread on a small QThreadPool. Every pool
+    thread keeps its own connection to the database file.
+
+    Databases without a file (":memory:") cannot be shared between connections,
+    so for those the work runs synchronously on the given connection.
+    """
+    MAX_THREADS = 2
+
+    def __init__(self, db_conn, parent=None):
+        super().__init__(parent)
+        self.db_conn = db_conn
+        self.db_path = database_path(db_conn)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(self.MAX_THREADS)
+        self.pool.setExpiryTimeout(-1)  # keep threads, and so their connections, alive
+        self.tasks = set()
+        self.connections = ConnectionManager(self.db_path)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, on_result=None, on_error=None, on_done=None, **kwargs):
+        """
+        Schedules fn(conn, *args, **kwargs) and returns the DatabaseTask, which can be
+        cancelled. The callbacks are invoked on the GUI thread.
+        """
+        task = DatabaseTask(self, fn, args, kwargs)
+        if on_result is not None:
+            task.signals.result.connect(on_result)
+        if on_error is not None:
+            task.signals.failed.connect(on_error)
+        if on_done is not None:
+            task.signals.done.connect(on_done)
+        # The pending writes of the GUI connection have to be visible to the pool
+        self.db_conn.commit()
+        if not self.db_path:
+            task.run()
+            return task
+        task.setAutoDelete(False)
+        with self._lock:
+            self.tasks.add(task)
+        self.pool.start(task)
+        return task
+
+    def connection(self):
+        if not self.db_path:
+            return self.db_conn
+        return self.connections.connection()
+
+    def release(self, task):
+        with self._lock:
+            self.tasks.discard(task)
+
+    def cancel_all(self):
+        with self._lock:
+            tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+
+    def shutdown(self):
+        self.cancel_all()
+        self.pool.waitForDone()
+        self.connections.close_all()
+
+
+class ChangeNotifier(QObject):
+    """
+    Re-emits the ChangeEvents of a changes.ChangeBus as the changed signal. Writes
+    publish on whichever thread ran them, and Qt queues the signal to the views
+    on the GUI thread.
+    """
+    changed = pyqtSignal(object)  # changes.ChangeEvent
+
+    def __init__(self, bus=change_bus, parent=None):
+        super().__init__(parent)
+        self.bus = bus
+        self.emit = emit = self.changed.emit
+        bus.subscribe(emit)
+        # Stop publishing into the signal once the C++ object is gone
+        self.destroyed.connect(lambda: bus.unsubscribe(emit))
+
+    def close(self):
+        self.bus.unsubscribe(self.emit)
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules import each other by their flat names, as when run from budgetingapp/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "budgetingapp"))
+
+from database import create_connection, initialize_database  # noqa: E402
+from users import add_default_user, find_user, DEFAULT_USERNAME  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "budgeting.db")
+
+
+@pytest.fixture
+def conn(db_path):
+    """A connection to a new, fully set up database with the default user."""
+    conn = create_connection(db_path)
+    initialize_database(conn)
+    add_default_user(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def user_id(conn):
+    return find_user(conn, DEFAULT_USERNAME)
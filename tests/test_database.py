@@ -0,0 +1,175 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from categories import add_category, add_rule, apply_rules
+from database import (create_connection, initialize_database, migrate_amounts, migrate_legacy_dates,
+                      needs_amount_migration, rebuild_category_totals, rebuild_monthly_totals, to_minor_units)
+from ledger import add_entry, delete_entries
+from users import create_user, find_user
+
+
+@pytest.mark.parametrize("amount, minor", [
+    ("12.34", 1234),
+    (" 7 ", 700),
+    (3, 300),
+    ("0.005", 1),
+    ("-0.005", -1),  # half away from zero
+    ("2.675", 268),
+    (2.675, 268),  # by its shortest repr, not the binary value just below 2.675
+    (0.1 + 0.2, 30),
+    (Decimal("1.999"), 200),
+    ("-19.994", -1999),
+])
+def test_to_minor_units_rounds_half_away_from_zero(amount, minor):
+    assert to_minor_units(amount) == minor
+
+
+@pytest.mark.parametrize("amount", ["", "abc", "1,5", "nan", "inf", "1e30"])
+def test_to_minor_units_rejects_invalid_amounts(amount):
+    with pytest.raises(ValueError):
+        to_minor_units(amount)
+
+
+def create_legacy_database(path):
+    """A database of the first version: REAL amounts in separate tables, with DD-MM-YYYY dates."""
+    conn = create_connection(path)
+    conn.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT UNIQUE NOT NULL, password TEXT NOT NULL);
+        CREATE TABLE income (id INTEGER PRIMARY KEY, date TEXT NOT NULL, name TEXT NOT NULL, amount REAL NOT NULL);
+        CREATE TABLE expenses (id INTEGER PRIMARY KEY, date TEXT NOT NULL, name TEXT NOT NULL, amount REAL NOT NULL);
+        CREATE TABLE recurring_transactions (
+            id INTEGER PRIMARY KEY, type TEXT NOT NULL, name TEXT NOT NULL, amount REAL NOT NULL,
+            start_date TEXT NOT NULL, frequency TEXT NOT NULL, last_processed_date TEXT
+        );
+        INSERT INTO income (date, name, amount) VALUES ('28-02-2024', 'Salary', 2500.5), ('31-03-2024', 'Salary', 2500.5);
+        INSERT INTO expenses (date, name, amount) VALUES
+            ('01-03-2024', 'Rent', 950), ('15-03-2024', 'Groceries', 0.1), ('15-03-2024', 'Groceries', 19.99);
+        INSERT INTO recurring_transactions (type, name, amount, start_date, frequency, last_processed_date) VALUES
+            ('expenses', 'Rent', 950.0, '01-01-2024', 'monthly', '01-03-2024');
+    """)
+    create_user(conn, "legacy", "secret")
+    return conn
+
+
+def test_legacy_database_is_migrated(db_path):
+    conn = create_legacy_database(db_path)
+    user_id = find_user(conn, "legacy")
+
+    assert initialize_database(conn)
+
+    cursor = conn.execute("SELECT user_id, type, date, name, amount, typeof(amount) FROM transactions ORDER BY id")
+    assert cursor.fetchall() == [
+        (user_id, "income", "2024-02-28", "Salary", 250050, "integer"),
+        (user_id, "income", "2024-03-31", "Salary", 250050, "integer"),
+        (user_id, "expenses", "2024-03-01", "Rent", 95000, "integer"),
+        (user_id, "expenses", "2024-03-15", "Groceries", 10, "integer"),
+        (user_id, "expenses", "2024-03-15", "Groceries", 1999, "integer"),
+    ]
+    cursor = conn.execute("""
+        SELECT amount, typeof(amount), start_date, last_processed_date, next_due_date FROM recurring_transactions
+    """)
+    assert cursor.fetchall() == [(95000, "integer", "2024-01-01", "2024-03-01", "2024-04-01")]
+    assert not needs_amount_migration(conn, "transactions")
+    assert not needs_amount_migration(conn, "recurring_transactions")
+    assert_rollups_match(conn)
+    # Nothing is left to do on the next start
+    assert not initialize_database(conn)
+    conn.close()
+
+
+def test_migrate_amounts_rebuilds_the_table_with_integer_amounts(conn):
+    conn.executescript("""
+        CREATE TABLE payments (
+            id INTEGER PRIMARY KEY, name TEXT NOT NULL, amount REAL NOT NULL, currency TEXT NOT NULL DEFAULT 'GBP'
+        );
+        INSERT INTO payments (id, name, amount, currency) VALUES
+            (3, 'a', 12.34, 'GBP'), (7, 'b', -0.07, 'USD'), (9, 'c', 1234567.89, 'EUR');
+    """)
+    assert needs_amount_migration(conn, "payments")
+
+    migrate_amounts(conn, "payments")
+    conn.commit()
+
+    assert not needs_amount_migration(conn, "payments")
+    cursor = conn.execute("SELECT id, name, amount, typeof(amount), currency FROM payments ORDER BY id")
+    assert cursor.fetchall() == [(3, "a", 1234, "integer", "GBP"), (7, "b", -7, "integer", "USD"),
+                                 (9, "c", 123456789, "integer", "EUR")]
+    assert conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'payments_new'").fetchone()[0] == 0
+
+
+def test_migrate_legacy_dates_in_batches(conn):
+    conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, date TEXT)")
+    dates = ["01-02-2023", "2023-02-02", "31-12-2023", "29-02-2024", None, "05-06-2024"]
+    conn.executemany("INSERT INTO events (date) VALUES (?)", [(date,) for date in dates])
+    conn.commit()
+
+    migrate_legacy_dates(conn, "events", "date", batch_size=2)
+
+    cursor = conn.execute("SELECT date FROM events ORDER BY id")
+    assert [row[0] for row in cursor.fetchall()] == [
+        "2023-02-01", "2023-02-02", "2023-12-31", "2024-02-29", None, "2024-06-05"]
+
+
+def rollups(conn):
+    monthly = conn.execute("SELECT user_id, month, type, currency, total, count FROM monthly_totals").fetchall()
+    category = conn.execute("SELECT user_id, month, category_id, currency, total, count FROM category_totals").fetchall()
+    return sorted(monthly), sorted(category)
+
+
+def assert_rollups_match(conn):
+    """The trigger-maintained rollups are what rebuilding them from the ledger gives."""
+    maintained = rollups(conn)
+    rebuild_monthly_totals(conn)
+    rebuild_category_totals(conn)
+    assert maintained == rollups(conn)
+    monthly, category = maintained
+    # and what adding up the ledger gives
+    assert sum(total for *_, total, _ in monthly) == conn.execute(
+        "SELECT IFNULL(SUM(amount), 0) FROM transactions").fetchone()[0]
+    assert sum(total for *_, total, _ in category) == conn.execute(
+        "SELECT IFNULL(SUM(amount), 0) FROM transactions WHERE type = 'expenses' AND category_id IS NOT NULL"
+    ).fetchone()[0]
+
+
+def test_rollups_follow_inserts_deletes_and_recategorising(conn, user_id):
+    create_user(conn, "other", "secret")
+    other = find_user(conn, "other")
+    groceries = add_category(conn, user_id, "Groceries", 40000)
+    transport = add_category(conn, user_id, "Transport")
+    add_rule(conn, user_id, groceries, "tesco")
+    D = datetime.date
+    ids = [
+        add_entry(conn, user_id, "expenses", D(2024, 3, 1), "Tesco Metro", 1250),
+        add_entry(conn, user_id, "expenses", D(2024, 3, 20), "TESCO", 899, "EUR"),
+        add_entry(conn, user_id, "expenses", D(2024, 4, 2), "Train", 4500, category_id=transport),
+        add_entry(conn, user_id, "expenses", D(2024, 4, 3), "Bus", 250),
+        add_entry(conn, user_id, "income", D(2024, 3, 28), "Salary", 250000),
+        add_entry(conn, other, "expenses", D(2024, 3, 5), "Tesco", 700),
+    ]
+    assert conn.execute("SELECT total FROM category_totals WHERE category_id = ? AND month = '2024-03'"
+                        " AND currency = 'GBP'", (groceries,)).fetchone() == (1250,)
+    assert_rollups_match(conn)
+
+    delete_entries(conn, user_id, "expenses", [ids[0]])
+    assert_rollups_match(conn)
+
+    with conn:
+        conn.execute("UPDATE transactions SET category_id = ? WHERE id = ?", (transport, ids[3]))  # categorised
+        conn.execute("UPDATE transactions SET category_id = ? WHERE id = ?", (groceries, ids[2]))  # moved
+        conn.execute("UPDATE transactions SET category_id = NULL WHERE id = ?", (ids[1],))  # uncategorised
+    assert_rollups_match(conn)
+
+    add_rule(conn, user_id, transport, "train")
+    assert apply_rules(conn, user_id, recategorize=True) == 2  # the train back, the Tesco row again
+    assert_rollups_match(conn)
+
+    with conn:
+        conn.execute("UPDATE transactions SET date = '2024-05-01', amount = 5000 WHERE id = ?", (ids[2],))
+        conn.execute("UPDATE transactions SET type = 'income' WHERE id = ?", (ids[3],))
+        conn.execute("UPDATE transactions SET currency = 'USD' WHERE id = ?", (ids[1],))
+    assert_rollups_match(conn)
+
+    delete_entries(conn, user_id, "expenses", ids[1:3])
+    assert_rollups_match(conn)
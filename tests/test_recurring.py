@@ -0,0 +1,99 @@
+import datetime
+import threading
+
+import categories
+from database import (add_recurring_transaction, create_connection, fetch_recurring_transactions, next_occurrence,
+                      sync_recurring_transactions_to_main)
+
+D = datetime.date
+
+
+def occurrences(start_date, frequency, count):
+    dates = [start_date]
+    while len(dates) < count:
+        dates.append(next_occurrence(start_date, frequency, dates[-1]))
+    return dates
+
+
+def test_monthly_rule_on_the_31st_is_clipped_without_drifting():
+    assert occurrences(D(2024, 1, 31), "monthly", 5) == [
+        D(2024, 1, 31), D(2024, 2, 29), D(2024, 3, 31), D(2024, 4, 30), D(2024, 5, 31)]
+    # From any day in between, as after a gap
+    assert next_occurrence(D(2024, 1, 31), "monthly", D(2024, 4, 12)) == D(2024, 4, 30)
+    assert next_occurrence(D(2024, 1, 31), "monthly", D(2024, 4, 30)) == D(2024, 5, 31)
+
+
+def test_yearly_rule_on_29_february():
+    assert occurrences(D(2020, 2, 29), "yearly", 5) == [
+        D(2020, 2, 29), D(2021, 2, 28), D(2022, 2, 28), D(2023, 2, 28), D(2024, 2, 29)]
+
+
+def test_next_occurrence_before_the_start_and_of_unknown_frequencies():
+    assert next_occurrence(D(2024, 3, 1), "weekly", D(2024, 1, 1)) == D(2024, 3, 1)
+    assert next_occurrence(D(2024, 3, 1), "weekly", D(2024, 3, 9)) == D(2024, 3, 15)
+    assert next_occurrence(D(2024, 3, 1), "fortnightly", D(2024, 3, 1)) is None
+
+
+def posted(conn, user_id):
+    cursor = conn.execute("SELECT date, name, amount FROM transactions WHERE user_id = ? ORDER BY date, id",
+                          (user_id,))
+    return cursor.fetchall()
+
+
+def test_sync_catches_up_on_every_missed_week(conn, user_id):
+    rule = add_recurring_transaction(conn, user_id, "expenses", "Cleaner", 4000, D(2024, 1, 1), "weekly")
+
+    assert sync_recurring_transactions_to_main(conn, user_id, today=D(2024, 1, 29)) == 5
+    assert posted(conn, user_id) == [(date, "Cleaner", 4000)
+                                     for date in ("2024-01-01", "2024-01-08", "2024-01-15", "2024-01-22", "2024-01-29")]
+    assert fetch_recurring_transactions(conn, user_id, [rule])[0][6] == "2024-02-05"
+
+    assert sync_recurring_transactions_to_main(conn, user_id, today=D(2024, 2, 4)) == 0
+    assert sync_recurring_transactions_to_main(conn, user_id, today=D(2024, 2, 12)) == 2
+    assert len(posted(conn, user_id)) == 7
+    assert fetch_recurring_transactions(conn, user_id, [rule])[0][6] == "2024-02-19"
+
+
+def test_sync_posts_month_ends_of_a_rule_on_the_31st(conn, user_id):
+    add_recurring_transaction(conn, user_id, "income", "Salary", 250000, D(2024, 1, 31), "monthly")
+
+    assert sync_recurring_transactions_to_main(conn, user_id, today=D(2024, 5, 31)) == 5
+    assert [date for date, *_ in posted(conn, user_id)] == [
+        "2024-01-31", "2024-02-29", "2024-03-31", "2024-04-30", "2024-05-31"]
+
+
+def test_concurrent_syncs_post_every_occurrence_once(conn, db_path, user_id, monkeypatch):
+    add_recurring_transaction(conn, user_id, "expenses", "Rent", 100000, D(2024, 1, 15), "monthly")
+    add_recurring_transaction(conn, user_id, "income", "Salary", 250000, D(2024, 1, 31), "monthly")
+
+    # Hold both syncs between reading the due rules and writing, so both read the same next_due_dates
+    both_read = threading.Barrier(2, timeout=10)
+    category_matcher = categories.category_matcher
+
+    def matcher_after_both_read(conn, user_id):
+        both_read.wait()
+        return category_matcher(conn, user_id)
+
+    monkeypatch.setattr(categories, "category_matcher", matcher_after_both_read)
+    results, errors = [], []
+
+    def sync():
+        sync_conn = create_connection(db_path, check_same_thread=False)
+        try:
+            results.append(sync_recurring_transactions_to_main(sync_conn, user_id, today=D(2024, 6, 15)))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            sync_conn.close()
+
+    threads = [threading.Thread(target=sync) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    assert not errors
+    assert sorted(results) == [0, 11]
+    rows = posted(conn, user_id)
+    assert len(rows) == len(set(rows)) == 11  # 6 rents from January to June and 5 salaries
+    assert [rule[6] for rule in fetch_recurring_transactions(conn, user_id)] == ["2024-07-15", "2024-06-30"]